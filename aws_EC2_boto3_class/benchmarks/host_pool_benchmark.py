@@ -0,0 +1,87 @@
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+# Fleet install throughput benchmark for the HostPool (sequential_master/pipeline_lib/host_pool.py).
+# No AWS or SSH is used: each simulated host does an SSH handshake and a Tomcat install with sleeps. The handshakes
+# slow down when many run at once (CPU in the container), and the installs slow down when more of them download at
+# the same time than the apt mirror can serve at full speed. This shows roughly where adding workers stops helping,
+# so ssh_max_workers / ssh_connect_rate and the container size can be picked for a given fleet size.
+#
+#   python3 benchmarks/host_pool_benchmark.py --hosts 1000 --workers 25,50,100,200 --connect-rates 0,20
+#
+# The times are scaled by --time-scale (0.01 = a 60 second install takes 0.6 seconds) so a run takes a minute or so.
+
+SCRIPT_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sequential_master')
+sys.path.insert(0, SCRIPT_DIRECTORY)
+
+from pipeline_lib.host_pool import HostPool
+
+
+class SimulatedFleet:
+    """Simulated hosts sharing a container CPU (for the handshakes) and an apt mirror (for the installs)"""
+
+    def __init__(self, time_scale, handshake_seconds=1.0, handshake_capacity=20, install_seconds=60.0,
+                 mirror_capacity=100):
+        self.time_scale = time_scale
+        self.handshake_seconds = handshake_seconds
+        self.handshake_capacity = handshake_capacity
+        self.install_seconds = install_seconds
+        self.mirror_capacity = mirror_capacity
+        self.active_handshakes = 0
+        self.active_installs = 0
+        self.peak_threads = 0
+        self._lock = threading.Lock()
+
+    def _phase(self, counter, base_seconds, capacity):
+        # The phase takes longer the more hosts are in it beyond the capacity
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            load = getattr(self, counter)
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+        slowdown = max(1.0, load / capacity)
+        time.sleep(base_seconds * slowdown * random.uniform(0.8, 1.2) * self.time_scale)
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) - 1)
+
+    def install(self, host, host_pool):
+        host_pool.before_connect()
+        self._phase('active_handshakes', self.handshake_seconds, self.handshake_capacity)
+        self._phase('active_installs', self.install_seconds, self.mirror_capacity)
+        return host, True
+
+
+def run_benchmark(hosts, max_workers, connect_rate, time_scale):
+    fleet = SimulatedFleet(time_scale)
+    host_pool = HostPool(max_workers=max_workers, connect_rate=connect_rate / time_scale if connect_rate else 0)
+    start = time.time()
+    completed = sum(1 for host, ok in host_pool.run(fleet.install, [(host, host_pool) for host in range(hosts)])
+                    if ok)
+    elapsed = (time.time() - start) / time_scale
+    return completed, elapsed, fleet.peak_threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated fleet install throughput for the HostPool")
+    parser.add_argument('--hosts', type=int, default=500)
+    parser.add_argument('--workers', default='10,25,50,100,200', help="comma separated ssh_max_workers values")
+    parser.add_argument('--connect-rates', default='0,10', help="comma separated ssh_connect_rate values (0 = off)")
+    parser.add_argument('--time-scale', type=float, default=0.01)
+    args = parser.parse_args()
+
+    print(f"{args.hosts} simulated hosts, times shown unscaled (seconds of a real run)")
+    print(f"{'Workers':>8} {'Connects/s':>11} {'Wall time (s)':>14} {'Hosts/min':>10} {'Peak threads':>13}")
+    for connect_rate in [float(rate) for rate in args.connect_rates.split(',')]:
+        for max_workers in [int(workers) for workers in args.workers.split(',')]:
+            completed, elapsed, peak_threads = run_benchmark(args.hosts, max_workers, connect_rate, args.time_scale)
+            rate_label = f"{connect_rate:g}" if connect_rate else 'off'
+            print(f"{max_workers:>8} {rate_label:>11} {elapsed:>14.0f} {completed / elapsed * 60:>10.0f} "
+                  f"{peak_threads:>13}")
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
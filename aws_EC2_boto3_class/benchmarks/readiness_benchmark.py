@@ -0,0 +1,63 @@
+import argparse
+import math
+import os
+import sys
+import threading
+import time
+
+# Readiness callback benchmark for the ReadinessReceiver (sequential_master/pipeline_lib/readiness_receiver.py).
+# No AWS is used: a receiver is started on a local port, simulated instances call back after a random boot time, and
+# one waiter per host (like the install workers of script 6) measures how long after the callback it was woken up.
+# For comparison it prints what the batched status poller adds on average (half a poll interval per host) and how
+# many describe_instance_status calls it makes over the same boot window.
+#
+#   python3 benchmarks/readiness_benchmark.py --hosts 500 --max-boot 10 --poll-interval 10
+
+SCRIPT_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sequential_master')
+sys.path.insert(0, SCRIPT_DIRECTORY)
+
+from pipeline_lib.instance_status import MAX_IDS_PER_CALL
+from pipeline_lib.readiness_receiver import CALLBACK_PATH, ReadinessReceiver, simulate_callers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated readiness callbacks against a local ReadinessReceiver")
+    parser.add_argument('--hosts', type=int, default=200)
+    parser.add_argument('--max-boot', type=float, default=5.0, help="boot times are random up to this many seconds")
+    parser.add_argument('--failed', type=int, default=0, help="how many hosts report a failed install")
+    parser.add_argument('--poll-interval', type=float, default=10.0, help="status_poll_interval to compare with")
+    args = parser.parse_args()
+
+    receiver = ReadinessReceiver(port=0, host='127.0.0.1').start()
+    url = f"http://127.0.0.1:{receiver.port}{CALLBACK_PATH}"
+    instance_ids = [f"i-{index:017x}" for index in range(args.hosts)]
+
+    woken_at = {}
+    results = {}
+
+    def waiter(instance_id):
+        results[instance_id] = receiver.wait(instance_id, args.max_boot + 30)
+        woken_at[instance_id] = time.monotonic()
+
+    threads = [threading.Thread(target=waiter, args=(instance_id,)) for instance_id in instance_ids]
+    for thread in threads:
+        thread.start()
+    start = time.monotonic()
+    sent_at = simulate_callers(url, instance_ids, max_delay=args.max_boot, failed_ids=set(instance_ids[:args.failed]))
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    receiver.stop()
+
+    latencies = sorted(woken_at[instance_id] - sent_at[instance_id] for instance_id in instance_ids)
+    print(f"{args.hosts} simulated hosts, {sum(results.values())} ready, {args.hosts - sum(results.values())} failed, "
+          f"all reported in {elapsed:.1f} seconds")
+    print(f"Callback to wake up: median {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"max {latencies[-1] * 1000:.1f} ms, 0 EC2 API calls")
+    polls = math.ceil(args.max_boot / args.poll_interval)
+    print(f"Status poller at {args.poll_interval:g} seconds: about {args.poll_interval / 2 * 1000:.0f} ms added per "
+          f"host on average, {polls * math.ceil(args.hosts / MAX_IDS_PER_CALL)} describe_instance_status calls")
+
+
+if __name__ == '__main__':
+    main()
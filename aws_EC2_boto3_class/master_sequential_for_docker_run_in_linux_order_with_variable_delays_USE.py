@@ -1,42 +1,23 @@
 import os
-import subprocess
-import time
+import sys
 
-def run_python_scripts_sequentially(directory, delays):
-    # List all files in the specified directory in the order of ls -la
-    files = sorted(os.listdir(directory))
-    
-    # Filter out only Python scripts
-    python_scripts = [f for f in files if f.endswith('.py')]
-    
-    # Run each Python script in the order they appear in the directory
-    for i, script in enumerate(python_scripts):
-        script_path = os.path.join(directory, script)
-        print(f"Running {script_path}...")
-        
-        # Run the script and capture output in binary mode
-        result = subprocess.run(['python3', script_path], capture_output=True)
-        stdout = result.stdout.decode('utf-8', errors='ignore')
-        stderr = result.stderr.decode('utf-8', errors='ignore')
-        
-        # Clean up the output by replacing '\\n' with actual new lines
-        cleaned_output = stdout.replace('\\n', '\n')
-        
-        # Print the cleaned output immediately
-        print(cleaned_output)
-        
-        # Introduce a delay if it's not the last script
-        if i < len(python_scripts) - 1:
-            print(f"Delaying next execution by {delays[i]} seconds...")
-            time.sleep(delays[i])
+# The step scripts and the shared pipeline_lib package are in sequential_master (/aws_EC2/sequential_master in the
+# docker image). Add it to the path so the master runner can use the same helpers as the steps.
+SCRIPT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sequential_master')
+sys.path.insert(0, SCRIPT_DIRECTORY)
+
+from pipeline_lib.context import PipelineContext
+from pipeline_lib.manifest import PIPELINE_STEPS
+from pipeline_lib.runner import run_pipeline_steps
 
 if __name__ == "__main__":
-    # Specify the directory containing the Python scripts
-    directory = '/aws_EC2/sequential_master'  # Replace with actual directory path
-    
-    # Specify the delays between running each script
-    delays = [5, 1, 90, 10, 90]  # Replace with actual delay values
-    
-    run_python_scripts_sequentially(directory, delays)
+    # The .env is created by the gitlab pipeline script (or passed in with docker run --env-file).
+    # The context holds the boto3 Session used by the readiness checks between the steps, and by the steps themselves
+    # when they run in-process (step_execution=in_process).
+    ctx = PipelineContext.from_env()
+
+    # Each step's stdout and stderr are streamed to the console line by line, prefixed with the step name.
+    # Independent steps (see depends_on in the manifest) run at the same time, up to max_parallel_steps.
+    run_pipeline_steps(SCRIPT_DIRECTORY, PIPELINE_STEPS, ctx)
 
 # test5
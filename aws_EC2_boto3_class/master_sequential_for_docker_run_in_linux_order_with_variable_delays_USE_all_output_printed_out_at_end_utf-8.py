@@ -1,47 +1,22 @@
 import os
-import subprocess
-import time
+import sys
+import tempfile
 
-def run_python_scripts_sequentially(directory, delays):
-    # List all files in the specified directory in the order of ls -la
-    files = sorted(os.listdir(directory))
-    
-    # Filter out only Python scripts
-    python_scripts = [f for f in files if f.endswith('.py')]
-    
-    all_outputs = []  # Collect outputs of all scripts
-    
-    # Run each Python script in the order they appear in the directory
-    for i, script in enumerate(python_scripts):
-        script_path = os.path.join(directory, script)
-        print(f"Running {script_path}...")
-        
-        # Run the script and capture output in binary mode
-        result = subprocess.run(['python3', script_path], capture_output=True)
-        stdout = result.stdout.decode('utf-8', errors='ignore')
-        stderr = result.stderr.decode('utf-8', errors='ignore')
-        
-        # Clean up the output by replacing '\\n' with actual new lines
-        cleaned_output = stdout.replace('\\n', '\n')
-        
-        # Collect the cleaned output
-        all_outputs.append(cleaned_output)
-        
-        # Introduce a delay if it's not the last script
-        if i < len(python_scripts) - 1:
-            print(f"Delaying next execution by {delays[i]} seconds...")
-            time.sleep(delays[i])
-    
-    return all_outputs
+# The step scripts and the shared pipeline_lib package are in sequential_master (/aws_EC2/sequential_master in the
+# docker image). Add it to the path so the master runner can use the same helpers as the steps.
+SCRIPT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sequential_master')
+sys.path.insert(0, SCRIPT_DIRECTORY)
+
+from pipeline_lib.context import PipelineContext
+from pipeline_lib.manifest import PIPELINE_STEPS
+from pipeline_lib.runner import run_pipeline_steps
+from pipeline_lib.streaming import print_spool_files
 
 if __name__ == "__main__":
-    # Specify the directory containing the Python scripts
-    directory = '/aws_EC2/sequential_master'  # Replace with actual directory path
-    
-    # Specify the delays between running each script
-    delays = [5, 1, 90, 10, 90]  # Replace with actual delay values
-    
-    outputs = run_python_scripts_sequentially(directory, delays)
-    for output in outputs:
-        print(output)
+    ctx = PipelineContext.from_env()
 
+    # Same runner as the _USE script, but the output of the steps is spooled to disk (one file per step) instead of
+    # being collected in an all_outputs list, and only printed out once all the steps are done.
+    spool_dir = tempfile.mkdtemp(prefix='pipeline_output_')
+    spool_paths = run_pipeline_steps(SCRIPT_DIRECTORY, PIPELINE_STEPS, ctx, spool_dir=spool_dir)
+    print_spool_files(spool_paths)
@@ -1,23 +1,23 @@
-import boto3
-from dotenv import load_dotenv
-import os
 import sys
 
-# This will load env vars from the .env file
-# They will be available to use in the rest of the code blocks below
-load_dotenv()
+from pipeline_lib.context import PipelineContext
+from pipeline_lib.fleet_launch import LAUNCH_TEMPLATE_SUFFIX, launch_fleet
+from pipeline_lib.golden_ami import resolve_golden_ami
+from pipeline_lib.install_manifest import TOMCAT_INSTALL_COMMANDS
+from pipeline_lib.inventory import build_inventory
+from pipeline_lib.launch_planner import DEFAULT_CHUNK_SIZE, LaunchPlanError, launch_multi_az
+from pipeline_lib.readiness_receiver import render_callback_installer, render_callback_user_data
+from pipeline_lib.stack_config import SUBNET_IDS
+from pipeline_lib.tags import ROLE_TAG_KEY, RUN_TAG_KEY, STACK_TAG_KEY, instance_tag_specifications, stack_name
+from pipeline_lib.tracing import get_tracer
+from pipeline_lib.user_data import render_user_data
+from pipeline_lib.warm_pool import start_warm_instances
 
+# Name of this step in the manifest and in the run state file
+STEP_NAME = '5_launch'
 
-# Set variables
-# os.getenv will load from the .env. The .env will be created on the fly by the gitlab pipeline script
-aws_access_key = f'{os.getenv("AWS_ACCESS_KEY_ID")}'
-aws_secret_key = f'{os.getenv("AWS_SECRET_ACCESS_KEY")}'
-region_name = f'{os.getenv("region_name")}'
-image_id = f'{os.getenv("image_id")}'
-instance_type = f'{os.getenv("instance_type")}'
-key_name = f'{os.getenv("key_name")}'
-min_count = f'{os.getenv("min_count")}'
-max_count = f'{os.getenv("max_count")}'
+# The settings (image_id, instance_type, key_name, min_count, max_count) and the AWS credentials are loaded from the
+# .env by the PipelineContext. The .env will be created on the fly by the gitlab pipeline script
 
 
 #def start_ec2_instances(aws_access_key, aws_secret_key, region_name, image_id, instance_type, key_name, min_count, max_count):
@@ -27,10 +27,10 @@ max_count = f'{os.getenv("max_count")}'
 #        aws_secret_access_key=aws_secret_key,
 #        region_name=region_name
 #    )
-#    
+#
 #    # Create an EC2 client
 #    my_ec2 = session.client('ec2')
-#    
+#
 #    # Start EC2 instances
 #    response = my_ec2.run_instances(
 #        ImageId=image_id,
@@ -39,7 +39,7 @@ max_count = f'{os.getenv("max_count")}'
 #        MinCount=int(min_count),
 #        MaxCount=int(max_count)
 #    )
-#    
+#
 #    return response
 #
 #
@@ -53,61 +53,180 @@ max_count = f'{os.getenv("max_count")}'
 
 
 ## Put the function in with the error handling and easy to read print outs:
-def start_ec2_instances(aws_access_key, aws_secret_key, region_name, image_id, instance_type, key_name, min_count, max_count):
-    # Establish a session with AWS
+# The session and the EC2 client now come from the shared PipelineContext (see main below)
+def start_ec2_instances(my_ec2, image_id, instance_type, key_name, min_count, max_count, user_data=None, tags=None):
+    # Start EC2 instances
+    launch_options = {}
+    if user_data:
+        launch_options['UserData'] = user_data
+    if tags:
+        launch_options['TagSpecifications'] = instance_tag_specifications(tags)
     try:
-        session = boto3.Session(
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key,
-            region_name=region_name
-        )
-        print("AWS session established.")
+        with get_tracer().span('run_instances', count=int(max_count)):
+            response = my_ec2.run_instances(
+                ImageId=image_id,
+                InstanceType=instance_type,
+                KeyName=key_name,
+                MinCount=int(min_count),
+                MaxCount=int(max_count),
+                **launch_options
+            )
+        print("EC2 instances started:", response)
     except Exception as e:
-        print("Error establishing AWS session:", e)
+        print("Error starting EC2 instances:", e)
         sys.exit(1)
 
+    return response
+
+
+def print_instances(response):
+    # Print the response in a more readable format using json.dumps for pretty printing
+    #print(json.dumps(response, indent=4))
+
+    # Print the response in a more readable format
+    if 'Instances' in response:
+        for i, instance in enumerate(response['Instances']):
+            print(f"Instance {i+1}:")
+            print(f"  Instance ID: {instance['InstanceId']}")
+            print(f"  Instance Type: {instance['InstanceType']}")
+            print(f"  Image ID: {instance['ImageId']}")
+            print(f"  State: {instance['State']['Name']}")
+            print(f"  Private IP Address: {instance['PrivateIpAddress']}")
+            print(f"  Subnet ID: {instance['SubnetId']}")
+    else:
+        print("No instances found in the response.")
+
+
+def main(ctx=None):
+    # Establish a session with AWS (or reuse the one the master runner passed in)
+    if ctx is None:
+        ctx = PipelineContext.from_env()
+
     # Create an EC2 client
     try:
-        my_ec2 = session.client('ec2')
+        my_ec2 = ctx.client('ec2')
         print("EC2 client created.")
     except Exception as e:
         print("Error creating EC2 client:", e)
         sys.exit(1)
 
-    # Start EC2 instances
-    try:
-        response = my_ec2.run_instances(
-            ImageId=image_id,
-            InstanceType=instance_type,
-            KeyName=key_name,
-            MinCount=int(min_count),
-            MaxCount=int(max_count)
+    image_id = ctx.setting("image_id")
+
+    # Launch from an AMI that already has Tomcat (see pipeline_lib/golden_ami.py)
+    if ctx.setting('provision_mode') == 'golden_ami':
+        with get_tracer().span('resolve_golden_ami'):
+            image_id = resolve_golden_ami(
+                ctx, TOMCAT_INSTALL_COMMANDS, image_id, ctx.setting("instance_type"), ctx.setting("key_name")
+            )
+        ctx.state.record(STEP_NAME, golden_ami_id=image_id)
+
+    # Install Tomcat at boot from the user-data, and/or report to the controller when booted
+    receiver = ctx.readiness_receiver
+    callback_url = ctx.setting('readiness_callback_url')
+    user_data = None
+    if ctx.setting('provision_mode') == 'user_data':
+        user_data = render_user_data(
+            TOMCAT_INSTALL_COMMANDS,
+            after_install=render_callback_installer(callback_url, receiver.token) if receiver else ''
         )
-        print("EC2 instances started:", response)
-    except Exception as e:
-        print("Error starting EC2 instances:", e)
+    elif receiver is not None:
+        user_data = render_callback_user_data(callback_url, receiver.token)
+
+    # Start the stopped instances of this stack first and only launch the shortfall
+    stack = stack_name(ctx)
+    # The later steps find this run's instances by these tags (see pipeline_lib/inventory.py)
+    run_tags = {RUN_TAG_KEY: ctx.state.run_id, ROLE_TAG_KEY: 'tomcat'}
+    max_count = int(ctx.setting("max_count"))
+    min_count = int(ctx.setting("min_count"))
+    warm_instances = []
+    if ctx.setting('warm_pool') == '1':
+        with get_tracer().span('start_warm_instances'):
+            warm_instances = start_warm_instances(my_ec2, stack, max_count)
+        if warm_instances:
+            my_ec2.create_tags(
+                Resources=[instance['InstanceId'] for instance in warm_instances],
+                Tags=[{'Key': key, 'Value': value} for key, value in run_tags.items()]
+            )
+
+    shortfall = max_count - len(warm_instances)
+    launch_error = None
+    if shortfall > 0 and ctx.setting('launch_mode') == 'multi_az':
+        # Spread the launch across the AZs of the ALB
+        try:
+            instances = launch_multi_az(
+                my_ec2,
+                ctx.client('service-quotas'),
+                SUBNET_IDS,
+                image_id,
+                ctx.setting("instance_type"),
+                ctx.setting("key_name"),
+                min(min_count, shortfall),
+                shortfall,
+                ctx.state.run_id,
+                user_data,
+                instance_tag_specifications({STACK_TAG_KEY: stack, **run_tags}),
+                chunk_size=int(ctx.setting('launch_chunk_size', DEFAULT_CHUNK_SIZE))
+            )
+        except LaunchPlanError as e:
+            print("Error starting EC2 instances:", e)
+            launch_error = e
+            instances = e.instances
+        response = {'Instances': instances}
+    elif shortfall > 0 and ctx.setting('launch_mode') == 'fleet':
+        # Launch from a launch template with an instant EC2 Fleet
+        instance_types = ctx.setting('fleet_instance_types') or ctx.setting("instance_type")
+        try:
+            instances = launch_fleet(
+                my_ec2,
+                stack + LAUNCH_TEMPLATE_SUFFIX,
+                SUBNET_IDS,
+                image_id,
+                [instance_type.strip() for instance_type in instance_types.split(',') if instance_type.strip()],
+                ctx.setting("key_name"),
+                min(min_count, shortfall),
+                shortfall,
+                ctx.state.run_id,
+                user_data,
+                instance_tag_specifications({STACK_TAG_KEY: stack, **run_tags}),
+                spot=ctx.setting('fleet_spot') == '1'
+            )
+        except LaunchPlanError as e:
+            print("Error starting EC2 instances:", e)
+            launch_error = e
+            instances = e.instances
+        response = {'Instances': instances}
+    elif shortfall > 0:
+        # Every instance is tagged with the stack so it can go back to the warm pool when it is stopped
+        response = start_ec2_instances(
+            my_ec2,
+            image_id,
+            ctx.setting("instance_type"),
+            ctx.setting("key_name"),
+            min(min_count, shortfall),
+            shortfall,
+            user_data,
+            tags={STACK_TAG_KEY: stack, **run_tags}
+        )
+        #print(response)
+    else:
+        response = {'Instances': []}
+    response['WarmInstances'] = warm_instances
+
+    print_instances({'Instances': warm_instances + response['Instances']})
+
+    # Save what was launched in the run state
+    instances = warm_instances + response['Instances']
+    ctx.state.record(
+        STEP_NAME,
+        instance_ids=[instance['InstanceId'] for instance in instances],
+        private_ips=[instance['PrivateIpAddress'] for instance in instances],
+        security_group_ids=list({sg['GroupId'] for instance in instances for sg in instance['SecurityGroups']}),
+        inventory=build_inventory(instances)
+    )
+    if launch_error is not None:
         sys.exit(1)
-
     return response
 
-response = start_ec2_instances(aws_access_key, aws_secret_key, region_name, image_id, instance_type, key_name, min_count, max_count)
-#print(response)
-
-
-# Print the response in a more readable format using json.dumps for pretty printing
-#print(json.dumps(response, indent=4))
-
-
 
-# Print the response in a more readable format
-if 'Instances' in response:
-    for i, instance in enumerate(response['Instances']):
-        print(f"Instance {i+1}:")
-        print(f"  Instance ID: {instance['InstanceId']}")
-        print(f"  Instance Type: {instance['InstanceType']}")
-        print(f"  Image ID: {instance['ImageId']}")
-        print(f"  State: {instance['State']['Name']}")
-        print(f"  Private IP Address: {instance['PrivateIpAddress']}")
-        print(f"  Subnet ID: {instance['SubnetId']}")
-else:
-    print("No instances found in the response.")
+if __name__ == "__main__":
+    main()
@@ -1,234 +1,433 @@
-import boto3
-from dotenv import load_dotenv
-import os
-import paramiko
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import json
 import sys
 
-# Load environment variables from the .env file
-load_dotenv()
-
-# Set variables from environment
-aws_access_key = os.getenv("AWS_ACCESS_KEY_ID")
-aws_secret_key = os.getenv("AWS_SECRET_ACCESS_KEY")
-region_name = os.getenv("region_name")
-image_id = os.getenv("image_id")
-instance_type = os.getenv("instance_type")
-key_name = os.getenv("key_name")
-min_count = os.getenv("min_count")
-max_count = os.getenv("max_count")
-aws_pem_key = os.getenv("AWS_PEM_KEY")
-
-# Define the instance ID to exclude (the EC2 controller)
-exclude_instance_id = 'i-0ddbf7fda9773252b'
-
-# Establish a session with AWS
-session = boto3.Session(
-    aws_access_key_id=aws_access_key,
-    aws_secret_access_key=aws_secret_key,
-    region_name=region_name
-)
-
-# Create an EC2 client
-my_ec2 = session.client('ec2')
-
-# Describe the running instances
-response = my_ec2.describe_instances(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
-
-# Get the public IP addresses and security group IDs of the running instances except the excluded instance ID
-public_ips = []
-private_ips = []
-security_group_ids = []
-instance_ids = []
-for reservation in response['Reservations']:
-    for instance in reservation['Instances']:
-        if instance['InstanceId'] != exclude_instance_id:
-            public_ips.append(instance['PublicIpAddress'])
-            private_ips.append(instance['PrivateIpAddress'])
-            instance_ids.append(instance['InstanceId'])
-            for sg in instance['SecurityGroups']:
-                security_group_ids.append(sg['GroupId'])
-
-
-# Save instance IDs and security group IDs to a file
-# The instance_id and the security_group_ids will be needed in the AWS ALB script in a different .py file
-data = {
-    'instance_ids': instance_ids,
-    'security_group_ids': list(set(security_group_ids))
-}
-with open('instance_ids.json', 'w') as f:
-    json.dump(data, f)
-
-
-
+from pipeline_lib.async_ssh import AsyncSSHEngine
+from pipeline_lib.bootstrap import run_bootstrap
+from pipeline_lib.context import PipelineContext
+from pipeline_lib.health import wait_for_tomcat
+from pipeline_lib.host_log import DEFAULT_LOG_DIR, DEFAULT_TAIL_LINES, HostLog
+from pipeline_lib.host_pool import HostPool
+from pipeline_lib.host_probe import DEFAULT_PROBE_CONNECT_TIMEOUT, probe_host, state_differences
+from pipeline_lib.host_results import HostResults, replace_instance
+from pipeline_lib.install_manifest import TOMCAT_INSTALL_COMMANDS, manifest_hash
+from pipeline_lib.instance_status import ready_instance_ids
+from pipeline_lib.inventory import refresh_inventory
+from pipeline_lib.port_scanner import CLOUD_INIT_WAIT, PortScanner
+from pipeline_lib.remote_exec import format_result, run_remote_command, run_remote_commands
+from pipeline_lib.security_groups import reconcile_ingress
+from pipeline_lib.ssh_pool import SSHConnectionPool
+from pipeline_lib.tags import TOMCAT_TAG_KEY
+from pipeline_lib.tracing import get_tracer
+from pipeline_lib.user_data import console_install_status
+
+# Name of this step in the manifest and in the run state file
+STEP_NAME = '6_install'
+
+# The AWS credentials and settings are loaded from the .env file by the PipelineContext
 
 # Define SSH details
 port = 22
 username = 'ubuntu'
 key_path = 'EC2_generic_key.pem'
 
-# Commands to install Tomcat server
-commands = [
-    'sudo DEBIAN_FRONTEND=noninteractive apt update -y',
-    'sudo DEBIAN_FRONTEND=noninteractive apt install -y tomcat9',
-    'sudo systemctl start tomcat9',
-    'sudo systemctl enable tomcat9'
-]
+# Commands to install Tomcat server (shared with the golden AMI baking, see pipeline_lib/install_manifest.py)
+commands = TOMCAT_INSTALL_COMMANDS
 
 
+def discover_instances(my_ec2, run_id):
+    # Refresh the running instances that script 5 launched in this run
+    inventory = refresh_inventory(my_ec2, run_id)
+    if not inventory:
+        print(f"No running instances tagged with run {run_id}")
 
+    # Get the public IP addresses and security group IDs of the instances
+    public_ips = []
+    private_ips = []
+    security_group_ids = []
+    instance_ids = []
+    for entry in inventory:
+        if not entry['public_ip']:
+            print(f"Instance {entry['instance_id']} has no public IP address, skipping it")
+            continue
+        public_ips.append(entry['public_ip'])
+        private_ips.append(entry['private_ip'])
+        instance_ids.append(entry['instance_id'])
+        security_group_ids.extend(entry['security_group_ids'])
 
+    return public_ips, private_ips, instance_ids, security_group_ids
 
-# Add a security group rule to allow access to port 22
-for sg_id in set(security_group_ids):
-    try:
-        my_ec2.authorize_security_group_ingress(
-            GroupId=sg_id,
-            IpPermissions=[
-                {
-                    'IpProtocol': 'tcp',
-                    'FromPort': 22,
-                    'ToPort': 22,
-                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
-                }
-            ]
-        )
-    except my_ec2.exceptions.ClientError as e:
-        if 'InvalidPermission.Duplicate' in str(e):
-            print(f"Rule already exists for security group {sg_id}")
-        else:
-            raise
-
-# Add a security group rule to allow access to port 80
-for sg_id in set(security_group_ids):
-    try:
-        my_ec2.authorize_security_group_ingress(
-            GroupId=sg_id,
-            IpPermissions=[
-                {
-                    'IpProtocol': 'tcp',
-                    'FromPort': 80,
-                    'ToPort': 80,
-                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
-                }
-            ]
-        )
-    except my_ec2.exceptions.ClientError as e:
-        if 'InvalidPermission.Duplicate' in str(e):
-            print(f"Rule already exists for security group {sg_id}")
-        else:
-            raise
-
-
-# Add a security group rule to allow access to port 8080
-for sg_id in set(security_group_ids):
-    try:
-        my_ec2.authorize_security_group_ingress(
-            GroupId=sg_id,
-            IpPermissions=[
-                {
-                    'IpProtocol': 'tcp',
-                    'FromPort': 8080,
-                    'ToPort': 8080,
-                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
-                }
-            ]
-        )
-    except my_ec2.exceptions.ClientError as e:
-        if 'InvalidPermission.Duplicate' in str(e):
-            print(f"Rule already exists for security group {sg_id}")
-        else:
-            raise
 
+def open_security_group_ports(my_ec2, security_group_ids):
+    # Allow access to ports 22 (SSH), 80 and 8080 (Tomcat)
+    reconcile_ingress(my_ec2, security_group_ids, [22, 80, 8080])
 
 
 # Function to wait for instance to be in running state and pass status checks
-def wait_for_instance_running(instance_id, ec2_client):
-    instance_status = ec2_client.describe_instance_status(InstanceIds=[instance_id])
-    while (instance_status['InstanceStatuses'][0]['InstanceState']['Name'] != 'running' or
-           instance_status['InstanceStatuses'][0]['SystemStatus']['Status'] != 'ok' or
-           instance_status['InstanceStatuses'][0]['InstanceStatus']['Status'] != 'ok'):
-        print(f"Waiting for instance {instance_id} to be in running state and pass status checks...")
-        time.sleep(10)
-        instance_status = ec2_client.describe_instance_status(InstanceIds=[instance_id])
+def wait_for_instance_running(instance_id, status_poller, timeout=None):
+    print(f"Waiting for instance {instance_id} to be in running state and pass status checks...")
+    if status_poller.wait(instance_id, timeout):
+        print(f"Instance {instance_id} is running and passed status checks")
+        return True
+    print(f"Instance {instance_id} did not pass status checks within {timeout} seconds")
+    return False
 
 # Function to install Tomcat on an instance
-def install_tomcat(ip, private_ip, instance_id):
-    wait_for_instance_running(instance_id, my_ec2)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    for attempt in range(5):
-        try:
-            print(f"Attempting to connect to {ip} (Attempt {attempt + 1})")
-            ssh.connect(ip, port, username, key_filename=key_path)
-            break
-        except paramiko.ssh_exception.NoValidConnectionsError as e:
-            print(f"Connection failed: {e}")
-            time.sleep(10)
-    else:
-        print(f"Failed to connect to {ip} after multiple attempts")
+def install_tomcat(ip, private_ip, instance_id, status_poller, status_check_timeout=None, remote_command_options=None,
+                   install_mode='commands', host_pool=None, early_start=False, ssh_pool=None, results_file=None,
+                   log_dir=DEFAULT_LOG_DIR, tail_lines=DEFAULT_TAIL_LINES):
+    # Time each phase per host for the trace, and record it in the per-host results
+    tracer = get_tracer()
+    if results_file is None:
+        results_file = HostResults(None)
+    # With early_start port 22 already answered: the status checks are waited for after the install
+    if not early_start:
+        with tracer.span('wait_for_instance_running', host=ip), \
+                results_file.phase(instance_id, 'wait_for_instance_running'):
+            if not wait_for_instance_running(instance_id, status_poller, status_check_timeout):
+                results_file.error(instance_id, f"Did not pass the status checks within {status_check_timeout} seconds")
+                return ip, private_ip, False
+    # The connection comes from the shared SSH pool
+    if ssh_pool is None:
+        ssh_pool = SSHConnectionPool(key_path, username, port)
+    with results_file.phase(instance_id, 'ssh_connect'):
+        ssh = ssh_pool.connect(ip, host_pool.before_connect if host_pool is not None else None)
+    if ssh is None:
+        results_file.error(instance_id, f"Could not connect to {ip} over SSH")
         return ip, private_ip, False
 
     print(f"Connected to {ip}. Executing commands...")
-    for command in commands:
-        for attempt in range(3):
-            stdin, stdout, stderr = ssh.exec_command(command)
-            stdout_output = stdout.read().decode()
-            stderr_output = stderr.read().decode()
-            print(f"Executing command: {command}")
-            print(f"STDOUT: {stdout_output}")
-            print(f"STDERR: {stderr_output}")
-            
-            # Check for real errors and ignore warnings
-            if "E: Package 'tomcat9' has no installation candidate" in stderr_output:
-                print(f"Installation failed for {ip} due to package issue.")
-                stdin.close()
-                stdout.close()
-                stderr.close()
-                ssh.close()
-                return ip, private_ip, False
-            
-            # Ignore specific warnings that are not critical errors
-            if "WARNING:" in stderr_output:
-                print(f"Warning on {ip}: {stderr_output}")
-                stderr_output = ""
-            
-            if stderr_output.strip():  # If there are any other errors left after ignoring warnings
-                print(f"Error executing command on {ip}: {stderr_output}")
-                stdin.close()
-                stdout.close()
-                stderr.close()
-                ssh.close()
+    # The apt output goes to the host's log instead of the console
+    log = HostLog(log_dir, ip, tail_lines)
+    try:
+        if early_start:
+            with results_file.phase(instance_id, 'cloud_init_wait'):
+                run_remote_command(ssh, CLOUD_INIT_WAIT, retries=1, host=ip, log=log)
+        # Each command is retried only if its exit status is non-zero
+        with results_file.phase(instance_id, 'install'):
+            if install_mode == 'bootstrap':
+                results = run_bootstrap(ssh, commands, host=ip, log=log, **(remote_command_options or {}))
+            else:
+                results = run_remote_commands(ssh, commands, host=ip, log=log, **(remote_command_options or {}))
+    finally:
+        log.close()
+        # The install is the last phase that needs SSH on this host
+        ssh_pool.discard(ip)
+    duration = sum(result['duration'] for result in results)
+    if not results[-1]['ok']:
+        print(f"{ip}: install failed after {duration:.1f}s, {format_result(results[-1])}, output in {log.path}")
+        if "E: Package 'tomcat9' has no installation candidate" in results[-1]['stderr']:
+            print(f"Installation failed for {ip} due to package issue.")
+        log.print_tail()
+        results_file.error(instance_id, f"{results[-1]['command']}: {format_result(results[-1])}: "
+                                        f"{results[-1]['stderr']}")
+        return ip, private_ip, False
+    if early_start:
+        # The poller has been following the status checks in the background during the install
+        with tracer.span('wait_for_instance_running', host=ip), \
+                results_file.phase(instance_id, 'wait_for_instance_running'):
+            if not wait_for_instance_running(instance_id, status_poller, status_check_timeout):
+                results_file.error(instance_id, f"Did not pass the status checks within {status_check_timeout} seconds")
                 return ip, private_ip, False
-            
-            print(f"Retrying command: {command} (Attempt {attempt + 1})")
-            time.sleep(10)
-        stdin.close()
-        stdout.close()
-        stderr.close()
-    ssh.close()
-    transport = ssh.get_transport()
-    if transport is not None:
-        transport.close()
+    print(f"{ip}: install ok, {len(results)} commands in {duration:.1f}s, output in {log.path}")
     print(f"Installation completed on {ip}")
     return ip, private_ip, True
 
-# Use ThreadPoolExecutor to run installations in parallel
-# In this updated script, the `install_tomcat` function returns a tuple containing the IP address and the result (`True` for success, `False` for failure). The script collects the IP addresses of both successful and failed installations in separate lists (`successful_ips` and `failed_ips`) and prints them out at the end. This way, you can easily identify which instances had successful installations and which ones failed.
-# Also: This script now correctly checks for both SSH connection failures and package installation failures, and prints out the IP addresses of both successful and failed installations.
-# This is to troubleshoot an issue where with 50 instances there were 2 that did not have Installation completed.
 
-failed_ips = []
-successful_ips = []
-failed_private_ips = []
-successful_private_ips = []
+# Function to verify Tomcat on an instance that already has it (golden AMI or user-data install)
+def verify_tomcat(ip, private_ip, instance_id, status_poller, status_check_timeout=None, health_timeout=300,
+                  my_ec2=None, results_file=None):
+    tracer = get_tracer()
+    if results_file is None:
+        results_file = HostResults(None)
+    with tracer.span('wait_for_instance_running', host=ip), \
+            results_file.phase(instance_id, 'wait_for_instance_running'):
+        if not wait_for_instance_running(instance_id, status_poller, status_check_timeout):
+            results_file.error(instance_id, f"Did not pass the status checks within {status_check_timeout} seconds")
+            return ip, private_ip, False
+    with tracer.span('verify_tomcat', host=ip), results_file.phase(instance_id, 'verify_tomcat'):
+        if not wait_for_tomcat(ip, health_timeout):
+            print(f"Tomcat is not responding on {ip}")
+            results_file.error(instance_id, f"Tomcat did not respond on port 8080 within {health_timeout} seconds")
+            if my_ec2 is not None:
+                # The user-data install leaves its exit code on the console
+                exit_code = console_install_status(my_ec2, instance_id)
+                if exit_code is None:
+                    print(f"The user-data install on {instance_id} has not finished (no exit code on the console)")
+                else:
+                    print(f"The user-data install on {instance_id} exited with {exit_code}, "
+                          f"see /var/log/pipeline-install.log on the host")
+            return ip, private_ip, False
+    print(f"Tomcat is responding on {ip}")
+    return ip, private_ip, True
+
 
-with ThreadPoolExecutor(max_workers=len(public_ips)) as executor:
-    futures = [executor.submit(install_tomcat, ip, private_ip, instance_id) for ip, private_ip, instance_id in zip(public_ips, private_ips, instance_ids)]
-    for future in as_completed(futures):
-        ip, private_ip, result  = future.result()
+def tomcat_installed_ids(my_ec2, instance_ids, manifest):
+    """The IDs of the instances tagged as having Tomcat installed from this install manifest"""
+    if not instance_ids:
+        return set()
+    installed = set()
+    paginator = my_ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(InstanceIds=instance_ids,
+                                   Filters=[{'Name': f'tag:{TOMCAT_TAG_KEY}', 'Values': [manifest]}]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                installed.add(instance['InstanceId'])
+    return installed
+
+
+def verify_fleet(ctx, hosts, status_poller, status_check_timeout, health_timeout, console_ec2=None,
+                 results_file=None):
+    """verify_tomcat on every (ip, private_ip, instance_id) in hosts, on the bounded host pool"""
+    host_pool = HostPool.from_settings(ctx)
+    work_items = [
+        (ip, private_ip, instance_id, status_poller, status_check_timeout, health_timeout, console_ec2, results_file)
+        for ip, private_ip, instance_id in hosts
+    ]
+    return list(host_pool.run(verify_tomcat, work_items))
+
+
+def probe_tomcat(ip, private_ip, instance_id, ssh_pool, host_pool, connect_timeout):
+    # One round trip to read the Tomcat state of a host (see pipeline_lib/host_probe.py)
+    with get_tracer().span('probe_host', host=ip):
+        state = probe_host(ssh_pool, ip, host_pool.before_connect, connect_timeout)
+    if state is None:
+        print(f"Could not probe {ip}, it goes through the install")
+        return (ip, private_ip, instance_id), False
+    differences = state_differences(state)
+    if differences:
+        print(f"{ip} needs the install: {', '.join(differences)}")
+        return (ip, private_ip, instance_id), False
+    # Nothing else needs SSH on this host
+    ssh_pool.discard(ip)
+    print(f"Tomcat {state['version']} is already installed and running on {ip}, skipping the install")
+    return (ip, private_ip, instance_id), True
+
+
+def probe_fleet(ctx, my_ec2, hosts):
+    """Probe the hosts that are already up, on the bounded host pool. Returns (hosts already in the installed state,
+    hosts that need the install)."""
+    if not hosts:
+        return [], []
+    # Only probe the instances that already pass their status checks
+    ready_ids = ready_instance_ids(my_ec2, [instance_id for ip, private_ip, instance_id in hosts])
+    probe_hosts = [host for host in hosts if host[2] in ready_ids]
+    needs_install = [host for host in hosts if host[2] not in ready_ids]
+    if not probe_hosts:
+        return [], needs_install
+    print(f"Probing {len(probe_hosts)} hosts that are already up for an existing Tomcat install")
+    host_pool = HostPool.from_settings(ctx)
+    connect_timeout = float(ctx.setting('probe_connect_timeout', DEFAULT_PROBE_CONNECT_TIMEOUT))
+    work_items = [
+        (ip, private_ip, instance_id, ctx.ssh_pool, host_pool, connect_timeout)
+        for ip, private_ip, instance_id in probe_hosts
+    ]
+    in_state = []
+    for host, installed in host_pool.run(probe_tomcat, work_items):
+        (in_state if installed else needs_install).append(host)
+    return in_state, needs_install
+
+
+def install_fleet(ctx, hosts, status_poller, status_check_timeout, results_file=None):
+    """install_tomcat on every (ip, private_ip, instance_id) in hosts. Returns [(ip, private_ip, result)]."""
+    # Retries and backoff (seconds, doubled after each failed attempt) for the install commands
+    remote_command_options = {
+        'retries': int(ctx.setting('remote_command_retries', 3)),
+        'backoff': float(ctx.setting('remote_command_backoff', 10)),
+    }
+    install_mode = ctx.setting('install_mode', 'commands')
+    # Where the per-host output logs go, and how many of their last lines are printed for a failed host
+    log_dir = ctx.setting('host_log_dir', DEFAULT_LOG_DIR)
+    tail_lines = int(ctx.setting('console_tail_lines', DEFAULT_TAIL_LINES))
+    # With ssh_readiness=port_scan a host starts as soon as its port 22 is open
+    ssh_readiness = ctx.setting('ssh_readiness', 'status_checks')
+    if not hosts:
+        return []
+    if ssh_readiness == 'port_scan':
+        status_poller.watch([instance_id for ip, private_ip, instance_id in hosts])
+
+    if ctx.setting('ssh_engine', 'threads') == 'asyncio':
+        # All the hosts are driven from one asyncio event loop
+        engine = AsyncSSHEngine.from_settings(ctx, key_path, username, port, readiness=ssh_readiness,
+                                              **remote_command_options)
+        print(f"Installing on {len(hosts)} hosts with the asyncio SSH engine, {engine.max_connections} at a time")
+        # The engine records the phases, timings and errors of each host in the per-host results
+        return [
+            (ip, private_ip, result)
+            for ip, private_ip, result, command_results in engine.run(hosts, commands, status_poller,
+                                                                       status_check_timeout,
+                                                                       results_file=results_file)
+        ]
+
+    # At most ssh_max_workers hosts at a time, taken in order from a queue
+    host_pool = HostPool.from_settings(ctx)
+    print(f"Installing on {len(hosts)} hosts, {host_pool.max_workers} at a time")
+    ssh_pool = ctx.ssh_pool
+    if ssh_readiness != 'port_scan':
+        work_items = [
+            (ip, private_ip, instance_id, status_poller, status_check_timeout, remote_command_options, install_mode,
+             host_pool, False, ssh_pool, results_file, log_dir, tail_lines)
+            for ip, private_ip, instance_id in hosts
+        ]
+        return list(host_pool.run(install_tomcat, work_items))
+
+    # The scanner probes port 22 of all the hosts at once and the pool picks each host up as soon as it is open
+    scanner = PortScanner.from_settings(ctx, port)
+    unreachable = []
+
+    def reachable_work_items():
+        for (ip, private_ip, instance_id), reachable in scanner.scan(hosts, status_check_timeout):
+            if reachable:
+                print(f"Port {port} is open on {ip}, starting the install")
+                yield (ip, private_ip, instance_id, status_poller, status_check_timeout, remote_command_options,
+                       install_mode, host_pool, True, ssh_pool, results_file, log_dir, tail_lines)
+            else:
+                print(f"Port {port} did not open on {ip} within {status_check_timeout} seconds")
+                if results_file is not None:
+                    results_file.error(instance_id, f"Port {port} did not open within {status_check_timeout} seconds")
+                unreachable.append((ip, private_ip, False))
+
+    installed = list(host_pool.run(install_tomcat, reachable_work_items()))
+    return installed + unreachable
+
+
+def replace_failed_hosts(ctx, my_ec2, results_file, replace_after):
+    """Replace the instances that failed replace_after times in a row with fresh ones (see
+    pipeline_lib/host_results.py), and swap them in the target group if script 7 already created it"""
+    failed_ids = results_file.failed(replace_after)
+    if not failed_ids:
+        return []
+    print(f"Replacing {len(failed_ids)} instances that failed {replace_after} times: {', '.join(failed_ids)}")
+    new_instances = []
+    for instance_id in failed_ids:
+        # The copy keeps the pipeline:stack/run/role tags, so the inventory refresh below picks it up
+        new_instance = replace_instance(my_ec2, instance_id, exclude_tags=(TOMCAT_TAG_KEY,))
+        print(f"Instance {instance_id} terminated, replaced with {new_instance['InstanceId']}")
+        new_instances.append(new_instance)
+        results_file.forget(instance_id)
+    new_ids = [instance['InstanceId'] for instance in new_instances]
+    my_ec2.get_waiter('instance_running').wait(InstanceIds=new_ids)
+
+    target_group_arn = ctx.state.get('target_group_arn')
+    if target_group_arn:
+        elb_client = ctx.client('elbv2')
+        elb_client.deregister_targets(TargetGroupArn=target_group_arn,
+                                      Targets=[{'Id': instance_id} for instance_id in failed_ids])
+        elb_client.register_targets(TargetGroupArn=target_group_arn,
+                                    Targets=[{'Id': instance_id} for instance_id in new_ids])
+        print(f"Swapped {len(new_ids)} replacement instances into the target group")
+    return new_ids
+
+
+def main(ctx=None):
+    # Establish a session with AWS (or reuse the one the master runner passed in)
+    if ctx is None:
+        ctx = PipelineContext.from_env()
+
+    # Create an EC2 client
+    my_ec2 = ctx.client('ec2')
+
+    tracer = get_tracer()
+
+    # Per-host results, saved to host_results_file at the end
+    results_file = HostResults.from_settings(ctx)
+    rerun = ctx.setting('install_rerun') == 'failed'
+    replace_after = int(ctx.setting('replace_failed_after', 0))
+    if rerun and replace_after:
+        with tracer.span('replace_failed_hosts'):
+            replace_failed_hosts(ctx, my_ec2, results_file, replace_after)
+
+    with tracer.span('discover_instances'):
+        public_ips, private_ips, instance_ids, security_group_ids = discover_instances(my_ec2, ctx.state.run_id)
+
+    # Save the hosts under this step's own keys: instance_ids and security_group_ids are script 5's
+    ctx.state.record(
+        STEP_NAME,
+        install_instance_ids=instance_ids,
+        install_security_group_ids=list(set(security_group_ids)),
+        install_public_ips=public_ips,
+        install_private_ips=private_ips
+    )
+
+    with tracer.span('open_security_group_ports'):
+        open_security_group_ports(my_ec2, security_group_ids)
+
+    # Run the installations in parallel (bounded host pool, see install_fleet)
+    # In this updated script, the `install_tomcat` function returns a tuple containing the IP address and the result (`True` for success, `False` for failure). The script collects the IP addresses of both successful and failed installations in separate lists (`successful_ips` and `failed_ips`) and prints them out at the end. This way, you can easily identify which instances had successful installations and which ones failed.
+    # Also: This script now correctly checks for both SSH connection failures and package installation failures, and prints out the IP addresses of both successful and failed installations.
+    # This is to troubleshoot an issue where with 50 instances there were 2 that did not have Installation completed.
+
+    failed_ips = []
+    successful_ips = []
+    failed_private_ips = []
+    successful_private_ips = []
+
+    # One poller for the status checks of all the hosts (or the readiness callback receiver)
+    status_poller = ctx.readiness_receiver or ctx.status_poller
+    status_check_timeout = int(ctx.setting('status_check_timeout', 900))
+
+    hosts = list(zip(public_ips, private_ips, instance_ids))
+    done_hosts = []
+    if rerun:
+        succeeded_ids = set(results_file.succeeded(instance_ids))
+        done_hosts = [host for host in hosts if host[2] in succeeded_ids]
+        hosts = [host for host in hosts if host[2] not in succeeded_ids]
+        print(f"Rerunning the {len(hosts)} hosts that failed or have no result, "
+              f"{len(done_hosts)} already succeeded")
+    for ip, private_ip, instance_id in hosts:
+        results_file.start(instance_id, ip, private_ip)
+    ip_to_instance_id = {ip: instance_id for ip, private_ip, instance_id in hosts}
+
+    with tracer.span('install_tomcat_fleet', hosts=len(hosts)):
+        provision_mode = ctx.setting('provision_mode')
+        if provision_mode in ('golden_ami', 'user_data'):
+            # Tomcat is already there or being installed at boot: only verify it
+            print(f"Verifying Tomcat on {len(hosts)} hosts ({provision_mode})")
+            health_timeout = int(ctx.setting('tomcat_health_timeout', 300 if provision_mode == 'golden_ami' else 900))
+            console_ec2 = my_ec2 if provision_mode == 'user_data' else None
+            host_results = verify_fleet(ctx, hosts, status_poller, status_check_timeout, health_timeout, console_ec2,
+                                        results_file)
+        else:
+            # Warm pool instances tagged with this install manifest already have Tomcat: only verify them
+            manifest = manifest_hash(commands, ctx.setting('image_id'))
+            installed_ids = tomcat_installed_ids(my_ec2, instance_ids, manifest)
+            warm_hosts = [host for host in hosts if host[2] in installed_ids]
+            new_hosts = [host for host in hosts if host[2] not in installed_ids]
+            host_results = []
+            if warm_hosts:
+                print(f"Tomcat is already installed on {len(warm_hosts)} warm pool hosts, verifying them")
+                health_timeout = int(ctx.setting('tomcat_health_timeout', 300))
+                warm_results = verify_fleet(ctx, warm_hosts, status_poller, status_check_timeout, health_timeout,
+                                            results_file=results_file)
+                host_results = [host_result for host_result in warm_results if host_result[2]]
+                verified_ips = {ip for ip, private_ip, result in host_results}
+                new_hosts += [host for host in warm_hosts if host[0] not in verified_ips]
+
+            # Only install on the hosts that are not already in the installed state
+            if ctx.setting('install_probe', '1') == '1':
+                with tracer.span('probe_fleet', hosts=len(new_hosts)):
+                    probed_hosts, new_hosts = probe_fleet(ctx, my_ec2, new_hosts)
+                if probed_hosts:
+                    print(f"{len(probed_hosts)} hosts already have Tomcat installed and running, "
+                          f"installing on {len(new_hosts)}")
+            else:
+                probed_hosts = []
+
+            installed = install_fleet(ctx, new_hosts, status_poller, status_check_timeout, results_file)
+            installed += [(ip, private_ip, True) for ip, private_ip, instance_id in probed_hosts]
+            host_results += installed
+
+            # Tag the hosts Tomcat was installed on, so they are skipped when they come back from the warm pool
+            tag_ids = [ip_to_instance_id[ip] for ip, private_ip, result in installed if result]
+            for start in range(0, len(tag_ids), 1000):
+                my_ec2.create_tags(Resources=tag_ids[start:start + 1000],
+                                   Tags=[{'Key': TOMCAT_TAG_KEY, 'Value': manifest}])
+
+    for ip, private_ip, result in host_results:
+        results_file.finish(ip_to_instance_id[ip], result)
+    results_file.save()
+    # The hosts that already succeeded in an earlier run still count as installed
+    host_results += [(ip, private_ip, True) for ip, private_ip, instance_id in done_hosts]
+
+    for ip, private_ip, result in host_results:
         if result:
             successful_ips.append(ip)
             successful_private_ips.append(private_ip)
@@ -236,12 +435,22 @@ with ThreadPoolExecutor(max_workers=len(public_ips)) as executor:
             failed_ips.append(ip)
             failed_private_ips.append(private_ip)
 
-if successful_ips:
-    print(f"Installation succeeded on the following IPs: {', '.join(successful_ips)}")
-    print(f"Installation succeeded on the following private IPs: {', '.join(successful_private_ips)}")
-if failed_ips:
-    print(f"Installation failed on the following IPs: {', '.join(failed_ips)}")
-    print(f"Installation failed on the following private IPs: {', '.join(failed_private_ips)}")
+    if successful_ips:
+        print(f"Installation succeeded on the following IPs: {', '.join(successful_ips)}")
+        print(f"Installation succeeded on the following private IPs: {', '.join(successful_private_ips)}")
+    if failed_ips:
+        print(f"Installation failed on the following IPs: {', '.join(failed_ips)}")
+        print(f"Installation failed on the following private IPs: {', '.join(failed_private_ips)}")
+
+    ctx.state.record(STEP_NAME, successful_ips=successful_ips, failed_ips=failed_ips)
+
+    print("Script execution completed.")
+    if failed_ips:
+        # A failed host leaves the step incomplete, so the next pipeline run resumes here
+        print(f"Installation failed on {len(failed_ips)} hosts, exiting with an error so a rerun can pick them up")
+        sys.exit(1)
+    return successful_ips, failed_ips
 
-print("Script execution completed.")
 
+if __name__ == "__main__":
+    main()
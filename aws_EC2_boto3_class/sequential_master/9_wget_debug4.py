@@ -1,195 +1,223 @@
-import boto3
-from dotenv import load_dotenv
-import os
-import paramiko
-import time
 import sys
 
-# Load environment variables from the .env file
-load_dotenv()
-
-# Set variables from environment
-aws_access_key = os.getenv("AWS_ACCESS_KEY_ID")
-aws_secret_key = os.getenv("AWS_SECRET_ACCESS_KEY")
-region_name = os.getenv("region_name")
-image_id = os.getenv("image_id")
-instance_type = os.getenv("instance_type")
-key_name = os.getenv("key_name")
+from pipeline_lib.async_ssh import AsyncSSHEngine
+from pipeline_lib.bootstrap import run_bootstrap
+from pipeline_lib.context import PipelineContext
+from pipeline_lib.host_log import DEFAULT_LOG_DIR, DEFAULT_TAIL_LINES, HostLog
+from pipeline_lib.readiness_receiver import render_callback_user_data
+from pipeline_lib.remote_exec import detached_command, format_result, run_remote_command, run_remote_commands
+from pipeline_lib.ssh_pool import SSHConnectionPool
+from pipeline_lib.tags import ROLE_TAG_KEY, RUN_TAG_KEY, instance_tag_specifications
+from pipeline_lib.tracing import get_tracer
+
+# Name of this step in the manifest and in the run state file
+STEP_NAME = '9_stress'
+
+# The AWS credentials and settings (image_id, instance_type, key_name) are loaded from the .env file by the
+# PipelineContext
 aws_pem_key = 'EC2_generic_key.pem'
 
-# Establish a session with AWS
-session = boto3.Session(
-    aws_access_key_id=aws_access_key,
-    aws_secret_access_key=aws_secret_key,
-    region_name=region_name
-)
-
-# Create an EC2 client
-my_ec2 = session.client('ec2')
-
-# Launch an EC2 instance with error handling
-try:
-    instances = my_ec2.run_instances(
-        ImageId=image_id,
-        InstanceType=instance_type,
-        KeyName=key_name,
-        MinCount=1,
-        MaxCount=1
-    )
-    instance_id = instances['Instances'][0]['InstanceId']
-    print(f"Launched EC2 instance with ID: {instance_id}")
-    sys.stdout.flush()
-except Exception as e:
-    print(f"Error launching EC2 instance: {e}")
-    sys.stdout.flush()
-    exit(1)
-
-# Function to wait for instance to be in running state and pass status checks
-def wait_for_instance_running(instance_id, ec2_client):
-    while True:
-        try:
-            instance_status = ec2_client.describe_instance_status(InstanceIds=[instance_id])
-            print(f"Instance status: {instance_status}")
-            sys.stdout.flush()
-            if (instance_status['InstanceStatuses'][0]['InstanceState']['Name'] == 'running' and
-                instance_status['InstanceStatuses'][0]['SystemStatus']['Status'] == 'ok' and
-                instance_status['InstanceStatuses'][0]['InstanceStatus']['Status'] == 'ok'):
-                print(f"Instance {instance_id} is now running and has passed status checks.")
-                sys.stdout.flush()
-                break
-            else:
-                print(f"Waiting for instance {instance_id} to be in running state and pass status checks...")
-                sys.stdout.flush()
-                time.sleep(10)
-        except Exception as e:
-            print(f"Error checking instance status: {e}")
-            sys.stdout.flush()
-            time.sleep(10)
-
-# Wait for the instance to be in running state and pass status checks
-wait_for_instance_running(instance_id, my_ec2)
-
-# Retrieve instance details including DNS and public IP
-try:
-    instance_description = my_ec2.describe_instances(InstanceIds=[instance_id])
-    instance_dns = instance_description['Reservations'][0]['Instances'][0].get('PublicDnsName', '')
-    instance_ip = instance_description['Reservations'][0]['Instances'][0].get('PublicIpAddress', '')
-    if not instance_dns:
-        print(f"Public DNS name not available, using Public IP: {instance_ip}")
-        sys.stdout.flush()
-    else:
-        print(f"Instance DNS: {instance_dns}")
-        sys.stdout.flush()
-except Exception as e:
-    print(f"Error retrieving instance details: {e}")
-    sys.stdout.flush()
-    exit(1)
-
-# Function to install wget and run the stress test script on the instance
-def install_wget_and_run_script(instance_address, key_path):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+# Commands to install wget and create the stress test script
+commands = [
+    "sudo DEBIAN_FRONTEND=noninteractive apt update",    
+    #"sudo apt update",
     
-    for attempt in range(5):
-        try:
-            print(f"Attempting to connect to {instance_address} (Attempt {attempt + 1})")
-            sys.stdout.flush()
-            ssh.connect(instance_address, port=22, username='ubuntu', key_filename=key_path)
-            break
-        except paramiko.ssh_exception.NoValidConnectionsError as e:
-            print(f"Connection failed: {e}")
-            sys.stdout.flush()
-            time.sleep(10)
-    else:
-        print(f"Failed to connect to {instance_address} after multiple attempts")
-        sys.stdout.flush()
-        return False
-
-    print(f"Connected to {instance_address}. Executing commands...")
-    sys.stdout.flush()
 
-    commands = [
-        "sudo DEBIAN_FRONTEND=noninteractive apt update",    
-        #"sudo apt update",
-        
-
-        "sudo DEBIAN_FRONTEND=noninteractive apt-get -o Dpkg::Options::='--force-confdef' -o Dpkg::Options::='--force-confold' install wget -y",
-        #"sudo DEBIAN_FRONTEND=noninteractive apt install wget -y",
-        #"sudo apt install wget -y",
-        
-        "echo 'while true; do wget -q -O- https://loadbalancer.holinessinloveofchrist.com; done' > stress_test.sh",
-        
-        "chmod +x stress_test.sh",
-        
-        # Move this out of the command block so that the wget shell script output does NOT print to gitlab console.
-        # Otherwise, the buffer overflows and the print statements for many of the scripts stop going to the console.
-        # "./stress_test.sh"
-    ]
+    "sudo DEBIAN_FRONTEND=noninteractive apt-get -o Dpkg::Options::='--force-confdef' -o Dpkg::Options::='--force-confold' install wget -y",
+    #"sudo DEBIAN_FRONTEND=noninteractive apt install wget -y",
+    #"sudo apt install wget -y",
     
-    for command in commands:
-        print(f"Executing command: {command}")
-        sys.stdout.flush()
-        stdin, stdout, stderr = ssh.exec_command(command)
-        stdout_output = stdout.read().decode()
-        stderr_output = stderr.read().decode()
+    "echo 'while true; do wget -q -O- https://loadbalancer.holinessinloveofchrist.com; done' > stress_test.sh",
     
-        # Check if wget is already installed and proceed if it is
-        # This issue caused the script to abort without running the shell script
-        if "wget is already the newest version" in stdout_output or "wget is already installed" in stdout_output:
-            print("wget is already installed. Proceeding with the stress test script.")
-            sys.stdout.flush()
-            continue
+    "chmod +x stress_test.sh",
+    
+    # Move this out of the command block so that the wget shell script output does NOT print to gitlab console.
+    # Otherwise, the buffer overflows and the print statements for many of the scripts stop going to the console.
+    # "./stress_test.sh"
+]
 
+# The stress loop, started after the commands without printing its output
+stress_command = './stress_test.sh'
 
 
-        print(f"STDOUT: {stdout_output}")
-        sys.stdout.flush()
-        print(f"STDERR: {stderr_output}")
+# Function to install wget and run the stress test script on the instance
+def install_wget_and_run_script(instance_address, key_path, instance_id, install_mode='commands', ssh_pool=None,
+                                log_dir=DEFAULT_LOG_DIR, tail_lines=DEFAULT_TAIL_LINES, remote_command_options=None):
+    # The connection comes from the shared SSH pool
+    if ssh_pool is None:
+        ssh_pool = SSHConnectionPool(key_path)
+    ssh = ssh_pool.connect(instance_address)
+    sys.stdout.flush()
+    if ssh is None:
+        return False
+
+    print(f"Connected to {instance_address}. Executing commands...")
+    sys.stdout.flush()
+
+    # The apt output goes to the host's log, not to the GitLab console
+    log = HostLog(log_dir, instance_address, tail_lines)
+    try:
+        ok = _run_commands(ssh, instance_address, install_mode, log, remote_command_options)
+    finally:
+        log.close()
+    if not ok:
+        log.print_tail()
         sys.stdout.flush()
-        
-        if stderr_output.strip() and "WARNING: apt does not have a stable CLI interface." not in stderr_output:
-            print(f"Error executing command on {instance_address}: {stderr_output}")
-            sys.stdout.flush()
-        #if stderr_output.strip():
-            #print(f"Error executing command on {instance_address}: {stderr_output}")
-            stdin.close()
-            stdout.close()
-            stderr.close()
-            ssh.close()
-            return False
-        
-        time.sleep(10)
-    
+        ssh_pool.discard(instance_address)
+        return False
 
     # Execute the stress test script without printing its output
     # This was moved out of the command block above to prevent it printing to the console with the other stuff.
-    ssh.exec_command("./stress_test.sh")
-
-
-
-    stdin.close()
-    stdout.close()
-    stderr.close()
-    #ssh.close()
+    # Detached, so it keeps running once the connection is closed
+    result = run_remote_command(ssh, detached_command(stress_command), retries=1, host=instance_address)
+    if not result['ok']:
+        print(f"Could not start the stress test script on {instance_address}: {format_result(result)}")
+        sys.stdout.flush()
+        ssh_pool.discard(instance_address)
+        return False
 
-    transport = ssh.get_transport()
-    if transport is not None:
-        transport.close()
+    # The stress host is not used by any later phase, so its connection is closed as before
+    ssh_pool.discard(instance_address)
     
-    print(f"Installation completed on {instance_address}")
+    print(f"Installation completed on {instance_address}, output in {log.path}")
     sys.stdout.flush()
     print(f"Instance ID {instance_id} is sending wget traffic.")
     sys.stdout.flush()
     return True
 
-# Path to your SSH key file (replace with your actual key file path)
-key_file_path = 'EC2_generic_key.pem'
+# The install commands of install_wget_and_run_script, with their output going to log. Returns False on a failure.
+def _run_commands(ssh, instance_address, install_mode, log, remote_command_options=None):
+    # Each command is retried only if its exit status is non-zero, as in script 6
+    if install_mode == 'bootstrap':
+        results = run_bootstrap(ssh, commands, host=instance_address, log=log, **(remote_command_options or {}))
+    else:
+        results = run_remote_commands(ssh, commands, host=instance_address, log=log, **(remote_command_options or {}))
+    if not results[-1]['ok']:
+        print(f"Error executing command on {instance_address}: {format_result(results[-1])}")
+        sys.stdout.flush()
+        return False
+    return True
+
+# Same as install_wget_and_run_script with the asyncio SSH engine (ssh_engine=asyncio, see pipeline_lib/async_ssh.py)
+def install_wget_and_run_script_async(instance_address, key_path, instance_id, ctx):
+    engine = AsyncSSHEngine.from_settings(ctx, key_path)
+    # The stress loop is started detached (nohup) so it keeps running after the engine disconnects
+    [(address, private_ip, result, command_results)] = engine.run(
+        [(instance_address, '', instance_id)], commands, background_command=stress_command
+    )
+    # The engine prints one line per command and streams the output into the host's log (host_log_dir)
+    sys.stdout.flush()
+    if result:
+        print(f"Instance ID {instance_id} is sending wget traffic.")
+        sys.stdout.flush()
+    return result
+
+def main(ctx=None):
+    # Establish a session with AWS (or reuse the one the master runner passed in)
+    if ctx is None:
+        ctx = PipelineContext.from_env()
+
+    image_id = ctx.setting("image_id")
+    instance_type = ctx.setting("instance_type")
+    key_name = ctx.setting("key_name")
+
+    # Create an EC2 client
+    my_ec2 = ctx.client('ec2')
+    tracer = get_tracer()
+
+    # With readiness_callback_url the instance reports to the controller when it has booted
+    receiver = ctx.readiness_receiver
+    launch_options = {}
+    if receiver is not None:
+        launch_options['UserData'] = render_callback_user_data(ctx.setting('readiness_callback_url'), receiver.token)
+
+    # Launch an EC2 instance with error handling
+    try:
+        with tracer.span('run_instances', count=1):
+            instances = my_ec2.run_instances(
+                ImageId=image_id,
+                InstanceType=instance_type,
+                KeyName=key_name,
+                MinCount=1,
+                MaxCount=1,
+                # Tagged with the run but with its own role, so it is never taken for a Tomcat host
+                TagSpecifications=instance_tag_specifications({RUN_TAG_KEY: ctx.state.run_id, ROLE_TAG_KEY: 'stress'}),
+                **launch_options
+            )
+        instance_id = instances['Instances'][0]['InstanceId']
+        ctx.state.record(STEP_NAME, stress_instance_id=instance_id)
+        print(f"Launched EC2 instance with ID: {instance_id}")
+        sys.stdout.flush()
+    except Exception as e:
+        print(f"Error launching EC2 instance: {e}")
+        sys.stdout.flush()
+        sys.exit(1)
+
+    # Wait for the instance to be in running state and pass status checks
+    status_check_timeout = int(ctx.setting('status_check_timeout', 900))
+    with tracer.span('wait_for_instance_running', host=instance_id):
+        if receiver is not None:
+            if not receiver.wait(instance_id, status_check_timeout):
+                print(f"Instance {instance_id} did not report ready")
+                sys.stdout.flush()
+                sys.exit(1)
+        else:
+            # The shared status poller, as in script 6
+            status_poller = ctx.status_poller
+            status_poller.watch([instance_id])
+            print(f"Waiting for instance {instance_id} to be in running state and pass status checks...")
+            sys.stdout.flush()
+            if not status_poller.wait(instance_id, status_check_timeout):
+                print(f"Instance {instance_id} did not pass status checks within {status_check_timeout} seconds")
+                sys.stdout.flush()
+                sys.exit(1)
+            print(f"Instance {instance_id} is now running and has passed status checks.")
+            sys.stdout.flush()
+
+    # Retrieve instance details including DNS and public IP
+    try:
+        instance_description = my_ec2.describe_instances(InstanceIds=[instance_id])
+        instance_dns = instance_description['Reservations'][0]['Instances'][0].get('PublicDnsName', '')
+        instance_ip = instance_description['Reservations'][0]['Instances'][0].get('PublicIpAddress', '')
+        if not instance_dns:
+            print(f"Public DNS name not available, using Public IP: {instance_ip}")
+            sys.stdout.flush()
+        else:
+            print(f"Instance DNS: {instance_dns}")
+            sys.stdout.flush()
+    except Exception as e:
+        print(f"Error retrieving instance details: {e}")
+        sys.stdout.flush()
+        sys.exit(1)
+
+    # Path to your SSH key file (replace with your actual key file path)
+    key_file_path = 'EC2_generic_key.pem'
+
+    # Install wget and run the stress test script on the instance
+    with tracer.span('install_wget_and_run_script', host=instance_id):
+        if ctx.setting('ssh_engine', 'threads') == 'asyncio':
+            ok = install_wget_and_run_script_async(instance_dns if instance_dns else instance_ip, key_file_path,
+                                                   instance_id, ctx)
+        else:
+            ok = install_wget_and_run_script(instance_dns if instance_dns else instance_ip, key_file_path, instance_id,
+                                             ctx.setting('install_mode', 'commands'), ctx.ssh_pool,
+                                             ctx.setting('host_log_dir', DEFAULT_LOG_DIR),
+                                             int(ctx.setting('console_tail_lines', DEFAULT_TAIL_LINES)),
+                                             {'retries': int(ctx.setting('remote_command_retries', 3)),
+                                              'backoff': float(ctx.setting('remote_command_backoff', 10))})
+
+    if not ok:
+        print(f"The stress traffic script could not be set up on {instance_id}")
+        sys.stdout.flush()
+        sys.exit(1)
+
+    print(f"EC2 instance {instance_id} is created and stress traffic script is running.")
+    sys.stdout.flush()
+    return instance_id
 
-# Install wget and run the stress test script on the instance
-install_wget_and_run_script(instance_dns if instance_dns else instance_ip, key_file_path)
 
-print(f"EC2 instance {instance_id} is created and stress traffic script is running.")
-sys.stdout.flush()
+if __name__ == "__main__":
+    main()
 
 
 # test2
@@ -12,6 +12,11 @@ aws_access_key = f'{os.getenv("AWS_ACCESS_KEY_ID")}'
 aws_secret_key = f'{os.getenv("AWS_SECRET_ACCESS_KEY")}'
 region_name = f'{os.getenv("region_name")}'
 
+# With warm_pool=1 the stopped instances of the stack (tag pipeline:stack = stack_name) are the warm pool that the
+# next pipeline run starts again instead of launching new instances, so they are not terminated
+warm_pool = os.getenv("warm_pool") == '1'
+stack_name = os.getenv("stack_name", 'tomcat-alb')
+
 def get_stopped_instance_ids(exclude_ids=None):
     if exclude_ids is None:
         exclude_ids = []
@@ -42,6 +47,10 @@ def get_stopped_instance_ids(exclude_ids=None):
         for reservation in response['Reservations']:
             for instance in reservation['Instances']:
                 instance_id = instance['InstanceId']
+                tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                if warm_pool and tags.get('pipeline:stack') == stack_name:
+                    print(f"Keeping warm pool instance {instance_id}")
+                    continue
                 if instance_id not in exclude_ids:
                     instance_ids.append(instance_id)
         
@@ -0,0 +1,3 @@
+# Shared helpers for the master runner and the numbered step scripts in sequential_master.
+# This is a package (sub directory) on purpose: the master runner only executes the top level .py files in
+# sequential_master, so nothing in here is ever run as a pipeline step by itself.
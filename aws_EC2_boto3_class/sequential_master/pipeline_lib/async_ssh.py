@@ -0,0 +1,265 @@
+import asyncio
+import time
+
+from pipeline_lib.host_log import DEFAULT_LOG_DIR, DEFAULT_TAIL_LINES, HostLog
+from pipeline_lib.host_results import HostResults
+from pipeline_lib.port_scanner import (
+    CLOUD_INIT_WAIT,
+    DEFAULT_CONNECT_TIMEOUT as PORT_SCAN_CONNECT_TIMEOUT,
+    DEFAULT_INTERVAL as PORT_SCAN_INTERVAL,
+    wait_for_port_async,
+)
+from pipeline_lib.rate_limit import TokenBucket
+from pipeline_lib.remote_exec import (
+    READ_SIZE,
+    TailBuffer,
+    command_attempts,
+    command_result,
+    detached_command,
+    format_result,
+    retry_delay,
+)
+from pipeline_lib.tracing import get_tracer
+
+# asyncio SSH engine (ssh_engine=asyncio in the .env), built on asyncssh.
+# The default engine gives every host a thread that sits in stdout.read() and time.sleep() for most of the install.
+# Here all the hosts are driven from one event loop: a host costs a coroutine and its SSH connection instead of a
+# thread, so one container can work on 1,000+ hosts at a time. The behaviour matches the thread engine: wait for
+# the status checks (through the shared poller), connect with retries, run the commands in order with exit status
+# based retries, and report (ip, private_ip, ok) per host so the callers can build successful_ips / failed_ips.
+#
+# Settings: ssh_max_workers caps the hosts worked on at once (default 1000 for this engine), ssh_connect_rate the
+# new connections per second, ssh_connect_timeout the seconds allowed for one connection attempt (default 30) and
+# ssh_host_deadline the seconds allowed for a whole host after its status checks passed (default 1800).
+# With readiness='port_scan' (ssh_readiness=port_scan for script 6) a host is started as soon as its SSH port accepts
+# connections, and its status checks are only waited for after the install (see port_scanner.py).
+# The output of the commands is streamed into a compressed log per host (host_log_dir, see host_log.py), and the
+# phases of each host (with their timings and the error a host stopped on) go to the per-host results like the thread
+# engine's (see host_results.py).
+
+DEFAULT_MAX_CONNECTIONS = 1000
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_HOST_DEADLINE = 1800
+
+CONNECT_ATTEMPTS = 5
+CONNECT_RETRY_DELAY = 10
+
+
+def _import_asyncssh():
+    # asyncssh is only needed with ssh_engine=asyncio, so it is imported on first use
+    try:
+        import asyncssh
+    except ImportError:
+        raise ImportError("ssh_engine=asyncio needs the asyncssh package (pip install -r requirements.txt)")
+    return asyncssh
+
+
+async def _acquire_async(bucket):
+    while not bucket.try_acquire():
+        await asyncio.sleep(1 / bucket.rate)
+
+
+class AsyncSSHEngine:
+    """Runs a command list on many hosts concurrently from one asyncio event loop"""
+
+    def __init__(self, key_path, username='ubuntu', port=22, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 connect_rate=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT, host_deadline=DEFAULT_HOST_DEADLINE,
+                 retries=3, backoff=10, backoff_factor=2, readiness='status_checks',
+                 port_scan_interval=PORT_SCAN_INTERVAL, port_scan_connect_timeout=PORT_SCAN_CONNECT_TIMEOUT,
+                 log_dir=DEFAULT_LOG_DIR, tail_lines=DEFAULT_TAIL_LINES):
+        self.key_path = key_path
+        self.username = username
+        self.port = port
+        self.max_connections = max(1, int(max_connections))
+        self.connect_limiter = TokenBucket(connect_rate) if connect_rate else None
+        self.connect_timeout = connect_timeout
+        self.host_deadline = host_deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.readiness = readiness
+        self.port_scan_interval = port_scan_interval
+        self.port_scan_connect_timeout = port_scan_connect_timeout
+        self.log_dir = log_dir
+        self.tail_lines = tail_lines
+
+    @classmethod
+    def from_settings(cls, ctx, key_path, username='ubuntu', port=22, retries=3, backoff=10,
+                      readiness='status_checks'):
+        return cls(
+            key_path, username=username, port=port,
+            max_connections=int(ctx.setting('ssh_max_workers', DEFAULT_MAX_CONNECTIONS)),
+            connect_rate=float(ctx.setting('ssh_connect_rate', 10)),
+            connect_timeout=float(ctx.setting('ssh_connect_timeout', DEFAULT_CONNECT_TIMEOUT)),
+            host_deadline=float(ctx.setting('ssh_host_deadline', DEFAULT_HOST_DEADLINE)),
+            retries=retries, backoff=backoff, readiness=readiness,
+            port_scan_interval=float(ctx.setting('port_scan_interval', PORT_SCAN_INTERVAL)),
+            port_scan_connect_timeout=float(ctx.setting('port_scan_connect_timeout', PORT_SCAN_CONNECT_TIMEOUT)),
+            log_dir=ctx.setting('host_log_dir', DEFAULT_LOG_DIR),
+            tail_lines=int(ctx.setting('console_tail_lines', DEFAULT_TAIL_LINES)),
+        )
+
+    def run(self, hosts, commands, status_poller=None, status_check_timeout=None, background_command=None,
+            results_file=None):
+        """Run commands on every (ip, private_ip, instance_id) in hosts. Returns [(ip, private_ip, ok, results)].
+        The phases of each host are recorded in results_file (a HostResults) if there is one."""
+        if results_file is None:
+            results_file = HostResults(None)
+        return asyncio.run(self._run(hosts, commands, status_poller, status_check_timeout, background_command,
+                                     results_file))
+
+    async def _run(self, hosts, commands, status_poller, status_check_timeout, background_command, results_file):
+        asyncssh = _import_asyncssh()
+        # The key is parsed once for the whole fleet, not once per connection
+        client_keys = [asyncssh.read_private_key(self.key_path)]
+        semaphore = asyncio.Semaphore(self.max_connections)
+        if self.readiness == 'port_scan' and status_poller is not None:
+            status_poller.watch([instance_id for ip, private_ip, instance_id in hosts])
+        return await asyncio.gather(*[
+            self._run_host(asyncssh, client_keys, semaphore, ip, private_ip, instance_id, commands, status_poller,
+                           status_check_timeout, background_command, results_file)
+            for ip, private_ip, instance_id in hosts
+        ])
+
+    async def _run_host(self, asyncssh, client_keys, semaphore, ip, private_ip, instance_id, commands,
+                        status_poller, status_check_timeout, background_command, results_file):
+        tracer = get_tracer()
+        if self.readiness == 'port_scan':
+            start = time.time()
+            with results_file.phase(instance_id, 'wait_for_ssh_port'):
+                ready = await wait_for_port_async(ip, self.port, status_check_timeout, self.port_scan_interval,
+                                                  self.port_scan_connect_timeout)
+            tracer.add_span('wait_for_ssh_port', 'phase', start, time.time(), host=ip)
+            if not ready:
+                print(f"Port {self.port} did not open on {ip} within {status_check_timeout} seconds")
+                results_file.error(instance_id, f"Port {self.port} did not open within {status_check_timeout} seconds")
+                return ip, private_ip, False, []
+            print(f"Port {self.port} is open on {ip}, starting the install")
+        elif status_poller is not None:
+            start = time.time()
+            print(f"Waiting for instance {instance_id} to be in running state and pass status checks...")
+            with results_file.phase(instance_id, 'wait_for_instance_running'):
+                ready = await status_poller.wait_async(instance_id, status_check_timeout)
+            tracer.add_span('wait_for_instance_running', 'phase', start, time.time(), host=ip)
+            if not ready:
+                print(f"Instance {instance_id} did not pass status checks within {status_check_timeout} seconds")
+                results_file.error(instance_id, f"Did not pass the status checks within {status_check_timeout} seconds")
+                return ip, private_ip, False, []
+
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(
+                    self._install(asyncssh, client_keys, ip, private_ip, instance_id, commands, background_command,
+                                  results_file),
+                    self.host_deadline
+                )
+            except asyncio.TimeoutError:
+                print(f"Installation on {ip} did not finish within {self.host_deadline} seconds")
+                results_file.error(instance_id, f"Did not finish within {self.host_deadline} seconds")
+                return ip, private_ip, False, []
+
+        if self.readiness == 'port_scan' and status_poller is not None and result[2]:
+            # The poller has been following the status checks in the background during the install
+            start = time.time()
+            with results_file.phase(instance_id, 'wait_for_instance_running'):
+                ready = await status_poller.wait_async(instance_id, status_check_timeout)
+            tracer.add_span('wait_for_instance_running', 'phase', start, time.time(), host=ip)
+            if not ready:
+                print(f"Instance {instance_id} did not pass status checks within {status_check_timeout} seconds")
+                results_file.error(instance_id, f"Did not pass the status checks within {status_check_timeout} seconds")
+                return ip, private_ip, False, result[3]
+        return result
+
+    async def _connect(self, asyncssh, client_keys, ip):
+        tracer = get_tracer()
+        start = time.time()
+        try:
+            for attempt in range(CONNECT_ATTEMPTS):
+                if self.connect_limiter is not None:
+                    await _acquire_async(self.connect_limiter)
+                try:
+                    print(f"Attempting to connect to {ip} (Attempt {attempt + 1})")
+                    return await asyncssh.connect(
+                        ip, self.port, username=self.username, client_keys=client_keys, known_hosts=None,
+                        connect_timeout=self.connect_timeout
+                    )
+                except (OSError, asyncssh.Error, asyncio.TimeoutError) as e:
+                    print(f"Connection failed: {e}")
+                    await asyncio.sleep(CONNECT_RETRY_DELAY)
+            print(f"Failed to connect to {ip} after multiple attempts")
+            return None
+        finally:
+            tracer.add_span('ssh_connect', 'phase', start, time.time(), host=ip)
+
+    async def _stream(self, reader, tail, log):
+        # Copy one output stream of a remote process into its tail and the host's log as it arrives
+        while True:
+            chunk = await reader.read(READ_SIZE)
+            if not chunk:
+                return
+            tail.feed(chunk)
+            if log is not None:
+                log.write(chunk)
+
+    async def run_command(self, conn, command, host, log=None):
+        """The asyncio version of remote_exec.run_remote_command(), returning the same result dict"""
+        tracer = get_tracer()
+        attempts = command_attempts(self.retries)
+        for attempt in range(1, attempts + 1):
+            start = time.time()
+            if log is not None:
+                log.note(f"$ {command} (attempt {attempt} of {attempts})")
+            try:
+                # Read as it comes instead of conn.run(), which would hold the whole output in memory
+                process = await conn.create_process(command, encoding=None)
+                process.stdin.write_eof()
+                stdout_tail, stderr_tail = TailBuffer(), TailBuffer()
+                await asyncio.gather(self._stream(process.stdout, stdout_tail, log),
+                                     self._stream(process.stderr, stderr_tail, log))
+                await process.wait()
+                exit_code = process.exit_status
+                stdout_output, stderr_output = stdout_tail.text(), stderr_tail.text()
+            except Exception as e:
+                exit_code, stdout_output, stderr_output = None, '', str(e)
+            end = time.time()
+            if log is not None:
+                log.note(f"exit code {exit_code}" + (f": {stderr_output}" if exit_code is None else ''))
+            tracer.add_span(command, 'command', start, end, host=host, attempt=attempt)
+            result = command_result(command, exit_code, stdout_output, stderr_output, attempt, end - start)
+            delay = retry_delay(result, attempts, self.backoff, self.backoff_factor, host)
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
+
+    async def _install(self, asyncssh, client_keys, ip, private_ip, instance_id, commands, background_command,
+                       results_file):
+        with results_file.phase(instance_id, 'ssh_connect'):
+            conn = await self._connect(asyncssh, client_keys, ip)
+        if conn is None:
+            results_file.error(instance_id, f"Could not connect to {ip} over SSH")
+            return ip, private_ip, False, []
+        results = []
+        log = HostLog(self.log_dir, ip, self.tail_lines)
+        try:
+            async with conn:
+                print(f"Connected to {ip}. Executing commands...")
+                if self.readiness == 'port_scan':
+                    with results_file.phase(instance_id, 'cloud_init_wait'):
+                        await conn.run(CLOUD_INIT_WAIT, check=False)
+                with results_file.phase(instance_id, 'install'):
+                    for command in commands:
+                        result = await self.run_command(conn, command, ip, log)
+                        results.append(result)
+                        print(f"{ip}: {format_result(result)}")
+                        if not result['ok']:
+                            print(f"Error executing command on {ip}, exit code {result['exit_code']}")
+                            log.print_tail()
+                            results_file.error(instance_id, f"{format_result(result)}: {result['stderr']}")
+                            return ip, private_ip, False, results
+                if background_command:
+                    # Detached from the session, so it keeps running after we disconnect
+                    await conn.run(detached_command(background_command), check=False)
+        finally:
+            log.close()
+        print(f"Installation completed on {ip}, output in {log.path}")
+        return ip, private_ip, True, results
@@ -0,0 +1,132 @@
+import random
+import threading
+
+from pipeline_lib.rate_limit import TokenBucket
+
+# Process wide AWS request budget with adaptive backoff.
+# Nothing used to handle RequestLimitExceeded / Throttling: the pollers slept fixed intervals and every host thread
+# called EC2 on its own, so a big fleet could fail halfway through on throttling errors. Now every client the
+# PipelineContext creates is hooked into one AwsRequestBudget:
+#   - before-send: each HTTP request (retries included) takes a token from the bucket of its service/operation, so
+#     all the threads of the process share one request rate per operation (aws_request_rate per second, default 20,
+#     with bursts of twice that)
+#   - needs-retry (registered first, ahead of botocore's own retry handler): on a throttling error the bucket of that
+#     operation halves its rate (down to 1 per second) and the request is retried after an exponential backoff with
+#     full jitter. Every successful request gives the rate back a little, up to aws_request_rate again.
+# The clients also use botocore's standard retry mode for the other retryable errors.
+
+DEFAULT_REQUEST_RATE = 20
+MIN_REQUEST_RATE = 1
+MAX_THROTTLE_RETRIES = 8
+
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20
+
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'TooManyRequestsException',
+    'PriorRequestNotComplete',
+    'SlowDown',
+    'EC2ThrottledException',
+}
+
+
+def jittered_backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Exponential backoff with full jitter: a random delay between 0 and min(cap, base * 2 ** attempt)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def polling_delay(attempt, base=5, cap=60):
+    """Delay before poll number attempt of a status loop: exponential with "equal jitter", i.e. at least half of
+    min(cap, base * 2 ** attempt), so many pollers spread out but none of them polls in a tight loop"""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _error_code(response):
+    if not response:
+        return None
+    parsed = response[1]
+    return parsed.get('Error', {}).get('Code') if isinstance(parsed, dict) else None
+
+
+class AwsRequestBudget:
+    """Token bucket per service/operation shared by all the clients it is attached to"""
+
+    def __init__(self, request_rate=DEFAULT_REQUEST_RATE):
+        self.request_rate = float(request_rate)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.throttled = 0
+
+    def bucket(self, service, operation):
+        key = (service, operation)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.request_rate, burst=2 * self.request_rate)
+            return self._buckets[key]
+
+    def attach(self, client):
+        """Hook the budget into a boto3 client"""
+        # The event names use the hyphenized service ID, e.g. before-send.elastic-load-balancing-v2.CreateListener
+        service = client.meta.service_model.service_id.hyphenize()
+        events = client.meta.events
+        events.register(f'before-send.{service}', self._before_send)
+        events.register_first(f'needs-retry.{service}', self._needs_retry)
+        events.register(f'after-call.{service}', self._after_call)
+        return client
+
+    def _operation(self, event_name):
+        # e.g. before-send.ec2.DescribeInstances
+        parts = event_name.split('.')
+        return parts[1], parts[2] if len(parts) > 2 else '*'
+
+    def _before_send(self, event_name=None, **kwargs):
+        service, operation = self._operation(event_name)
+        self.bucket(service, operation).acquire()
+        # Returning None lets botocore send the request
+
+    def _needs_retry(self, response=None, attempts=None, operation=None, event_name=None, **kwargs):
+        code = _error_code(response)
+        if code not in THROTTLING_ERROR_CODES:
+            # Not throttling: botocore's standard retry handler decides
+            return None
+        service = event_name.split('.')[1]
+        bucket = self.bucket(service, operation.name)
+        bucket.set_rate(max(MIN_REQUEST_RATE, bucket.rate / 2))
+        with self._lock:
+            self.throttled += 1
+        if attempts >= MAX_THROTTLE_RETRIES:
+            print(f"AWS {service} {operation.name} still throttled after {attempts} attempts")
+            return None
+        delay = jittered_backoff(attempts)
+        print(f"AWS {service} {operation.name} throttled ({code}), retrying in {delay:.1f} seconds "
+              f"at {bucket.rate:.1f} requests per second")
+        return delay
+
+    def _after_call(self, event_name=None, http_response=None, **kwargs):
+        # Additive increase after a successful call, back up to the configured rate
+        if http_response is None or http_response.status_code >= 400:
+            return
+        service, operation = self._operation(event_name)
+        bucket = self.bucket(service, operation)
+        if bucket.rate < self.request_rate:
+            bucket.set_rate(min(self.request_rate, bucket.rate + 0.5))
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_request_budget(request_rate=DEFAULT_REQUEST_RATE):
+    """The request budget of this process, shared by all its clients"""
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = AwsRequestBudget(request_rate)
+        return _budget
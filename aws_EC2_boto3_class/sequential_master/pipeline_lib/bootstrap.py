@@ -0,0 +1,188 @@
+import time
+
+from pipeline_lib.remote_exec import READ_SIZE, TailBuffer, command_result
+from pipeline_lib.tracing import get_tracer
+
+# Single round trip provisioning (install_mode=bootstrap in the .env).
+# Instead of one exec_command per install command, followed by a sleep, the whole command list is rendered into one
+# bash bootstrap script, uploaded once over the SFTP channel of the SSH connection that is already open, and run with
+# a single exec. The script echoes a marker line before and after each command, on stdout and on stderr, so we still
+# get a per-command status (exit code, attempts, duration, output) as the script runs:
+#
+#   ##PIPELINE_STEP <index> start
+#   ##PIPELINE_STEP <index> end <exit code> <attempts>
+#
+# A failed command is retried inside the script with the same doubling backoff as remote_exec.py, and the script
+# stops at the first command that still fails. The results have the same shape as run_remote_commands(). With a
+# HostLog the script's output is streamed into the host's log, markers included, and only a tail per command is kept.
+
+MARKER = '##PIPELINE_STEP'
+
+REMOTE_SCRIPT_PATH = '/tmp/pipeline_bootstrap.sh'
+
+
+def render_bootstrap_script(commands, retries=3, backoff=10, backoff_factor=2, remove_when_done=True):
+    """The bootstrap script for commands, as a string"""
+    delays = ' '.join(str(backoff * backoff_factor ** attempt) for attempt in range(max(retries - 1, 1)))
+    lines = [
+        '#!/bin/bash',
+        '# Generated by the pipeline (pipeline_lib/bootstrap.py)',
+    ]
+    if remove_when_done:
+        lines.append('trap \'rm -f "$0"\' EXIT')
+    lines.append(f'delays=({delays})')
+    for index, command in enumerate(commands):
+        lines += [
+            '',
+            f'echo "{MARKER} {index} start"; echo "{MARKER} {index} start" >&2',
+            'attempt=1',
+            'while true; do',
+            f'    {command}',
+            '    rc=$?',
+            f'    if [ $rc -eq 0 ] || [ $attempt -ge {retries} ]; then break; fi',
+            '    sleep ${delays[$((attempt - 1))]}',
+            '    attempt=$((attempt + 1))',
+            'done',
+            f'echo "{MARKER} {index} end $rc $attempt"; echo "{MARKER} {index} end $rc $attempt" >&2',
+            '[ $rc -eq 0 ] || exit $rc',
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def upload_bootstrap_script(ssh, script, remote_path=REMOTE_SCRIPT_PATH):
+    """Write the script to remote_path over SFTP"""
+    sftp = ssh.open_sftp()
+    try:
+        with sftp.open(remote_path, 'w') as f:
+            f.write(script)
+        sftp.chmod(remote_path, 0o755)
+    finally:
+        sftp.close()
+
+
+def parse_marker(line):
+    """(index, 'start'|'end', exit_code, attempts) for a marker line, None for any other line"""
+    if not line.startswith(MARKER + ' '):
+        return None
+    fields = line.split()
+    index, event = int(fields[1]), fields[2]
+    if event == 'end':
+        return index, event, int(fields[3]), int(fields[4])
+    return index, event, None, None
+
+
+class _StreamSplitter:
+    """Splits one output stream of the script into the output of each command"""
+
+    def __init__(self):
+        self.partial = b''
+        self.current = None
+        # The last OUTPUT_TAIL_BYTES of each command's output
+        self.output = {}
+
+    def feed(self, data):
+        """Add data, returning the complete marker lines seen in it"""
+        self.partial += data
+        *lines, self.partial = self.partial.split(b'\n')
+        markers = []
+        for raw_line in lines:
+            line = raw_line.decode('utf-8', errors='replace')
+            marker = parse_marker(line)
+            if marker is None:
+                # Output before the first marker (e.g. bash errors) is kept under None
+                self.output.setdefault(self.current, TailBuffer()).feed(raw_line + b'\n')
+                continue
+            index, event = marker[0], marker[1]
+            self.current = index if event == 'start' else None
+            markers.append(marker)
+        return markers
+
+    def text(self, index):
+        return self.output[index].text().rstrip('\n') if index in self.output else ''
+
+
+def run_bootstrap(ssh, commands, retries=3, backoff=10, backoff_factor=2, timeout=None, host=None,
+                  remote_path=REMOTE_SCRIPT_PATH, log=None):
+    """Upload and run the bootstrap script for commands over ssh. Returns one result dict per command run.
+    With log (a HostLog) the whole output goes to the host's log."""
+    tracer = get_tracer()
+    if log is not None:
+        log.note(f"$ bash {remote_path} ({len(commands)} commands)")
+    try:
+        with tracer.span('bootstrap_upload', host=host):
+            script = render_bootstrap_script(commands, retries, backoff, backoff_factor)
+            upload_bootstrap_script(ssh, script, remote_path)
+        stdin, stdout, stderr = ssh.exec_command(f'bash {remote_path}')
+        stdin.close()
+    except Exception as e:
+        # SFTP or SSH level failure: nothing ran
+        if log is not None:
+            log.note(f"could not start the bootstrap script: {e}")
+        return [_failed_to_start(commands, None, str(e))]
+    channel = stdout.channel
+    out, err = _StreamSplitter(), _StreamSplitter()
+    started = {}
+    finished = {}
+    deadline = time.monotonic() + timeout if timeout else None
+
+    # Read both streams as they arrive. The stdout markers give the per command timing and status.
+    while True:
+        read_something = False
+        if channel.recv_ready():
+            chunk = channel.recv(READ_SIZE)
+            if log is not None:
+                log.write(chunk)
+            for index, event, exit_code, attempts in out.feed(chunk):
+                now = time.time()
+                if event == 'start':
+                    started[index] = now
+                else:
+                    finished[index] = (exit_code, attempts, now)
+                    tracer.add_span(commands[index], 'command', started.get(index, now), now, host=host,
+                                    attempt=attempts)
+                    print(f"{host}: {commands[index]}: "
+                          f"{'ok' if exit_code == 0 else f'failed (exit code {exit_code})'}")
+            read_something = True
+        if channel.recv_stderr_ready():
+            chunk = channel.recv_stderr(READ_SIZE)
+            if log is not None:
+                log.write(chunk)
+            err.feed(chunk)
+            read_something = True
+        if not read_something:
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                channel.close()
+                break
+            time.sleep(0.05)
+    script_exit_code = channel.recv_exit_status() if channel.exit_status_ready() else None
+    if log is not None:
+        log.note(f"exit code {script_exit_code}")
+
+    results = []
+    for index, command in enumerate(commands):
+        if index not in started:
+            break
+        if index in finished:
+            exit_code, attempts, end = finished[index]
+        else:
+            # The script died (or timed out) in the middle of this command
+            exit_code, attempts, end = script_exit_code or None, None, time.time()
+        results.append(command_result(command, exit_code, out.text(index), err.text(index), attempts,
+                                      end - started[index]))
+        if exit_code != 0:
+            break
+
+    if not results:
+        # The script never got to its first command
+        results.append(_failed_to_start(commands, script_exit_code, err.text(None)))
+    return results
+
+
+def _failed_to_start(commands, exit_code, error):
+    return {
+        'command': commands[0] if commands else '', 'exit_code': exit_code, 'ok': False, 'attempts': 0,
+        'duration': 0, 'stdout': '', 'stderr': error, 'truncated': False,
+    }
+
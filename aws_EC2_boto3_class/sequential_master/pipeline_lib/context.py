@@ -0,0 +1,129 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+from dotenv import load_dotenv
+
+from pipeline_lib.aws_rate_limit import DEFAULT_REQUEST_RATE, get_request_budget
+from pipeline_lib.instance_status import InstanceStatusPoller
+from pipeline_lib.readiness_receiver import ReadinessReceiver
+from pipeline_lib.run_state import RUN_STATE_FILE, RunState
+from pipeline_lib.ssh_pool import SSHConnectionPool
+from pipeline_lib.tags import stack_name
+
+# Shared context for the pipeline steps.
+# Each numbered step script exposes main(ctx=None). When the master runner runs the steps in-process it hands every
+# step the same PipelineContext, so the .env is parsed once, there is a single boto3 Session and each service client
+# (and its botocore service model) is only created once for the whole run. When a step script is run on its own
+# with python3, main() builds its own context from the environment, same as before.
+
+# The clients used by the pipeline (see boto3_class_list/class_list)
+CLIENT_NAMES = ('ec2', 'elbv2', 'acm', 'route53', 'autoscaling', 'service-quotas')
+
+
+class PipelineContext:
+    """One boto3 Session plus lazily created, cached service clients"""
+
+    def __init__(self, aws_access_key=None, aws_secret_key=None, region_name=None):
+        self.aws_access_key = aws_access_key
+        self.aws_secret_key = aws_secret_key
+        self.region_name = region_name
+        self._session = None
+        self._clients = {}
+        self._state = None
+        self._status_poller = None
+        self._readiness_receiver = None
+        self._ssh_pool = None
+        # Creating clients from one Session is not thread safe (the clients themselves are)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Build a context from the .env file / environment variables set by the gitlab pipeline"""
+        load_dotenv()
+        return cls(
+            aws_access_key=os.getenv("AWS_ACCESS_KEY_ID"),
+            aws_secret_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+            region_name=os.getenv("region_name"),
+        )
+
+    def setting(self, name, default=None):
+        """Read a pipeline setting (image_id, instance_type, min_count, ...) from the environment"""
+        return os.getenv(name, default)
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                self._session = boto3.Session(
+                    aws_access_key_id=self.aws_access_key,
+                    aws_secret_access_key=self.aws_secret_key,
+                    region_name=self.region_name
+                )
+            return self._session
+
+    def client(self, service_name):
+        """Return the cached client for service_name, creating it on first use"""
+        session = self.session
+        with self._lock:
+            if service_name not in self._clients:
+                # Every client shares the process wide AWS request budget and throttling backoff
+                # (see aws_rate_limit.py), on top of botocore's standard retry mode
+                client = session.client(service_name, config=Config(
+                    retries={'mode': 'standard', 'max_attempts': int(self.setting('aws_max_attempts', 5))}
+                ))
+                budget = get_request_budget(float(self.setting('aws_request_rate', DEFAULT_REQUEST_RATE)))
+                self._clients[service_name] = budget.attach(client)
+            return self._clients[service_name]
+
+    @property
+    def state(self):
+        """The persistent run state (checkpoints and step outputs), see run_state.py"""
+        if self._state is None:
+            self._state = RunState(self.setting('run_state_file', RUN_STATE_FILE))
+        return self._state
+
+    @property
+    def status_poller(self):
+        """The shared, batched instance status check poller, see instance_status.py"""
+        ec2_client = self.client('ec2')
+        with self._lock:
+            if self._status_poller is None:
+                self._status_poller = InstanceStatusPoller(
+                    ec2_client,
+                    interval=int(self.setting('status_poll_interval', 10))
+                )
+            return self._status_poller
+
+    @property
+    def readiness_receiver(self):
+        """The readiness callback receiver (started on first use), None without readiness_callback_url.
+        See readiness_receiver.py."""
+        if not self.setting('readiness_callback_url'):
+            return None
+        status_poller = self.status_poller
+        with self._lock:
+            if self._readiness_receiver is None:
+                self._readiness_receiver = ReadinessReceiver.from_settings(
+                    self, stack_name(self), fallback=status_poller
+                ).start()
+            return self._readiness_receiver
+
+    @property
+    def ssh_pool(self):
+        """The SSH connection pool shared by the steps, see ssh_pool.py"""
+        with self._lock:
+            if self._ssh_pool is None:
+                self._ssh_pool = SSHConnectionPool.from_settings(self)
+            return self._ssh_pool
+
+    def close(self):
+        """Close the pooled SSH connections and stop the readiness receiver at the end of the pipeline"""
+        with self._lock:
+            ssh_pool, receiver = self._ssh_pool, self._readiness_receiver
+            self._ssh_pool = self._readiness_receiver = None
+        if ssh_pool is not None:
+            ssh_pool.close_all()
+        if receiver is not None:
+            receiver.stop()
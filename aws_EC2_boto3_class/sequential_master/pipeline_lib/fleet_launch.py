@@ -0,0 +1,160 @@
+import base64
+import time
+
+from botocore.exceptions import ClientError
+
+from pipeline_lib.aws_rate_limit import polling_delay
+from pipeline_lib.launch_planner import CLIENT_TOKEN_LENGTH, LaunchPlanError
+from pipeline_lib.tracing import get_tracer
+
+# EC2 Fleet launch (launch_mode=fleet in the .env).
+# Instead of run_instances with one instance type, the fleet is launched from a launch template with create_fleet
+# (type instant, so the call returns the instance IDs right away like run_instances does):
+#   - the launch template (<stack_name>-tomcat) holds the image, key pair and user-data. A new version is created when
+#     the image_id / key pair / user-data changed, otherwise the latest version is reused
+#   - fleet_instance_types (comma separated, default instance_type) x the subnets of stack_config.py are the
+#     overrides, so EC2 can pick whichever type/AZ has capacity
+#   - with fleet_spot=1 the fleet asks for Spot capacity first (price-capacity-optimized) and launches whatever Spot
+#     could not cover as On-Demand in a second call
+# The instances are then described, so the caller gets the same run_instances style instances (and inventory) as
+# with the other launch modes.
+# The ClientToken of each create_fleet call is made from the run_id, the template version and the capacity, so a rerun
+# of the step with the same request gets the same fleet back instead of a second one, and a rerun with a different
+# request (new template version, other count) is not rejected with IdempotentParameterMismatch.
+
+LAUNCH_TEMPLATE_SUFFIX = '-tomcat'
+
+# create_fleet allows up to 300 launch template overrides
+MAX_OVERRIDES = 300
+
+# The new instance IDs are eventually consistent, describe_instances can miss them right after the launch
+DESCRIBE_ATTEMPTS = 5
+DESCRIBE_BATCH = 1000
+
+
+def ensure_launch_template(my_ec2, name, image_id, key_name, user_data=None):
+    """Create the launch template, or a new version of it if the data changed. Returns (template_id, version)."""
+    data = {'ImageId': image_id, 'KeyName': key_name}
+    if user_data:
+        # Unlike run_instances, launch templates take the user-data base64 encoded
+        data['UserData'] = base64.b64encode(user_data.encode()).decode()
+    try:
+        response = my_ec2.create_launch_template(LaunchTemplateName=name, LaunchTemplateData=data)
+        template = response['LaunchTemplate']
+        print(f"Created launch template {name} ({template['LaunchTemplateId']})")
+        return template['LaunchTemplateId'], str(template['LatestVersionNumber'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidLaunchTemplateName.AlreadyExistsException':
+            raise
+    latest = my_ec2.describe_launch_template_versions(LaunchTemplateName=name, Versions=['$Latest'])
+    latest = latest['LaunchTemplateVersions'][0]
+    if all(latest['LaunchTemplateData'].get(key) == data.get(key) for key in ('ImageId', 'KeyName', 'UserData')):
+        print(f"Reusing version {latest['VersionNumber']} of launch template {name}")
+        return latest['LaunchTemplateId'], str(latest['VersionNumber'])
+    response = my_ec2.create_launch_template_version(LaunchTemplateName=name, LaunchTemplateData=data)
+    version = response['LaunchTemplateVersion']
+    print(f"Created version {version['VersionNumber']} of launch template {name}")
+    return version['LaunchTemplateId'], str(version['VersionNumber'])
+
+
+def fleet_overrides(instance_types, subnet_ids):
+    """One override per instance type and subnet"""
+    overrides = [
+        {'InstanceType': instance_type, 'SubnetId': subnet_id}
+        for instance_type in instance_types
+        for subnet_id in subnet_ids
+    ]
+    return overrides[:MAX_OVERRIDES]
+
+
+def fleet_client_token(run_id, capacity_type, version, count):
+    return f"{run_id}-fleet-{capacity_type}-v{version}-n{count}"[:CLIENT_TOKEN_LENGTH]
+
+
+def create_instant_fleet(my_ec2, template_id, version, overrides, count, capacity_type, client_token,
+                         tag_specifications=None):
+    """One create_fleet call of type instant. Returns (instance_ids, errors)."""
+    request = {
+        'Type': 'instant',
+        'ClientToken': client_token,
+        'LaunchTemplateConfigs': [{
+            'LaunchTemplateSpecification': {'LaunchTemplateId': template_id, 'Version': version},
+            'Overrides': overrides,
+        }],
+        'TargetCapacitySpecification': {
+            'TotalTargetCapacity': count,
+            'DefaultTargetCapacityType': capacity_type,
+        },
+    }
+    if capacity_type == 'spot':
+        request['SpotOptions'] = {'AllocationStrategy': 'price-capacity-optimized'}
+    else:
+        request['OnDemandOptions'] = {'AllocationStrategy': 'lowest-price'}
+    if tag_specifications:
+        request['TagSpecifications'] = tag_specifications
+    with get_tracer().span('create_fleet', count=count, capacity=capacity_type):
+        response = my_ec2.create_fleet(**request)
+    instance_ids = [
+        instance_id for launched in response.get('Instances', []) for instance_id in launched['InstanceIds']
+    ]
+    errors = response.get('Errors', [])
+    for error in errors:
+        overrides_used = error.get('LaunchTemplateAndOverrides', {}).get('Overrides', {})
+        print(f"create_fleet {capacity_type} error for {overrides_used.get('InstanceType')} in "
+              f"{overrides_used.get('SubnetId')}: {error.get('ErrorCode')} {error.get('ErrorMessage')}")
+    print(f"create_fleet launched {len(instance_ids)} of {count} {capacity_type} instances")
+    return instance_ids, errors
+
+
+def describe_new_instances(my_ec2, instance_ids):
+    """The describe_instances entries of instances that were just launched"""
+    instances = []
+    for start in range(0, len(instance_ids), DESCRIBE_BATCH):
+        batch = instance_ids[start:start + DESCRIBE_BATCH]
+        for attempt in range(DESCRIBE_ATTEMPTS):
+            try:
+                response = my_ec2.describe_instances(InstanceIds=batch)
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound' or attempt == DESCRIBE_ATTEMPTS - 1:
+                    raise
+                time.sleep(polling_delay(attempt, base=1, cap=10))
+        for reservation in response['Reservations']:
+            instances.extend(reservation['Instances'])
+    return instances
+
+
+def launch_fleet(my_ec2, template_name, subnet_ids, image_id, instance_types, key_name, min_count, max_count, run_id,
+                 user_data=None, tag_specifications=None, spot=False):
+    """Launch between min_count and max_count instances with create_fleet. Returns the instances."""
+    template_id, version = ensure_launch_template(my_ec2, template_name, image_id, key_name, user_data)
+    overrides = fleet_overrides(instance_types, subnet_ids)
+
+    instance_ids = []
+    try:
+        if spot:
+            spot_ids, _ = create_instant_fleet(
+                my_ec2, template_id, version, overrides, max_count, 'spot',
+                fleet_client_token(run_id, 'spot', version, max_count),
+                tag_specifications
+            )
+            instance_ids.extend(spot_ids)
+        shortfall = max_count - len(instance_ids)
+        if shortfall > 0:
+            if spot:
+                print(f"Spot capacity short by {shortfall} instances, launching them On-Demand")
+            on_demand_ids, _ = create_instant_fleet(
+                my_ec2, template_id, version, overrides, shortfall, 'on-demand',
+                fleet_client_token(run_id, 'on-demand', version, shortfall),
+                tag_specifications
+            )
+            instance_ids.extend(on_demand_ids)
+    except ClientError as e:
+        raise LaunchPlanError(f"Error launching the fleet: {e}", describe_new_instances(my_ec2, instance_ids))
+
+    instances = describe_new_instances(my_ec2, instance_ids)
+    if len(instances) < min_count:
+        raise LaunchPlanError(
+            f"Only {len(instances)} of the minimum {min_count} instances could be launched", instances
+        )
+    return instances
@@ -0,0 +1,145 @@
+import json
+import os
+import time
+
+from pipeline_lib.install_manifest import manifest_hash
+from pipeline_lib.remote_exec import format_result, run_remote_commands
+from pipeline_lib.security_groups import reconcile_ingress
+from pipeline_lib.tracing import get_tracer
+
+# Bake-once golden AMI (provision_mode=golden_ami in the .env).
+# Every run used to install tomcat9 over SSH on all 50 instances from scratch: 50 apt updates against the public
+# mirrors, the slowest part of the pipeline. In this mode script 5 first looks up an AMI in the golden AMI cache
+# under the hash of the install commands and the base image_id. If there is none, it launches one builder instance,
+# runs the install commands on it, creates an AMI from it, terminates the builder and saves the AMI ID in the cache.
+# The fleet is then launched from the golden AMI and script 6 only checks that Tomcat answers on every host.
+#
+# The cache is a JSON file (golden_ami_cache.json, or golden_ami_cache_file in the .env). Mount it on a volume to
+# keep it across docker runs. Changing the commands in install_manifest.py or the image_id bakes a new AMI.
+
+GOLDEN_AMI_CACHE_FILE = 'golden_ami_cache.json'
+
+# How long to wait for the builder's status checks and for the AMI to become available
+BUILDER_READY_TIMEOUT = 900
+IMAGE_AVAILABLE_TIMEOUT = 1800
+
+# SSH connection attempts on the builder (10 seconds apart with the pool's default retry delay)
+BUILDER_CONNECT_ATTEMPTS = 10
+
+
+def load_cache(path=GOLDEN_AMI_CACHE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_cache(cache, path=GOLDEN_AMI_CACHE_FILE):
+    # Write to a temporary file and rename it over the old one, so a crash can't leave a half written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def cached_golden_ami(my_ec2, key, cache_file=GOLDEN_AMI_CACHE_FILE):
+    """The cached AMI ID for key, if the AMI still exists and is available"""
+    entry = load_cache(cache_file).get(key)
+    if not entry:
+        return None
+    try:
+        images = my_ec2.describe_images(ImageIds=[entry['image_id']])['Images']
+    except my_ec2.exceptions.ClientError as e:
+        # e.g. InvalidAMIID.NotFound after the AMI was deregistered
+        print(f"Cached golden AMI {entry['image_id']} is not usable: {e}")
+        return None
+    if not images or images[0]['State'] != 'available':
+        print(f"Cached golden AMI {entry['image_id']} is not available")
+        return None
+    return entry['image_id']
+
+
+def bake_golden_ami(ctx, commands, image_id, instance_type, key_name, key):
+    """Launch a builder from image_id, run commands on it and create an AMI. Returns the new AMI ID."""
+    my_ec2 = ctx.client('ec2')
+    tracer = get_tracer()
+    tags = [{'Key': 'Name', 'Value': 'golden-ami-builder'}, {'Key': 'pipeline:manifest', 'Value': key}]
+
+    with tracer.span('golden_ami_launch_builder'):
+        response = my_ec2.run_instances(
+            ImageId=image_id,
+            InstanceType=instance_type,
+            KeyName=key_name,
+            MinCount=1,
+            MaxCount=1,
+            TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}]
+        )
+    builder_id = response['Instances'][0]['InstanceId']
+    print(f"Launched golden AMI builder {builder_id} from {image_id}")
+
+    try:
+        with tracer.span('golden_ami_wait_for_builder'):
+            if not ctx.status_poller.wait(builder_id, BUILDER_READY_TIMEOUT):
+                raise RuntimeError(f"Golden AMI builder {builder_id} did not pass its status checks")
+        builder = my_ec2.describe_instances(InstanceIds=[builder_id])['Reservations'][0]['Instances'][0]
+        ip = builder['PublicIpAddress']
+
+        # The builder's security groups need port 22 open for the install
+        reconcile_ingress(my_ec2, [sg['GroupId'] for sg in builder['SecurityGroups']], [22])
+
+        # Through the shared SSH pool (ssh_key_path, key parsed once, see ssh_pool.py). Its retries also cover the
+        # banner/authentication errors of a builder that is still booting.
+        with tracer.span('golden_ami_install', host=ip):
+            ssh = ctx.ssh_pool.connect(ip, attempts=BUILDER_CONNECT_ATTEMPTS)
+            if ssh is None:
+                raise RuntimeError(f"Failed to connect to the golden AMI builder {ip} after multiple attempts")
+            try:
+                results = run_remote_commands(ssh, commands, host=ip)
+            finally:
+                ctx.ssh_pool.discard(ip)
+        for result in results:
+            print(f"{ip}: {format_result(result)}")
+        if not results[-1]['ok']:
+            raise RuntimeError(f"Golden AMI install failed on the builder: {results[-1]['stderr']}")
+
+        with tracer.span('golden_ami_create_image'):
+            image = my_ec2.create_image(
+                InstanceId=builder_id,
+                Name=f"tomcat-golden-{key[:16]}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}",
+                Description='Tomcat golden AMI baked by the pipeline',
+                TagSpecifications=[{'ResourceType': 'image', 'Tags': tags[1:]}]
+            )
+            golden_ami_id = image['ImageId']
+            print(f"Creating golden AMI {golden_ami_id}...")
+            my_ec2.get_waiter('image_available').wait(
+                ImageIds=[golden_ami_id],
+                WaiterConfig={'Delay': 15, 'MaxAttempts': IMAGE_AVAILABLE_TIMEOUT // 15}
+            )
+        print(f"Golden AMI {golden_ami_id} is available")
+        return golden_ami_id
+    finally:
+        my_ec2.terminate_instances(InstanceIds=[builder_id])
+        print(f"Terminated golden AMI builder {builder_id}")
+
+
+def resolve_golden_ami(ctx, commands, image_id, instance_type, key_name):
+    """The golden AMI for commands on top of image_id: from the cache, or baked now and cached"""
+    my_ec2 = ctx.client('ec2')
+    cache_file = ctx.setting('golden_ami_cache_file', GOLDEN_AMI_CACHE_FILE)
+    key = manifest_hash(commands, image_id)
+    golden_ami_id = cached_golden_ami(my_ec2, key, cache_file)
+    if golden_ami_id:
+        print(f"Using cached golden AMI {golden_ami_id} for install manifest {key[:16]}")
+        return golden_ami_id
+
+    print(f"No golden AMI for install manifest {key[:16]}, baking one")
+    golden_ami_id = bake_golden_ami(ctx, commands, image_id, instance_type, key_name, key)
+    cache = load_cache(cache_file)
+    cache[key] = {
+        'image_id': golden_ami_id,
+        'base_image_id': image_id,
+        'commands': list(commands),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+    }
+    save_cache(cache, cache_file)
+    return golden_ami_id
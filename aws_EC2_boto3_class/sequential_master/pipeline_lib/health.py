@@ -0,0 +1,31 @@
+import time
+import urllib.error
+import urllib.request
+
+from pipeline_lib.install_manifest import TOMCAT_PORT
+
+# Quick Tomcat health verification from the controller, used when the instances come up with Tomcat already on them
+# (golden AMI) instead of being installed over SSH: an HTTP GET on port 8080 of each host.
+
+
+def tomcat_responding(ip, port=TOMCAT_PORT, timeout=5):
+    """True if Tomcat answers an HTTP GET on ip:port"""
+    try:
+        with urllib.request.urlopen(f"http://{ip}:{port}/", timeout=timeout) as response:
+            return response.status < 500
+    except urllib.error.HTTPError as e:
+        # A 404 still means Tomcat is up
+        return e.code < 500
+    except OSError:
+        return False
+
+
+def wait_for_tomcat(ip, timeout=300, interval=5, port=TOMCAT_PORT):
+    """Poll tomcat_responding until it is True or timeout seconds have passed"""
+    deadline = time.monotonic() + timeout
+    while True:
+        if tomcat_responding(ip, port):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
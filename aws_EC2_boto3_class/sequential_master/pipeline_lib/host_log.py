@@ -0,0 +1,76 @@
+import gzip
+import os
+import threading
+import time
+from collections import deque
+
+# Per-host remote output logs (host_log_dir in the .env, default host_logs).
+# install_tomcat() used to read the whole stdout/stderr of every apt command into memory and print it, and with 50+
+# hosts the GitLab console buffer overflowed and print statements got lost (see the comment in 9_wget_debug4.py).
+# Now the output of every command is streamed, chunk by chunk as it arrives, into a gzip compressed log per host
+# (<host_log_dir>/<host>.log.gz), and only a bounded tail of it is kept in memory. The console gets one summary line
+# per host per phase, and the last console_tail_lines lines of the log (default 20) when a host fails.
+#
+# Each run appends a new gzip member to the file, so zcat / zless show all the runs one after the other.
+
+DEFAULT_LOG_DIR = 'host_logs'
+DEFAULT_TAIL_LINES = 20
+
+# A line longer than this (e.g. a progress bar without newlines) is cut in the console tail, not in the log
+MAX_LINE_BYTES = 4096
+
+
+def _timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+
+
+class HostLog:
+    """gzip compressed log of everything a host printed, keeping the last lines for the console"""
+
+    def __init__(self, directory, host, tail_lines=DEFAULT_TAIL_LINES):
+        os.makedirs(directory, exist_ok=True)
+        self.host = host
+        self.path = os.path.join(directory, f"{host}.log.gz")
+        self.bytes_written = 0
+        self._file = gzip.open(self.path, 'ab')
+        self._lines = deque(maxlen=tail_lines)
+        self._partial = b''
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, ctx, host):
+        return cls(ctx.setting('host_log_dir', DEFAULT_LOG_DIR), host,
+                   int(ctx.setting('console_tail_lines', DEFAULT_TAIL_LINES)))
+
+    def write(self, data):
+        """Append a chunk of remote output (bytes or str)"""
+        if isinstance(data, str):
+            data = data.encode('utf-8', errors='replace')
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(data)
+            self.bytes_written += len(data)
+            *lines, partial = (self._partial + data).split(b'\n')
+            self._lines.extend(line[-MAX_LINE_BYTES:] for line in lines)
+            self._partial = partial[-MAX_LINE_BYTES:]
+
+    def note(self, text):
+        """A line of our own in the log (the command being run, its exit code, ...)"""
+        self.write(f"## {_timestamp()} {text}\n")
+
+    def tail(self):
+        """The last lines of the log, as text"""
+        with self._lock:
+            lines = list(self._lines) + ([self._partial] if self._partial else [])
+        return '\n'.join(line.decode('utf-8', errors='replace') for line in lines[-self._lines.maxlen:])
+
+    def print_tail(self):
+        print(f"Last lines of {self.path}:")
+        print(self.tail())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
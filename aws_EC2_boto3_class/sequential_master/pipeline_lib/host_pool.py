@@ -0,0 +1,68 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pipeline_lib.rate_limit import TokenBucket
+from pipeline_lib.tracing import get_tracer
+
+# Bounded worker pool for per-host work (Tomcat install, stress generator setup).
+# Script 6 used to create ThreadPoolExecutor(max_workers=len(public_ips)): fine for 50 hosts, but 1,000 hosts meant
+# 1,000 threads, 1,000 simultaneous SSH handshakes from one container and a burst of apt downloads against the
+# mirrors. The HostPool runs at most max_workers hosts at a time, takes the hosts from a FIFO queue in the order they
+# were given, and callers call before_connect() right before opening a connection so new connections are opened at
+# no more than connect_rate per second.
+#
+# Settings in the .env: ssh_max_workers (default 50) and ssh_connect_rate (new connections per second, default 10,
+# 0 = no limit). See benchmarks/host_pool_benchmark.py for the throughput at different settings.
+
+DEFAULT_MAX_WORKERS = 50
+DEFAULT_CONNECT_RATE = 10
+
+
+class HostPool:
+    """Run a function for many hosts with a concurrency cap, a FIFO queue and a connection rate limit"""
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, connect_rate=DEFAULT_CONNECT_RATE):
+        self.max_workers = max(1, int(max_workers))
+        self.connect_limiter = TokenBucket(connect_rate) if connect_rate else None
+
+    @classmethod
+    def from_settings(cls, ctx):
+        """A pool sized from the ssh_max_workers / ssh_connect_rate settings"""
+        return cls(
+            max_workers=int(ctx.setting('ssh_max_workers', DEFAULT_MAX_WORKERS)),
+            connect_rate=float(ctx.setting('ssh_connect_rate', DEFAULT_CONNECT_RATE)),
+        )
+
+    def before_connect(self):
+        """Call right before opening a connection: blocks as needed to stay under connect_rate"""
+        if self.connect_limiter is not None:
+            self.connect_limiter.acquire()
+
+    def run(self, func, work_items):
+        """Call func(*args) for every args tuple in work_items and yield the results as they complete.
+        work_items can also be a generator (e.g. hosts coming out of the port scanner): each item is submitted as
+        soon as it is produced."""
+        if isinstance(work_items, (list, tuple)):
+            if not work_items:
+                return
+            max_workers = min(self.max_workers, len(work_items))
+        else:
+            max_workers = self.max_workers
+        tracer = get_tracer()
+        # ThreadPoolExecutor hands queued work to free workers first in, first out
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='host') as executor:
+
+            def run_item(args, queued_at):
+                # Time spent waiting for a free worker shows up in the trace as queue_wait
+                tracer.add_span('queue_wait', 'host_pool', queued_at, time.time())
+                return func(*args)
+
+            futures = set()
+            for args in work_items:
+                futures.add(executor.submit(run_item, args, time.time()))
+                # Hand back what already finished while the next items are still being produced
+                for future in [future for future in futures if future.done()]:
+                    futures.discard(future)
+                    yield future.result()
+            for future in as_completed(futures):
+                yield future.result()
@@ -0,0 +1,70 @@
+from pipeline_lib.install_manifest import TOMCAT_PORT
+from pipeline_lib.remote_exec import run_remote_command
+
+# Remote state probe for idempotent installs (install_probe in the .env, default 1).
+# Rerunning script 6 used to run the full apt update / apt install tomcat9 on every host, even when Tomcat was already
+# installed and running. Before installing, script 6 now probes the hosts that are already up (status checks ok) in
+# parallel: one SSH exec per host reads the package status and version, systemctl is-active / is-enabled and whether
+# anything listens on port 8080. Only the hosts that differ from that state go through the install; the others are
+# done. The probe connection comes from the shared SSH pool, so a host that does need the install reuses it.
+#
+# The version is only reported: the install commands install whatever version apt has, so a different version is
+# not something the install would change. probe_connect_timeout (default 5 seconds) bounds the single connection
+# attempt; a host that can not be reached that quickly simply goes through the normal install path.
+
+TOMCAT_PACKAGE = 'tomcat9'
+DEFAULT_PROBE_CONNECT_TIMEOUT = 5
+
+# One round trip: key=value lines, empty values when something is missing
+PROBE_COMMAND = '; '.join([
+    f"printf 'package=%s\\n' \"$(dpkg-query -W -f='${{Status}}' {TOMCAT_PACKAGE} 2>/dev/null)\"",
+    f"printf 'version=%s\\n' \"$(dpkg-query -W -f='${{Version}}' {TOMCAT_PACKAGE} 2>/dev/null)\"",
+    f"printf 'active=%s\\n' \"$(systemctl is-active {TOMCAT_PACKAGE} 2>/dev/null)\"",
+    f"printf 'enabled=%s\\n' \"$(systemctl is-enabled {TOMCAT_PACKAGE} 2>/dev/null)\"",
+    f"printf 'listening=%s\\n' \"$(ss -Hltn 'sport = :{TOMCAT_PORT}' 2>/dev/null | wc -l)\"",
+])
+
+
+def parse_probe_output(stdout):
+    """The host state from the output of PROBE_COMMAND"""
+    values = {}
+    for line in stdout.splitlines():
+        key, _, value = line.partition('=')
+        values[key.strip()] = value.strip()
+    listening = values.get('listening', '0')
+    return {
+        'installed': values.get('package') == 'install ok installed',
+        'version': values.get('version') or None,
+        'active': values.get('active') or 'unknown',
+        'enabled': values.get('enabled') or 'unknown',
+        'listening': listening.isdigit() and int(listening) > 0,
+    }
+
+
+def state_differences(state):
+    """What differs from the state the install leaves a host in (an empty list if nothing does)"""
+    differences = []
+    if not state['installed']:
+        differences.append(f"{TOMCAT_PACKAGE} is not installed")
+    if state['active'] != 'active':
+        differences.append(f"{TOMCAT_PACKAGE} is {state['active']}")
+    if state['enabled'] != 'enabled':
+        differences.append(f"{TOMCAT_PACKAGE} is {state['enabled']} at boot")
+    if not state['listening']:
+        differences.append(f"nothing listens on port {TOMCAT_PORT}")
+    return differences
+
+
+def probe_host(ssh_pool, ip, before_connect=None, connect_timeout=DEFAULT_PROBE_CONNECT_TIMEOUT):
+    """Probe ip over a pooled connection (one connection attempt). Returns the state dict, or None if the host could
+    not be reached or the probe did not run."""
+    ssh = ssh_pool.connect(ip, before_connect, attempts=1, timeout=connect_timeout)
+    if ssh is None:
+        return None
+    result = run_remote_command(ssh, PROBE_COMMAND, retries=1, host=ip)
+    if result['exit_code'] is None:
+        ssh_pool.discard(ip)
+        return None
+    # Kept open (idle) for the install, if the host needs one
+    ssh_pool.release(ip)
+    return parse_probe_output(result['stdout'])
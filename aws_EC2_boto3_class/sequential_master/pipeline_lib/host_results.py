@@ -0,0 +1,161 @@
+import base64
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-host results of script 6 (host_results_file in the .env, default pipeline_host_results.json).
+# Script 6 used to print failed_ips at the end and forget them, and the only way to fix the 2 hosts out of 50 that
+# failed was to rerun the install on all 50. Now every host gets an entry with its instance ID, IPs, the phase it
+# reached, the error it stopped on, how long each phase took and how many times it has failed. The file is written
+# when script 6 finishes, and with install_rerun=failed the next run of script 6 only works on the hosts that failed
+# or have no entry yet (see replace_instance below for replace_failed_after).
+#
+# Layout of the file:
+# {
+#     "run_id": "20250408-004322-1a2b3c4d",
+#     "updated_at": "...",
+#     "hosts": {"i-0123...": {"instance_id": "i-0123...", "public_ip": "...", "private_ip": "...", "ok": false,
+#                             "phase": "install", "error": "...", "timings": {"install": 93.2}, "failures": 1,
+#                             "updated_at": "..."}, ...}
+# }
+# A new run_id (a fresh pipeline run) starts the file over. Script 6 exits with an error when any host failed, so the
+# master runner does not mark it complete: the next run of the pipeline resumes at script 6 with the same run_id,
+# and install_rerun=failed then finds the results of that run.
+
+HOST_RESULTS_FILE = 'pipeline_host_results.json'
+
+
+def _timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+
+
+class HostResults:
+    """The per-host results of a run, recorded by the install workers and saved to a JSON file"""
+
+    def __init__(self, path=HOST_RESULTS_FILE, run_id=None):
+        # With path None nothing is saved (e.g. install_tomcat called on its own)
+        self.path = path
+        self.run_id = run_id
+        self._hosts = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if run_id is None or data.get('run_id') == run_id:
+                self._hosts = data.get('hosts', {})
+
+    @classmethod
+    def from_settings(cls, ctx):
+        return cls(ctx.setting('host_results_file', HOST_RESULTS_FILE), ctx.state.run_id)
+
+    def start(self, instance_id, public_ip, private_ip):
+        """Start a new attempt on a host (the failure count is kept from the earlier attempts)"""
+        with self._lock:
+            failures = self._hosts.get(instance_id, {}).get('failures', 0)
+            self._hosts[instance_id] = {
+                'instance_id': instance_id,
+                'public_ip': public_ip,
+                'private_ip': private_ip,
+                'ok': None,
+                'phase': 'queued',
+                'error': None,
+                'timings': {},
+                'failures': failures,
+                'updated_at': _timestamp(),
+            }
+
+    @contextmanager
+    def phase(self, instance_id, name):
+        """Mark the phase the host is in and time it"""
+        start = time.monotonic()
+        self._update(instance_id, phase=name)
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry = self._hosts.get(instance_id)
+                if entry is not None:
+                    entry['timings'][name] = round(entry['timings'].get(name, 0) + time.monotonic() - start, 2)
+
+    def error(self, instance_id, error):
+        """The error the host stopped on (the phase is the one it was in)"""
+        self._update(instance_id, error=str(error)[-500:])
+
+    def finish(self, instance_id, ok):
+        with self._lock:
+            entry = self._hosts.get(instance_id)
+            if entry is None:
+                return
+            entry['ok'] = bool(ok)
+            if ok:
+                # e.g. a warm host that failed the Tomcat check and was then installed: the error is not current
+                entry['phase'] = 'done'
+                entry['error'] = None
+            else:
+                entry['failures'] += 1
+            entry['updated_at'] = _timestamp()
+
+    def _update(self, instance_id, **fields):
+        with self._lock:
+            entry = self._hosts.get(instance_id)
+            if entry is not None:
+                entry.update(fields, updated_at=_timestamp())
+
+    def forget(self, instance_id):
+        with self._lock:
+            self._hosts.pop(instance_id, None)
+
+    def succeeded(self, instance_ids):
+        """The instance_ids whose last attempt succeeded"""
+        with self._lock:
+            return [instance_id for instance_id in instance_ids if self._hosts.get(instance_id, {}).get('ok')]
+
+    def failed(self, min_failures=1):
+        """The instance_ids whose last attempt failed, and that have failed at least min_failures times"""
+        with self._lock:
+            return [instance_id for instance_id, entry in self._hosts.items()
+                    if entry.get('ok') is False and entry.get('failures', 0) >= min_failures]
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {'run_id': self.run_id, 'updated_at': _timestamp(), 'hosts': self._hosts}
+            # Write to a temporary file and rename it over the old one, like the run state
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=4)
+            os.replace(tmp_path, self.path)
+        print(f"Saved the results of {len(data['hosts'])} hosts to {self.path}")
+
+
+def replace_instance(my_ec2, instance_id, exclude_tags=()):
+    """Launch a fresh copy of instance_id (same AMI, type, key, subnet, security groups, user-data and tags, except
+    exclude_tags) and terminate the old one. Returns the new instance from the run_instances response."""
+    instance = my_ec2.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]
+    launch_options = {}
+    user_data = my_ec2.describe_instance_attribute(InstanceId=instance_id, Attribute='userData')
+    if user_data.get('UserData', {}).get('Value'):
+        # Comes back base64 encoded, and boto3 encodes the UserData of run_instances itself
+        launch_options['UserData'] = base64.b64decode(user_data['UserData']['Value']).decode('utf-8')
+    # aws:* tags (e.g. aws:ec2:fleet-id, aws:ec2launchtemplate:id on fleet instances) are reserved: run_instances
+    # rejects them
+    tags = [tag for tag in instance.get('Tags', [])
+            if tag['Key'] not in exclude_tags and not tag['Key'].startswith('aws:')]
+    if tags:
+        launch_options['TagSpecifications'] = [{'ResourceType': 'instance', 'Tags': tags}]
+    if instance.get('KeyName'):
+        launch_options['KeyName'] = instance['KeyName']
+    response = my_ec2.run_instances(
+        ImageId=instance['ImageId'],
+        InstanceType=instance['InstanceType'],
+        MinCount=1,
+        MaxCount=1,
+        SubnetId=instance['SubnetId'],
+        SecurityGroupIds=[sg['GroupId'] for sg in instance.get('SecurityGroups', [])],
+        **launch_options
+    )
+    my_ec2.terminate_instances(InstanceIds=[instance_id])
+    return response['Instances'][0]
@@ -0,0 +1,23 @@
+import hashlib
+import json
+
+# What gets installed on the Tomcat target instances.
+# Script 6 runs these commands over SSH, and the golden AMI mode (golden_ami.py) bakes them into an AMI. The golden
+# AMI cache is keyed by manifest_hash(), so changing the commands (or the base image_id) bakes a new AMI.
+
+# Commands to install Tomcat server
+TOMCAT_INSTALL_COMMANDS = [
+    'sudo DEBIAN_FRONTEND=noninteractive apt update -y',
+    'sudo DEBIAN_FRONTEND=noninteractive apt install -y tomcat9',
+    'sudo systemctl start tomcat9',
+    'sudo systemctl enable tomcat9'
+]
+
+# Port Tomcat listens on, for the health checks
+TOMCAT_PORT = 8080
+
+
+def manifest_hash(commands, image_id):
+    """sha256 of the command list and the base image ID"""
+    manifest = json.dumps({'image_id': image_id, 'commands': list(commands)}, sort_keys=True)
+    return hashlib.sha256(manifest.encode('utf-8')).hexdigest()
@@ -0,0 +1,190 @@
+import asyncio
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# Batched, fleet-wide EC2 status check poller.
+# Script 6 used to call describe_instance_status(InstanceIds=[instance_id]) from every host thread every 10 seconds,
+# i.e. 50 API calls per 10 seconds for 50 hosts, and EC2 throttling at 500. Here a single background thread polls
+# all the instances that workers are waiting on in batches of up to 100 IDs per call, and wakes each waiting worker
+# through an event as soon as its instance is running and has passed both status checks. The number of API calls per
+# interval is ceil(waiting instances / 100), so it stays roughly constant as the fleet grows.
+# An ID EC2 does not know (InvalidInstanceID.NotFound: just launched and not visible yet, or long gone) fails the
+# whole call, so it is left out of that round and the call is repeated for the rest of the batch.
+
+# describe_instance_status accepts at most 100 instance IDs per call
+MAX_IDS_PER_CALL = 100
+
+# The errors that name the bad instance IDs in their message
+INVALID_ID_ERRORS = ('InvalidInstanceID.NotFound', 'InvalidInstanceID.Malformed')
+
+
+def instance_passed_status_checks(status):
+    """True for a describe_instance_status entry that is running with both status checks ok"""
+    return (status['InstanceState']['Name'] == 'running' and
+            status['SystemStatus']['Status'] == 'ok' and
+            status['InstanceStatus']['Status'] == 'ok')
+
+
+def ready_instance_ids(ec2_client, instance_ids):
+    """The instance_ids that are running with both status checks ok right now (one poll_once round, no waiting)"""
+    poller = InstanceStatusPoller(ec2_client)
+    poller.track(instance_ids)
+    poller.poll_once()
+    return {instance_id for instance_id in instance_ids if poller.is_ready(instance_id)}
+
+
+def _describe_ready(ec2_client, instance_ids):
+    """The instance_ids (at most MAX_IDS_PER_CALL) that passed their status checks. IDs named in an
+    InvalidInstanceID error are left out and the call is repeated for the others."""
+    instance_ids = list(instance_ids)
+    while instance_ids:
+        try:
+            ready = []
+            paginator = ec2_client.get_paginator('describe_instance_status')
+            for page in paginator.paginate(InstanceIds=instance_ids, IncludeAllInstances=True):
+                for status in page['InstanceStatuses']:
+                    if instance_passed_status_checks(status):
+                        ready.append(status['InstanceId'])
+            return ready
+        except ClientError as e:
+            if e.response['Error']['Code'] not in INVALID_ID_ERRORS:
+                raise
+            bad_ids = set(re.findall(r'i-[0-9a-zA-Z]+', e.response['Error'].get('Message', ''))) & set(instance_ids)
+            if not bad_ids:
+                raise
+            print(f"Skipping {len(bad_ids)} unknown instance IDs this round: {', '.join(sorted(bad_ids))}")
+            instance_ids = [instance_id for instance_id in instance_ids if instance_id not in bad_ids]
+    return []
+
+
+class InstanceStatusPoller:
+    """Shared poller: workers call wait(instance_id) and block until the instance passes its status checks"""
+
+    def __init__(self, ec2_client, interval=10, min_interval=1):
+        self.ec2_client = ec2_client
+        # Seconds between polls, and the minimum gap when new waiters arrive and wake the poller early
+        self.interval = interval
+        self.min_interval = min_interval
+        self._events = {}
+        # Futures of the asyncio waiters (see wait_async), per instance ID
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def track(self, instance_ids):
+        """Add instance_ids to the ones poll_once() checks, without starting the background thread"""
+        with self._lock:
+            for instance_id in instance_ids:
+                self._events.setdefault(instance_id, threading.Event())
+
+    def _register(self, instance_id):
+        with self._lock:
+            event = self._events.setdefault(instance_id, threading.Event())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='instance-status-poller', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return event
+
+    def watch(self, instance_ids):
+        """Start polling instance_ids now, so their status checks are followed in the background while the hosts
+        are already being worked on (see port_scanner.py)"""
+        for instance_id in instance_ids:
+            self._register(instance_id)
+
+    def wait(self, instance_id, timeout=None):
+        """Block until instance_id is running and has passed its status checks. Returns False on timeout."""
+        return self._register(instance_id).wait(timeout)
+
+    async def wait_async(self, instance_id, timeout=None):
+        """wait() for the asyncio SSH engine: the event loop is not blocked and no thread is used per waiter"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._futures.setdefault(instance_id, []).append((loop, future))
+        try:
+            if self._register(instance_id).is_set():
+                return True
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            # A waiter that timed out or returned early must not be woken later: its loop may be closed by then
+            forget_future(self._lock, self._futures, instance_id, loop, future)
+
+    def is_ready(self, instance_id):
+        with self._lock:
+            event = self._events.get(instance_id)
+        return event is not None and event.is_set()
+
+    def _pending_ids(self):
+        with self._lock:
+            return [instance_id for instance_id, event in self._events.items() if not event.is_set()]
+
+    def poll_once(self):
+        """One round of batched describe_instance_status calls for every instance still being waited on.
+        Returns how many are still not ready."""
+        pending = self._pending_ids()
+        for start in range(0, len(pending), MAX_IDS_PER_CALL):
+            chunk = pending[start:start + MAX_IDS_PER_CALL]
+            try:
+                for instance_id in _describe_ready(self.ec2_client, chunk):
+                    self._set_ready(instance_id)
+            except Exception as e:
+                # e.g. throttling: the chunk is simply polled again next round
+                print(f"Error polling instance status for {len(chunk)} instances: {e}")
+        return len(self._pending_ids())
+
+    def _set_ready(self, instance_id):
+        with self._lock:
+            self._events[instance_id].set()
+            futures = self._futures.pop(instance_id, [])
+        for loop, future in futures:
+            resolve_from_thread(loop, future)
+
+    def _run(self):
+        last_poll = 0
+        while True:
+            # New waiters wake the poller early, but never more often than min_interval, so 50 threads arriving at
+            # once still produce one batched call
+            since_last_poll = time.monotonic() - last_poll
+            if since_last_poll < self.min_interval:
+                time.sleep(self.min_interval - since_last_poll)
+            self._wakeup.clear()
+            last_poll = time.monotonic()
+            pending = self.poll_once()
+            if pending:
+                print(f"Waiting for {pending} instances to be in running state and pass status checks...")
+            self._wakeup.wait(self.interval)
+
+
+def forget_future(lock, futures, instance_id, loop, future):
+    # Remove a waiter's (loop, future) from futures[instance_id], if it is still there
+    with lock:
+        waiters = futures.get(instance_id)
+        if waiters and (loop, future) in waiters:
+            waiters.remove((loop, future))
+            if not waiters:
+                del futures[instance_id]
+
+
+def resolve_from_thread(loop, future):
+    # Wake an asyncio waiter from the poller (or HTTP) thread. The loop may have been closed since the waiter
+    # registered (asyncio.run returned): the RuntimeError from call_soon_threadsafe would kill the calling thread
+    if loop.is_closed():
+        return
+    try:
+        loop.call_soon_threadsafe(_resolve, future)
+    except RuntimeError:
+        # Closed between the check and the call
+        pass
+
+
+def _resolve(future):
+    # Runs in the waiter's event loop
+    if not future.done():
+        future.set_result(True)
@@ -0,0 +1,41 @@
+from pipeline_lib.tags import ROLE_TAG_KEY, RUN_TAG_KEY
+
+# Inventory of the instances this run launched.
+# Script 6 used to find its targets with an unfiltered describe_instances of every running instance in the account,
+# minus one hard coded controller instance ID, and only read the first page of the results. Now script 5 tags the
+# instances it launches (pipeline:run = the run_id, pipeline:role = tomcat, see tags.py) and saves a compact
+# inventory taken straight from the run_instances response in the run state. The later steps refresh only those
+# instances, with server side tag filters and a paginator, so the cost does not grow with the other instances in the
+# account and nothing past the first page is missed.
+
+
+def inventory_entry(instance):
+    """The compact inventory entry for a run_instances/describe_instances instance"""
+    return {
+        'instance_id': instance['InstanceId'],
+        'private_ip': instance.get('PrivateIpAddress'),
+        'public_ip': instance.get('PublicIpAddress'),
+        'subnet_id': instance.get('SubnetId'),
+        'availability_zone': instance.get('Placement', {}).get('AvailabilityZone'),
+        'security_group_ids': [sg['GroupId'] for sg in instance.get('SecurityGroups', [])],
+        'state': instance['State']['Name'],
+    }
+
+
+def build_inventory(instances):
+    return [inventory_entry(instance) for instance in instances]
+
+
+def refresh_inventory(my_ec2, run_id, role='tomcat', states=('running',)):
+    """Fresh inventory entries for the instances of this run with the given role and states"""
+    paginator = my_ec2.get_paginator('describe_instances')
+    inventory = []
+    for page in paginator.paginate(Filters=[
+        {'Name': f'tag:{RUN_TAG_KEY}', 'Values': [run_id]},
+        {'Name': f'tag:{ROLE_TAG_KEY}', 'Values': [role]},
+        {'Name': 'instance-state-name', 'Values': list(states)},
+    ]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                inventory.append(inventory_entry(instance))
+    return sorted(inventory, key=lambda entry: entry['instance_id'])
@@ -0,0 +1,200 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from pipeline_lib.tracing import get_tracer
+
+# Multi-AZ, chunked bulk launch (launch_mode=multi_az in the .env).
+# start_ec2_instances in script 5 is a single run_instances call with no SubnetId, so the whole fleet lands in one
+# default AZ while the ALB of script 7 spans six subnets, and a big min_count fails outright on capacity or on the
+# vCPU quota. The planner instead:
+#   - checks the account's Running On-Demand Standard instances vCPU quota first, and trims the launch to what fits
+#     (or fails before launching anything when even min_count does not fit)
+#   - splits the count evenly across the subnets of stack_config.py, in chunks of at most launch_chunk_size
+#   - issues the chunks' run_instances calls concurrently, each with an idempotent ClientToken made from the run_id, so
+#     a retried call (or a rerun of the step with the same run state) can not launch a chunk twice
+#   - on a capacity error (InsufficientInstanceCapacity, ...) or a partial launch, retries what is missing in the
+#     subnets of the other AZs
+# The result is the same list of run_instances instances as before, so the inventory in the run state is unchanged.
+
+# Running On-Demand Standard (A, C, D, H, I, M, R, T, Z) instances, in vCPUs
+VCPU_QUOTA_CODE = 'L-1216C47A'
+STANDARD_FAMILIES = 'acdhimrtz'
+
+DEFAULT_CHUNK_SIZE = 50
+DEFAULT_LAUNCH_WORKERS = 6
+
+CAPACITY_ERROR_CODES = {
+    'InsufficientInstanceCapacity',
+    'InsufficientCapacity',
+    'InsufficientHostCapacity',
+    'InsufficientReservedInstanceCapacity',
+    'Unsupported',
+}
+
+# ClientToken is limited to 64 ASCII characters
+CLIENT_TOKEN_LENGTH = 64
+
+
+class LaunchPlanError(Exception):
+    """The fleet can not be launched (vCPU quota, or not enough capacity in any AZ)"""
+
+    def __init__(self, message, instances=None):
+        super().__init__(message)
+        # The instances that did launch, so they are still recorded (and can be cleaned up)
+        self.instances = instances or []
+
+
+def plan_chunks(count, subnet_ids, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split count across the subnets as evenly as possible, then into chunks of at most chunk_size.
+    Returns a list of (subnet_id, count)."""
+    if not subnet_ids:
+        raise ValueError("no subnets to launch into")
+    per_subnet = [count // len(subnet_ids)] * len(subnet_ids)
+    for i in range(count % len(subnet_ids)):
+        per_subnet[i] += 1
+    chunks = []
+    for subnet_id, subnet_count in zip(subnet_ids, per_subnet):
+        for start in range(0, subnet_count, chunk_size):
+            chunks.append((subnet_id, min(chunk_size, subnet_count - start)))
+    return chunks
+
+
+def subnet_zones(my_ec2, subnet_ids):
+    """{subnet_id: availability zone} with one describe_subnets call"""
+    response = my_ec2.describe_subnets(SubnetIds=list(subnet_ids))
+    return {subnet['SubnetId']: subnet['AvailabilityZone'] for subnet in response['Subnets']}
+
+
+def fallback_subnets(subnet_id, zones):
+    """The other subnets to retry a chunk in, those in a different AZ first"""
+    others = [other for other in zones if other != subnet_id]
+    return [other for other in others if zones[other] != zones.get(subnet_id)] + \
+        [other for other in others if zones[other] == zones.get(subnet_id)]
+
+
+def is_standard_instance_type(instance_type):
+    return instance_type[0].lower() in STANDARD_FAMILIES
+
+
+def instance_type_vcpus(my_ec2, instance_type):
+    response = my_ec2.describe_instance_types(InstanceTypes=[instance_type])
+    return response['InstanceTypes'][0]['VCpuInfo']['DefaultVCpus']
+
+
+def running_standard_vcpus(my_ec2):
+    """vCPUs of the pending/running standard family instances of the account in this region"""
+    paginator = my_ec2.get_paginator('describe_instances')
+    vcpus = 0
+    for page in paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running']}]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                if not is_standard_instance_type(instance['InstanceType']):
+                    continue
+                cpu = instance.get('CpuOptions', {})
+                vcpus += cpu.get('CoreCount', 1) * cpu.get('ThreadsPerCore', 1)
+    return vcpus
+
+
+def check_vcpu_quota(my_ec2, quotas_client, instance_type, min_count, max_count):
+    """How many of the instances fit in the vCPU quota, at most max_count. Raises LaunchPlanError if min_count does
+    not fit. The check is skipped (max_count is returned) if the quota can not be read."""
+    if not is_standard_instance_type(instance_type):
+        print(f"{instance_type} is not a standard instance family, skipping the vCPU quota check")
+        return max_count
+    try:
+        quota = quotas_client.get_service_quota(ServiceCode='ec2', QuotaCode=VCPU_QUOTA_CODE)['Quota']['Value']
+        in_use = running_standard_vcpus(my_ec2)
+        per_instance = instance_type_vcpus(my_ec2, instance_type)
+    except ClientError as e:
+        print(f"Could not read the vCPU quota, skipping the check: {e}")
+        return max_count
+    fits = int(max(0, quota - in_use) // per_instance)
+    print(f"vCPU quota {quota:.0f}, in use {in_use}, {instance_type} needs {per_instance} vCPUs: "
+          f"room for {fits} instances")
+    if fits < min_count:
+        raise LaunchPlanError(
+            f"vCPU quota too low: {min_count} x {instance_type} needs {min_count * per_instance} vCPUs, "
+            f"only {quota - in_use:.0f} of {quota:.0f} are free (quota {VCPU_QUOTA_CODE})"
+        )
+    if fits < max_count:
+        print(f"Launching {fits} instead of {max_count} instances to stay within the vCPU quota")
+    return min(fits, max_count)
+
+
+def client_token(run_id, chunk_index, attempt):
+    return f"{run_id}-chunk{chunk_index}-try{attempt}"[:CLIENT_TOKEN_LENGTH]
+
+
+def launch_chunk(my_ec2, chunk_index, subnet_id, count, zones, launch_options, run_id):
+    """Launch count instances in subnet_id, retrying capacity errors and partial launches in the other subnets.
+    Returns the list of launched instances (possibly fewer than count)."""
+    instances = []
+    for attempt, target_subnet in enumerate([subnet_id] + fallback_subnets(subnet_id, zones)):
+        missing = count - len(instances)
+        if missing <= 0:
+            break
+        try:
+            with get_tracer().span('run_instances', count=missing, subnet=target_subnet):
+                response = my_ec2.run_instances(
+                    SubnetId=target_subnet,
+                    MinCount=1,
+                    MaxCount=missing,
+                    ClientToken=client_token(run_id, chunk_index, attempt),
+                    **launch_options
+                )
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code not in CAPACITY_ERROR_CODES:
+                raise
+            print(f"Chunk {chunk_index}: {code} in {target_subnet} ({zones.get(target_subnet)}), "
+                  f"retrying {missing} instances in another AZ")
+            continue
+        instances.extend(response['Instances'])
+        print(f"Chunk {chunk_index}: launched {len(response['Instances'])} of {missing} instances in "
+              f"{target_subnet} ({zones.get(target_subnet)})")
+    return instances
+
+
+def launch_multi_az(my_ec2, quotas_client, subnet_ids, image_id, instance_type, key_name, min_count, max_count,
+                    run_id, user_data=None, tag_specifications=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                    max_workers=DEFAULT_LAUNCH_WORKERS):
+    """Launch between min_count and max_count instances spread across subnet_ids. Returns the instances."""
+    count = check_vcpu_quota(my_ec2, quotas_client, instance_type, min_count, max_count)
+    zones = subnet_zones(my_ec2, subnet_ids)
+    chunks = plan_chunks(count, subnet_ids, chunk_size)
+    print(f"Launching {count} instances in {len(chunks)} chunks across {len(set(zones.values()))} AZs")
+
+    launch_options = {'ImageId': image_id, 'InstanceType': instance_type, 'KeyName': key_name}
+    if user_data:
+        launch_options['UserData'] = user_data
+    if tag_specifications:
+        launch_options['TagSpecifications'] = tag_specifications
+
+    instances = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(launch_chunk, my_ec2, index, subnet_id, chunk_count, zones, launch_options, run_id)
+            for index, (subnet_id, chunk_count) in enumerate(chunks)
+        ]
+        error = None
+        for future in futures:
+            try:
+                instances.extend(future.result())
+            except ClientError as e:
+                # Keep collecting the other chunks so every launched instance is reported
+                print(f"Error launching a chunk: {e}")
+                error = error or e
+    if error is not None:
+        raise LaunchPlanError(f"Error launching the fleet: {error}", instances)
+
+    if len(instances) < min_count:
+        raise LaunchPlanError(
+            f"Only {len(instances)} of the minimum {min_count} instances could be launched in any AZ", instances
+        )
+    per_zone = {}
+    for instance in instances:
+        zone = instance.get('Placement', {}).get('AvailabilityZone')
+        per_zone[zone] = per_zone.get(zone, 0) + 1
+    print("Instances per AZ: " + ", ".join(f"{zone} {n}" for zone, n in sorted(per_zone.items())))
+    return instances
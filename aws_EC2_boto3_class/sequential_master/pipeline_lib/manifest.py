@@ -0,0 +1,66 @@
+# Step manifest for the master runner.
+# 'name' is the short name used to tag the step's output lines and to refer to the step in the run state.
+# 'depends_on' lists the steps that must have completed before this one can start. Steps that don't depend on each
+# other run at the same time (up to max_parallel_steps), so the waits for instance boot, certificate issuance and DNS
+# propagation overlap instead of adding up.
+# 'ready' lists the readiness conditions (see readiness.py) that must hold before the step is started and 'timeout'
+# is how many seconds to wait for them. If the timeout runs out the step fails without being run (its dependents are
+# not run either, and a rerun resumes there). readiness_timeout_action=start in the .env starts it anyway instead,
+# which is what the old fixed delays list did on a slow day.
+#
+# This replaces delays = [5, 1, 90, 10, 90]:
+#   - the 5 second delay before script 6 becomes "the instances launched by script 5 are running"
+#   - the 90 second delay before script 8 becomes "the ALB is active"
+#   - the 90 second delay before script 9 becomes "the targets are healthy and the certificate is issued"
+#
+# The dependency graph:
+#
+#   5_launch --> 6_install
+#            \-> 7_alb -----> 8_ssl
+#            \-> 9_stress
+#
+#   - 7_alb only needs the instance and security group IDs recorded by script 5 (and the instances to be running so
+#     they can be registered), not the Tomcat install. The targets simply turn healthy once script 6 is done.
+#   - 8_ssl (ACM request/validation, Route 53, HTTPS listener) only needs the ALB.
+#   - 9_stress launches its own instance. Script 6 only picks up the instances tagged as this run's Tomcat fleet
+#     (see inventory.py), so the stress generator does not depend on the install. It waits for 5_launch so the two
+#     launches don't compete for capacity, and is only started once the targets behind the ALB are healthy (i.e. the
+#     install is done and 7_alb registered them) and the listener certificate is issued, so the wget loop does not
+#     start against an ALB with nothing behind it.
+
+PIPELINE_STEPS = [
+    {
+        'name': '5_launch',
+        'script': '5_restart_the_EC_multiple_instances_with_client_method.py',
+        'depends_on': [],
+        'ready': [],
+    },
+    {
+        'name': '6_install',
+        'script': '6_install_tomcat_on_each_of_new_instances_ThreadPoolExecutor_list_failed_installation_ips_3.py',
+        'depends_on': ['5_launch'],
+        'ready': ['instances_running'],
+        'timeout': 600,
+    },
+    {
+        'name': '7_alb',
+        'script': '7_create_application_load_balancer_for_EC2_tomcat9_instances_json_pretty_format.py',
+        'depends_on': ['5_launch'],
+        'ready': ['instances_running'],
+        'timeout': 600,
+    },
+    {
+        'name': '8_ssl',
+        'script': '8_SSL_listener_with_Route53_for_ACM_validation_with_CNAME_automated.py',
+        'depends_on': ['7_alb'],
+        'ready': ['load_balancer_active'],
+        'timeout': 900,
+    },
+    {
+        'name': '9_stress',
+        'script': '9_wget_debug4.py',
+        'depends_on': ['5_launch'],
+        'ready': ['targets_healthy', 'certificate_issued'],
+        'timeout': 2400,
+    },
+]
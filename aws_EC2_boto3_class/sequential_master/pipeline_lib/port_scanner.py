@@ -0,0 +1,131 @@
+import asyncio
+import errno
+import selectors
+import socket
+import time
+
+# SSH reachability scanner (ssh_readiness=port_scan in the .env).
+# Script 6 used to start a host's install only once EC2 reported both SystemStatus and InstanceStatus ok, which
+# usually comes minutes after the instance already accepts SSH. With the scanner, port 22 of every pending host is
+# probed at once with non-blocking connects from one thread (selectors), and each host is handed to the install pool
+# the moment its port accepts a connection. The status checks are still polled in the background by the shared
+# poller, and a host only counts as installed once they pass too. The asyncio SSH engine uses wait_for_port_async
+# instead.
+#
+# Settings: port_scan_interval (seconds between probes of a host that is not up yet, default 2) and
+# port_scan_connect_timeout (seconds allowed for one probe, default 3). The whole scan gives up on a host after
+# status_check_timeout.
+
+DEFAULT_INTERVAL = 2
+DEFAULT_CONNECT_TIMEOUT = 3
+# Open sockets at a time, well under the default file descriptor limit
+MAX_IN_FLIGHT = 512
+
+# A host reached this early is usually still running cloud-init (which may hold the apt lock): wait for it to finish
+# before the install commands
+CLOUD_INIT_WAIT = 'cloud-init status --wait > /dev/null 2>&1 || true'
+
+_CONNECTING = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class PortScanner:
+    """Probes a TCP port on many hosts at once and reports each host as soon as the port accepts connections"""
+
+    def __init__(self, port=22, interval=DEFAULT_INTERVAL, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 max_in_flight=MAX_IN_FLIGHT):
+        self.port = port
+        self.interval = interval
+        self.connect_timeout = connect_timeout
+        self.max_in_flight = max_in_flight
+
+    @classmethod
+    def from_settings(cls, ctx, port=22):
+        return cls(
+            port=port,
+            interval=float(ctx.setting('port_scan_interval', DEFAULT_INTERVAL)),
+            connect_timeout=float(ctx.setting('port_scan_connect_timeout', DEFAULT_CONNECT_TIMEOUT)),
+        )
+
+    def _start_probe(self, selector, ip, index):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        if sock.connect_ex((ip, self.port)) not in _CONNECTING:
+            sock.close()
+            return None
+        selector.register(sock, selectors.EVENT_WRITE, index)
+        return sock
+
+    def scan(self, hosts, timeout=None):
+        """Yield (host, True) for each host (a tuple starting with its ip) as soon as its port is open, and
+        (host, False) at the end for the hosts whose port did not open within timeout seconds"""
+        selector = selectors.DefaultSelector()
+        start = time.monotonic()
+        # host index -> when to probe it next
+        next_probe = {index: start for index in range(len(hosts))}
+        # socket -> (host index, when the probe started)
+        in_flight = {}
+        try:
+            while next_probe or in_flight:
+                now = time.monotonic()
+                if timeout is not None and now - start > timeout:
+                    break
+                for index, probe_at in sorted(next_probe.items(), key=lambda item: item[1]):
+                    if probe_at > now or len(in_flight) >= self.max_in_flight:
+                        continue
+                    del next_probe[index]
+                    sock = self._start_probe(selector, hosts[index][0], index)
+                    if sock is None:
+                        next_probe[index] = now + self.interval
+                    else:
+                        in_flight[sock] = (index, now)
+
+                # Sleep until the next probe is due (if there is room for it), a probe times out or a socket is ready
+                due = list(next_probe.values()) if len(in_flight) < self.max_in_flight else []
+                wait = min(due + [now + self.interval]) - now
+                if in_flight:
+                    wait = min(wait, min(started for index, started in in_flight.values()) + self.connect_timeout - now)
+                    events = selector.select(max(0, wait))
+                else:
+                    time.sleep(max(0, wait))
+                    events = []
+
+                now = time.monotonic()
+                for key, mask in events:
+                    sock = key.fileobj
+                    index = key.data
+                    selector.unregister(sock)
+                    del in_flight[sock]
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    sock.close()
+                    if error == 0:
+                        yield hosts[index], True
+                    else:
+                        # e.g. connection refused: the instance is up but sshd is not listening yet
+                        next_probe[index] = now + self.interval
+                for sock, (index, started) in list(in_flight.items()):
+                    if now - started > self.connect_timeout:
+                        selector.unregister(sock)
+                        del in_flight[sock]
+                        sock.close()
+                        next_probe[index] = now
+        finally:
+            for sock in in_flight:
+                selector.unregister(sock)
+                sock.close()
+            selector.close()
+        for index in sorted(set(next_probe) | {index for index, started in in_flight.values()}):
+            yield hosts[index], False
+
+
+async def wait_for_port_async(ip, port=22, timeout=None, interval=DEFAULT_INTERVAL,
+                              connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+    """Wait until ip accepts TCP connections on port. Returns False if it did not within timeout seconds."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while deadline is None or time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), connect_timeout)
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError):
+            await asyncio.sleep(interval)
+    return False
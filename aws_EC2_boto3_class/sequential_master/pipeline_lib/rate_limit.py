@@ -0,0 +1,52 @@
+import threading
+import time
+
+# Token bucket rate limiter.
+# Used to cap how many new SSH connections per second the install step opens (host_pool.py), so 1,000 hosts don't
+# all start their handshake in the same second. Tokens are added continuously at 'rate' per second up to 'burst';
+# acquire() blocks until a token is available.
+
+
+class TokenBucket:
+    """Thread safe token bucket: at most rate acquisitions per second on average, bursts of up to burst"""
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """Change the refill rate (used by the adaptive AWS request budget)"""
+        with self._lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if they are available right now"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available and take them. Returns how many seconds we waited."""
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return time.monotonic() - start
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
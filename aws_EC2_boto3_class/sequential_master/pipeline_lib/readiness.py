@@ -0,0 +1,127 @@
+import time
+
+# Readiness conditions for the master runner.
+# Each step in the manifest names the condition(s) that must hold before it is started. Instead of sleeping a fixed
+# number of seconds between scripts, the runner polls these conditions and starts the next step as soon as AWS
+# reports that the resources are actually ready (or the step's timeout runs out).
+#
+# A condition factory takes the PipelineContext (anything with a .client(name) method) and returns a check() function that
+# returns True when the condition holds.
+
+
+def instances_running(ctx, instance_ids=None):
+    """Ready when the given instances (by default the ones script 5 recorded in the run state) are running. With no
+    ids at all, ready when no instance in the account is still pending."""
+    ec2_client = ctx.client('ec2')
+    if instance_ids is None and hasattr(ctx, 'state'):
+        instance_ids = ctx.state.get('instance_ids')
+
+    def check():
+        if instance_ids:
+            response = ec2_client.describe_instances(InstanceIds=list(instance_ids))
+            states = [instance['State']['Name']
+                      for reservation in response['Reservations']
+                      for instance in reservation['Instances']]
+            return len(states) == len(instance_ids) and all(state == 'running' for state in states)
+
+        # Script 6 discovers its targets as "all running instances", so it must not start while instances
+        # launched by script 5 are still pending (they would be missed).
+        response = ec2_client.describe_instances(
+            Filters=[{'Name': 'instance-state-name', 'Values': ['pending']}]
+        )
+        return not any(reservation['Instances'] for reservation in response['Reservations'])
+
+    return check
+
+
+def load_balancer_active(ctx, name='tomcat-load-balancer'):
+    """Ready when the ALB created by script 7 has finished provisioning"""
+    elb_client = ctx.client('elbv2')
+
+    def check():
+        try:
+            response = elb_client.describe_load_balancers(Names=[name])
+        except elb_client.exceptions.LoadBalancerNotFoundException:
+            return False
+        return response['LoadBalancers'][0]['State']['Code'] == 'active'
+
+    return check
+
+
+def targets_healthy(ctx, target_group_name='tomcat-target-group'):
+    """Ready when every target registered in the target group passes its health check"""
+    elb_client = ctx.client('elbv2')
+
+    def check():
+        try:
+            target_groups = elb_client.describe_target_groups(Names=[target_group_name])
+        except elb_client.exceptions.TargetGroupNotFoundException:
+            return False
+        target_group_arn = target_groups['TargetGroups'][0]['TargetGroupArn']
+        health = elb_client.describe_target_health(TargetGroupArn=target_group_arn)
+        states = [target['TargetHealth']['State'] for target in health['TargetHealthDescriptions']]
+        return bool(states) and all(state == 'healthy' for state in states)
+
+    return check
+
+
+def certificate_issued(ctx, domain_name='loadbalancer.holinessinloveofchrist.com'):
+    """Ready when the certificate script 8 requested in this run (certificate_arn in the run state) is issued. Before
+    script 8 has recorded one, ready when ACM holds any issued certificate for the listener domain."""
+    acm_client = ctx.client('acm')
+
+    def check():
+        certificate_arn = ctx.state.get('certificate_arn') if hasattr(ctx, 'state') else None
+        if certificate_arn:
+            certificate = acm_client.describe_certificate(CertificateArn=certificate_arn)['Certificate']
+            return certificate['Status'] == 'ISSUED'
+        paginator = acm_client.get_paginator('list_certificates')
+        for page in paginator.paginate(CertificateStatuses=['ISSUED']):
+            for certificate in page['CertificateSummaryList']:
+                if certificate['DomainName'] == domain_name:
+                    return True
+        return False
+
+    return check
+
+
+# The names used in the step manifest
+CONDITIONS = {
+    'instances_running': instances_running,
+    'load_balancer_active': load_balancer_active,
+    'targets_healthy': targets_healthy,
+    'certificate_issued': certificate_issued,
+}
+
+
+def wait_until(check, timeout, interval=10, description='condition'):
+    """Poll check() until it returns True. Returns False if the timeout (seconds) runs out first."""
+    start = time.monotonic()
+    deadline = start + timeout
+    while True:
+        try:
+            if check():
+                print(f"{description} is ready after {time.monotonic() - start:.1f} seconds")
+                return True
+        except Exception as e:
+            # A failed describe call is treated as "not ready yet" and polled again
+            print(f"Error checking {description}: {e}")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print(f"Timed out after {timeout:.0f} seconds waiting for {description}")
+            return False
+        print(f"Waiting for {description}...")
+        time.sleep(min(interval, remaining))
+
+
+def wait_for_step_readiness(ctx, step):
+    """Wait for all the readiness conditions declared by a manifest step. Returns True if they all hold."""
+    timeout = step.get('timeout', 600)
+    deadline = time.monotonic() + timeout
+    for name in step.get('ready', []):
+        check = CONDITIONS[name](ctx)
+        remaining = max(0, deadline - time.monotonic())
+        if not wait_until(check, remaining, description=f"{name} (before {step['script']})"):
+            return False
+    return True
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from pipeline_lib.instance_status import forget_future, resolve_from_thread
+from pipeline_lib.user_data import STATUS_DIRECTORY
+
+# Push based readiness callbacks (readiness_callback_url in the .env).
+# Scripts 6 and 9 used to find out that an instance is usable by polling EC2 for its status checks and then retrying
+# ssh.connect every 10 seconds. With a callback URL set, script 5 (and script 9 for the stress generator) adds a small
+# script to the user-data that every instance runs at the end of each boot: it reads its instance ID from the
+# instance metadata (IMDSv2) and POSTs it to the controller, with status failed if the user-data Tomcat install
+# (provision_mode=user_data) did not succeed. The ReadinessReceiver is an HTTP endpoint in the controller process
+# that turns those calls into events, so a host's install starts the moment it reports in, with no polling and no
+# EC2 API calls.
+#
+# The receiver has the same wait/wait_async/watch interface as the InstanceStatusPoller and is used in its place. If
+# an instance has not called back after readiness_fallback_after seconds (default 300, e.g. the callback port is
+# not reachable) it falls back to the EC2 status checks for that instance.
+#
+# There is one receiver per pipeline: under the master runner it is started by the runner and shared by the
+# in-process steps (step_execution=in_process is required, see runner.py). A step script run on its own starts its
+# own.
+#
+# The controller's security group must allow the instances in on the callback port (readiness_listen_port, default
+# the port of the URL). The callbacks carry a token derived from the stack name and the AWS secret key, so the
+# receiver ignores anything else that reaches the port. simulate_callers() posts callbacks like booting instances
+# would, to test locally (see benchmarks/readiness_benchmark.py).
+
+CALLBACK_PATH = '/ready'
+DEFAULT_FALLBACK_AFTER = 300
+MAX_BODY_BYTES = 4096
+
+# cloud-init runs the scripts in this directory at the end of every boot, so an instance started again from the
+# warm pool calls back too (user-data itself only runs at the first boot)
+PER_BOOT_SCRIPT = '/var/lib/cloud/scripts/per-boot/pipeline-ready.sh'
+
+
+def callback_token(stack, secret=None):
+    """The token the instances of the stack send with their callbacks"""
+    return hashlib.sha256(f"{stack}:{secret or ''}".encode()).hexdigest()[:32]
+
+
+def render_callback_script(url, token):
+    """The script an instance runs at the end of each boot to report to the controller"""
+    return f"""#!/bin/bash
+# Readiness callback to the pipeline controller, generated by the pipeline (pipeline_lib/readiness_receiver.py)
+status=ready
+if [ -f {STATUS_DIRECTORY}/install.exit_code ] && [ "$(cat {STATUS_DIRECTORY}/install.exit_code)" != "0" ]; then
+    status=failed
+fi
+imds_token=$(curl -s --max-time 5 -X PUT -H 'X-aws-ec2-metadata-token-ttl-seconds: 300' \\
+    http://169.254.169.254/latest/api/token)
+instance_id=$(curl -s --max-time 5 -H "X-aws-ec2-metadata-token: $imds_token" \\
+    http://169.254.169.254/latest/meta-data/instance-id)
+curl -s -o /dev/null --max-time 5 --retry 60 --retry-delay 10 --retry-all-errors -X POST \\
+    -H 'Content-Type: application/json' \\
+    -d "{{\\"instance_id\\": \\"$instance_id\\", \\"status\\": \\"$status\\", \\"token\\": \\"{token}\\"}}" \\
+    {url}
+"""
+
+
+def render_callback_installer(url, token):
+    """user-data lines that install the callback as a per-boot script and run it for the first boot"""
+    return f"""mkdir -p {PER_BOOT_SCRIPT.rsplit('/', 1)[0]}
+cat > {PER_BOOT_SCRIPT} <<'PIPELINE_READY_SCRIPT'
+{render_callback_script(url, token)}PIPELINE_READY_SCRIPT
+chmod +x {PER_BOOT_SCRIPT}
+nohup {PER_BOOT_SCRIPT} > /dev/null 2>&1 &
+"""
+
+
+def render_callback_user_data(url, token):
+    """Complete user-data for an instance that only has to call back (no install at boot)"""
+    return "#!/bin/bash\n" + render_callback_installer(url, token)
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        if self.path != CALLBACK_PATH:
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            self.send_error(413)
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_error(400)
+            return
+        if receiver.token and not hmac.compare_digest(str(body.get('token', '')), receiver.token):
+            self.send_error(403)
+            return
+        if not body.get('instance_id'):
+            self.send_error(400)
+            return
+        receiver.report(body['instance_id'], body.get('status', 'ready'), self.client_address[0])
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # The receiver prints the callbacks itself
+        pass
+
+
+class ReadinessReceiver:
+    """HTTP endpoint for the instance readiness callbacks, with the wait interface of the InstanceStatusPoller"""
+
+    def __init__(self, port=0, token=None, fallback=None, fallback_after=DEFAULT_FALLBACK_AFTER, host='0.0.0.0'):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.fallback = fallback
+        self.fallback_after = fallback_after
+        self._statuses = {}
+        self._events = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @classmethod
+    def from_settings(cls, ctx, stack, fallback=None):
+        url = ctx.setting('readiness_callback_url')
+        return cls(
+            port=int(ctx.setting('readiness_listen_port', urlsplit(url).port or 80)),
+            token=callback_token(stack, ctx.aws_secret_key),
+            fallback=fallback,
+            fallback_after=float(ctx.setting('readiness_fallback_after', DEFAULT_FALLBACK_AFTER)),
+        )
+
+    def start(self):
+        """Start listening in a background thread"""
+        self._server = ThreadingHTTPServer((self.host, self.port), _CallbackHandler)
+        self._server.daemon_threads = True
+        self._server.receiver = self
+        # With port 0 the OS picks a free port
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='readiness-receiver', daemon=True).start()
+        print(f"Readiness receiver listening on port {self.port}")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _event(self, instance_id):
+        with self._lock:
+            return self._events.setdefault(instance_id, threading.Event())
+
+    def report(self, instance_id, status, address=None):
+        """Record a callback (called by the HTTP handler, or directly)"""
+        event = self._event(instance_id)
+        with self._lock:
+            first = instance_id not in self._statuses
+            self._statuses[instance_id] = status
+            futures = self._futures.pop(instance_id, [])
+        if first:
+            print(f"Instance {instance_id} reported {status}" + (f" from {address}" if address else ""))
+        event.set()
+        for loop, future in futures:
+            resolve_from_thread(loop, future)
+
+    def status(self, instance_id):
+        with self._lock:
+            return self._statuses.get(instance_id)
+
+    def is_ready(self, instance_id):
+        return self.status(instance_id) == 'ready'
+
+    def watch(self, instance_ids):
+        # Nothing to poll: the instances call in on their own
+        pass
+
+    def _first_wait(self, timeout):
+        # How long to wait for the callback before falling back to the EC2 status checks
+        if self.fallback is None:
+            return timeout
+        return self.fallback_after if timeout is None else min(timeout, self.fallback_after)
+
+    def wait(self, instance_id, timeout=None):
+        """Block until instance_id calls back. True if it reported ready, False if it reported a failure or nothing
+        came in time (from the callback or the fallback)."""
+        first_wait = self._first_wait(timeout)
+        if self._event(instance_id).wait(first_wait):
+            return self.is_ready(instance_id)
+        remaining = None if timeout is None else timeout - first_wait
+        if self.fallback is None or (remaining is not None and remaining <= 0):
+            return False
+        print(f"No readiness callback from {instance_id} after {first_wait:.0f} seconds, "
+              f"falling back to the EC2 status checks")
+        return self.fallback.wait(instance_id, remaining)
+
+    async def wait_async(self, instance_id, timeout=None):
+        """wait() for the asyncio SSH engine"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._futures.setdefault(instance_id, []).append((loop, future))
+        first_wait = self._first_wait(timeout)
+        try:
+            if self._event(instance_id).is_set():
+                return self.is_ready(instance_id)
+            await asyncio.wait_for(future, first_wait)
+            return self.is_ready(instance_id)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # Not woken by report() after this (see forget_future in instance_status.py)
+            forget_future(self._lock, self._futures, instance_id, loop, future)
+        remaining = None if timeout is None else timeout - first_wait
+        if self.fallback is None or (remaining is not None and remaining <= 0):
+            return False
+        print(f"No readiness callback from {instance_id} after {first_wait:.0f} seconds, "
+              f"falling back to the EC2 status checks")
+        return await self.fallback.wait_async(instance_id, remaining)
+
+
+def post_callback(url, instance_id, status='ready', token=None, timeout=5):
+    """POST one callback the way an instance does. Returns the HTTP status."""
+    body = json.dumps({'instance_id': instance_id, 'status': status, 'token': token}).encode()
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def simulate_callers(url, instance_ids, token=None, max_delay=5.0, failed_ids=()):
+    """Simulated booting instances: each calls back after a random delay up to max_delay seconds, in its own
+    thread. Returns {instance_id: time the callback was sent}."""
+    sent_at = {}
+
+    def boot(instance_id):
+        time.sleep(random.uniform(0, max_delay))
+        sent_at[instance_id] = time.monotonic()
+        post_callback(url, instance_id, 'failed' if instance_id in failed_ids else 'ready', token)
+
+    threads = [threading.Thread(target=boot, args=(instance_id,), daemon=True) for instance_id in instance_ids]
+    for thread in threads:
+        thread.start()
+    return sent_at
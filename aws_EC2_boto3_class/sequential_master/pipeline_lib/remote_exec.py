@@ -0,0 +1,155 @@
+import time
+
+from pipeline_lib.tracing import get_tracer
+
+# Remote command execution over an open paramiko SSHClient.
+# Success is decided by the exit status of the remote command (channel.recv_exit_status()), not by scanning stderr
+# for strings: apt prints "WARNING: apt does not have a stable CLI interface" on stderr on every run and exits 0,
+# while a missing package exits 100. A command is only retried when it actually failed, with a backoff between the
+# attempts, and each command returns a result dict that the caller can print or save.
+# With a HostLog (see host_log.py) the output is streamed into the host's compressed log as it arrives, and only a
+# bounded tail of it is ever held in memory.
+
+# How much of stdout/stderr is kept in the results (the end of the output, where the errors are)
+OUTPUT_TAIL_CHARS = 2000
+
+# Chunk size for reading the channel
+READ_SIZE = 32768
+
+# How much of each stream is held in memory while a command runs (comfortably more than OUTPUT_TAIL_CHARS, so
+# output_tail() still knows whether the output was cut)
+OUTPUT_TAIL_BYTES = 65536
+
+
+def detached_command(command):
+    """command wrapped to keep running after the SSH session that started it is closed (e.g. the stress loop)"""
+    return f"nohup {command} > /dev/null 2>&1 &"
+
+
+def output_tail(text, limit=OUTPUT_TAIL_CHARS):
+    """The last limit characters of text, and whether anything was cut off"""
+    if len(text) <= limit:
+        return text, False
+    return text[-limit:], True
+
+
+class TailBuffer:
+    """The last limit bytes of a stream"""
+
+    def __init__(self, limit=OUTPUT_TAIL_BYTES):
+        self.limit = limit
+        self.data = bytearray()
+
+    def feed(self, chunk):
+        self.data += chunk
+        if len(self.data) > self.limit:
+            del self.data[:-self.limit]
+
+    def text(self):
+        return self.data.decode('utf-8', errors='replace')
+
+
+def read_channel(channel, timeout=None, log=None):
+    """Read stdout and stderr of a channel until the command exits, writing them to log (a HostLog) as they come.
+    Returns (exit_code, stdout, stderr), with stdout and stderr cut to their last OUTPUT_TAIL_BYTES."""
+    # Both streams are drained as they arrive, so a command writing a lot to stderr can't stall on a full SSH window
+    # while we are still reading stdout
+    stdout_tail = TailBuffer()
+    stderr_tail = TailBuffer()
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        read_something = False
+        for ready, recv, tail in ((channel.recv_ready, channel.recv, stdout_tail),
+                                  (channel.recv_stderr_ready, channel.recv_stderr, stderr_tail)):
+            if ready():
+                chunk = recv(READ_SIZE)
+                tail.feed(chunk)
+                if log is not None:
+                    log.write(chunk)
+                read_something = True
+        if not read_something:
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                channel.close()
+                raise TimeoutError(f"command did not finish within {timeout} seconds")
+            time.sleep(0.05)
+    exit_code = channel.recv_exit_status()
+    return exit_code, stdout_tail.text(), stderr_tail.text()
+
+
+def command_attempts(retries):
+    """How many times a command is run at most: retries, but always at least once (remote_command_retries=0)"""
+    return max(1, int(retries))
+
+
+def command_result(command, exit_code, stdout_output, stderr_output, attempt, duration):
+    """The result dict of one attempt, shared by the paramiko and the asyncio (async_ssh.py) executors"""
+    stdout_tail, stdout_truncated = output_tail(stdout_output)
+    stderr_tail, stderr_truncated = output_tail(stderr_output)
+    return {
+        'command': command,
+        'exit_code': exit_code,
+        'ok': exit_code == 0,
+        'attempts': attempt,
+        'duration': round(duration, 2),
+        'stdout': stdout_tail,
+        'stderr': stderr_tail,
+        'truncated': stdout_truncated or stderr_truncated,
+    }
+
+
+def retry_delay(result, attempts, backoff, backoff_factor, host=None):
+    """None if result is the final one (the command succeeded or it was the last attempt), otherwise how many seconds
+    to wait before the next attempt"""
+    attempt = result['attempts']
+    if result['ok'] or attempt >= attempts:
+        return None
+    delay = backoff * backoff_factor ** (attempt - 1)
+    print(f"Command failed on {host} with exit code {result['exit_code']}: {result['command']}. "
+          f"Retrying in {delay} seconds (Attempt {attempt + 1} of {attempts})")
+    return delay
+
+
+def run_remote_command(ssh, command, retries=3, backoff=10, backoff_factor=2, timeout=None, host=None, log=None):
+    """Run command over ssh, retrying on a non-zero exit status. Returns a result dict for the last attempt.
+    With log (a HostLog) the whole output goes to the host's log and only its tail is kept."""
+    tracer = get_tracer()
+    attempts = command_attempts(retries)
+    for attempt in range(1, attempts + 1):
+        start = time.time()
+        if log is not None:
+            log.note(f"$ {command} (attempt {attempt} of {attempts})")
+        with tracer.span(command, 'command', host=host, attempt=attempt):
+            try:
+                stdin, stdout, stderr = ssh.exec_command(command)
+                stdin.close()
+                exit_code, stdout_output, stderr_output = read_channel(stdout.channel, timeout, log)
+            except Exception as e:
+                # SSH level failure (connection dropped, timeout): no exit status from the command
+                exit_code, stdout_output, stderr_output = None, '', str(e)
+        if log is not None:
+            log.note(f"exit code {exit_code}" + (f": {stderr_output}" if exit_code is None else ''))
+        result = command_result(command, exit_code, stdout_output, stderr_output, attempt, time.time() - start)
+        delay = retry_delay(result, attempts, backoff, backoff_factor, host)
+        if delay is None:
+            return result
+        time.sleep(delay)
+
+
+def run_remote_commands(ssh, commands, **kwargs):
+    """Run the commands in order, stopping at the first one that still fails after its retries"""
+    results = []
+    for command in commands:
+        result = run_remote_command(ssh, command, **kwargs)
+        results.append(result)
+        if not result['ok']:
+            break
+    return results
+
+
+def format_result(result):
+    """One line summary of a command result"""
+    status = 'ok' if result['ok'] else f"failed (exit code {result['exit_code']})"
+    return (f"{result['command']}: {status} in {result['duration']}s "
+            f"after {result['attempts']} attempt(s)")
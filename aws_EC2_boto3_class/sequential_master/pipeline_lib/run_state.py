@@ -0,0 +1,116 @@
+import fcntl
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+# Persistent run state for checkpoint/resume.
+# The master runner marks each step complete in this file when it exits cleanly, and the steps record what they
+# produced (instance IDs, target group ARN, load balancer ARN, certificate ARN, Route 53 changes...). When the pipeline
+# is rerun after a failure the completed steps are skipped and it resumes at the first incomplete one, with the later
+# steps reading their inputs from here. This replaces the old instance_ids.json handoff between scripts 6, 7 and 8.
+#
+# To resume across docker runs, point run_state_file in the .env at a file on a mounted volume.
+#
+# Layout of the file:
+# {
+#     "run_id": "20250408-004322-1a2b3c4d",
+#     "started_at": "...",
+#     "steps": {"5_launch": {"status": "complete", "completed_at": "...", "outputs": {...}}, ...},
+#     "outputs": {...all the step outputs merged, this is what the later steps read...}
+# }
+
+RUN_STATE_FILE = 'pipeline_run_state.json'
+
+
+def _timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+
+
+def _new_run():
+    return {
+        'run_id': f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}",
+        'started_at': _timestamp(),
+        'steps': {},
+        'outputs': {},
+    }
+
+
+class RunState:
+    """Read/write access to the run-state file.
+
+    Nothing is cached in memory: every call re-reads the file under an exclusive lock, so the master runner and the
+    step scripts (in their own processes, possibly running at the same time) all see each other's updates.
+    """
+
+    def __init__(self, path=RUN_STATE_FILE):
+        self.path = path
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return _new_run()
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _write(self, data):
+        # Write to a temporary file and rename it over the old one, so a crash can't leave a half written file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Return the whole state as a dict"""
+        with self._locked():
+            return self._read()
+
+    def reset(self):
+        """Start a new run (a new run_id and no completed steps)"""
+        with self._locked():
+            data = _new_run()
+            self._write(data)
+            return data
+
+    @property
+    def run_id(self):
+        with self._locked():
+            data = self._read()
+            if not os.path.exists(self.path):
+                # Keep the run_id stable from the first time it is asked for
+                self._write(data)
+            return data['run_id']
+
+    def record(self, step_name, **outputs):
+        """Save outputs produced by a step. They are saved straight away, so a step that fails halfway still leaves
+        behind what it already created (e.g. the certificate ARN) for the rerun to pick up."""
+        with self._locked():
+            data = self._read()
+            step = data['steps'].setdefault(step_name, {'status': 'incomplete', 'outputs': {}})
+            step['outputs'].update(outputs)
+            data['outputs'].update(outputs)
+            self._write(data)
+
+    def get(self, key, default=None):
+        """Read an output recorded by any step of this run"""
+        return self.load()['outputs'].get(key, default)
+
+    def mark_complete(self, step_name):
+        with self._locked():
+            data = self._read()
+            step = data['steps'].setdefault(step_name, {'outputs': {}})
+            step['status'] = 'complete'
+            step['completed_at'] = _timestamp()
+            self._write(data)
+
+    def is_complete(self, step_name):
+        return self.load()['steps'].get(step_name, {}).get('status') == 'complete'
@@ -0,0 +1,218 @@
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from pipeline_lib.readiness import wait_for_step_readiness
+from pipeline_lib.streaming import StepOutputPrefixer, run_step_spooled, run_step_streaming
+from pipeline_lib.tracing import TRACE_FILE, finish_trace, get_tracer, print_trace_summary, start_trace_collection
+
+# The master runner shared by the master_sequential_... wrapper scripts. The steps and the dependencies between them
+# are declared in manifest.py.
+#
+# There are two ways to execute a step (step_execution setting in the .env):
+#   - subprocess (default): each step script runs in its own python3 process, as it always has
+#   - in_process: each step script is imported once and its main(ctx) is called in the master process with the
+#     shared PipelineContext. boto3/paramiko are only imported once, the .env is only parsed once and the boto3
+#     Session and clients (with their loaded service models) are reused by all the steps.
+
+# Step scripts already imported by run_step_in_process, keyed by path
+_step_modules = {}
+
+
+def load_step_module(script_path):
+    """Import a step script as a module (once per process). The numbered file names are not valid module names,
+    so they are loaded by path."""
+    if script_path not in _step_modules:
+        module_name = 'step_' + os.path.splitext(os.path.basename(script_path))[0]
+        spec = importlib.util.spec_from_file_location(module_name, script_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _step_modules[script_path] = module
+    return _step_modules[script_path]
+
+
+def run_step_in_process(script_path, ctx):
+    """Call main(ctx) of a step script in this process. Returns an exit code like the subprocess mode does."""
+    try:
+        load_step_module(script_path).main(ctx)
+        return 0
+    except SystemExit as e:
+        # The step scripts call sys.exit(1) on errors
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+def say(message):
+    """Print a whole line in one write, so lines printed by concurrently running steps can't run together"""
+    sys.stdout.write(f"{message}\n")
+    sys.stdout.flush()
+
+
+def run_step(directory, step, ctx, tracer, spool_dir=None, prefixers=None):
+    """Wait for a step's readiness conditions, then run it. Returns (exit code, spool file path or None)."""
+    script_path = os.path.join(directory, step['script'])
+    spool_path = None
+    spool_file = None
+
+    if prefixers:
+        # In-process: tag everything this thread prints with the step name (or send it to the step's spool file)
+        if spool_dir:
+            spool_path = os.path.join(spool_dir, f"{step['name']}.log")
+            spool_file = open(spool_path, 'w', encoding='utf-8')
+        for prefixer in prefixers:
+            prefixer.begin_step(step['name'], spool_file)
+
+    try:
+        # Instead of a fixed delay, wait until the resources this step needs are actually ready
+        if step.get('ready'):
+            with tracer.span(f"{step['name']} readiness", 'readiness', conditions=step['ready']):
+                ready = wait_for_step_readiness(ctx, step)
+            if not ready:
+                # The step fails like a script that exited with an error (its dependents are not run and a rerun
+                # resumes here), unless readiness_timeout_action=start asks for the old "start it anyway"
+                if ctx.setting('readiness_timeout_action', 'fail') != 'start':
+                    say(f"Readiness conditions for {step['script']} did not hold in time, not running it")
+                    return 1, spool_path
+                say(f"Readiness conditions for {step['script']} did not hold in time. Starting it anyway...")
+
+        say(f"Running {script_path}...")
+        step_start = time.time()
+
+        if prefixers:
+            returncode = run_step_in_process(script_path, ctx)
+        elif spool_dir:
+            returncode, spool_path = run_step_spooled(script_path, step['name'], spool_dir)
+        else:
+            returncode = run_step_streaming(script_path, step['name'])
+
+        tracer.add_span(step['name'], 'step', step_start, time.time(), exit_code=returncode)
+        say(f"{step['script']} finished with exit code {returncode}")
+    finally:
+        if prefixers:
+            for prefixer in prefixers:
+                prefixer.flush()
+                prefixer.end_step()
+        if spool_file:
+            spool_file.close()
+
+    return returncode, spool_path
+
+
+def run_pipeline_steps(directory, steps, ctx, spool_dir=None):
+    """Run the manifest steps, starting each one as soon as the steps it depends on have completed.
+
+    Independent steps run at the same time, up to max_parallel_steps (from the .env, default 3; set it to 1 for the
+    old strictly sequential behaviour). By default each step's output is streamed to the console as it is produced,
+    tagged with the step name. With spool_dir set the output of each step is written to a spool file instead; the
+    spool file paths are returned in manifest order so the caller can print them at the end of the run.
+    """
+    in_process = ctx.setting('step_execution', 'subprocess') == 'in_process'
+    max_parallel_steps = max(1, int(ctx.setting('max_parallel_steps', '3')))
+
+    # The readiness callbacks (readiness_callback_url, see readiness_receiver.py) all arrive on one port, so there
+    # can only be one receiver. Step processes can't share it (script 5's would die with its process, and scripts 6
+    # and 9 run at the same time and would both try to bind the port), so the feature needs the in-process steps:
+    # the master starts the receiver here and the steps use it through the shared context.
+    if ctx.setting('readiness_callback_url'):
+        if not in_process:
+            raise ValueError("readiness_callback_url needs step_execution=in_process: the steps have to share the "
+                             "one readiness receiver that listens on readiness_listen_port")
+        ctx.readiness_receiver
+    if spool_dir:
+        os.makedirs(spool_dir, exist_ok=True)
+
+    # Checkpoint/resume: steps that completed in the previous run are skipped, so the pipeline picks up at the first
+    # incomplete step. Once every step has completed (or with reset_run_state=1) the next run starts from scratch.
+    state = ctx.state
+    if ctx.setting('reset_run_state') == '1' or all(state.is_complete(step['name']) for step in steps):
+        state.reset()
+    print(f"Pipeline run {state.run_id} (run state file: {state.path})", flush=True)
+
+    # Timing: each step (and each readiness wait) is a span in the trace. The steps add their own phase spans.
+    tracer = get_tracer()
+    trace_dir = tempfile.mkdtemp(prefix='pipeline_trace_')
+    start_trace_collection(trace_dir)
+
+    prefixers = None
+    if in_process:
+        # Tag the output of the in-process steps the same way the streaming executor tags subprocess output.
+        # The wrappers stay installed for the whole run because logging handlers keep a reference to sys.stderr.
+        console_stdout, console_stderr = sys.stdout, sys.stderr
+        prefixers = (StepOutputPrefixer(sys.stdout), StepOutputPrefixer(sys.stderr, ':stderr'))
+        sys.stdout, sys.stderr = prefixers
+
+    completed = set()
+    not_run = set()
+    pending = []
+    for step in steps:
+        if state.is_complete(step['name']):
+            print(f"Skipping {step['script']}, it already completed in this run", flush=True)
+            completed.add(step['name'])
+        else:
+            pending.append(step)
+
+    spool_paths = {}
+    running = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel_steps) as executor:
+            while pending or running:
+                # Start every pending step whose dependencies have all completed
+                for step in list(pending):
+                    depends_on = step.get('depends_on', [])
+                    blocked_by = [name for name in depends_on if name in not_run]
+                    if blocked_by:
+                        say(f"Not running {step['script']} because {', '.join(blocked_by)} did not complete")
+                        not_run.add(step['name'])
+                        pending.remove(step)
+                    elif all(name in completed for name in depends_on):
+                        future = executor.submit(run_step, directory, step, ctx, tracer, spool_dir, prefixers)
+                        running[future] = step
+                        pending.remove(step)
+
+                if not running:
+                    # Whatever is left depends on a step that is not in the manifest
+                    for step in pending:
+                        say(f"Not running {step['script']}, its dependencies {step.get('depends_on')} can't complete")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        returncode, spool_path = future.result()
+                    except Exception as e:
+                        say(f"{step['script']} could not be run: {e}")
+                        returncode, spool_path = 1, None
+                    if spool_path:
+                        spool_paths[step['name']] = spool_path
+
+                    if returncode == 0:
+                        state.mark_complete(step['name'])
+                        completed.add(step['name'])
+                    else:
+                        # The steps that depend on this one are not run, so a rerun resumes here instead of running
+                        # them on a broken setup. Steps that don't depend on it carry on.
+                        say(f"Rerun the pipeline to resume from {step['script']}")
+                        not_run.add(step['name'])
+    finally:
+        if in_process:
+            sys.stdout, sys.stderr = console_stdout, console_stderr
+        # The SSH connections the in-process steps kept open for each other
+        ctx.close()
+
+        trace_file = ctx.setting('trace_file', TRACE_FILE)
+        events = finish_trace(trace_dir, trace_file)
+        shutil.rmtree(trace_dir, ignore_errors=True)
+        print(f"Timing trace written to {trace_file}")
+        print_trace_summary(events)
+
+    return [spool_paths[step['name']] for step in steps if step['name'] in spool_paths]
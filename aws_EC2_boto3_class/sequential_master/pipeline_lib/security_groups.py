@@ -0,0 +1,75 @@
+from botocore.exceptions import ClientError
+
+# Security group ingress reconciliation.
+# Script 6 used to loop over the security groups once per port (22, 80, 8080) and make one
+# authorize_security_group_ingress call per port per group, relying on InvalidPermission.Duplicate to detect the rules
+# that were already there. Script 8 did the same for 443. reconcile_ingress reads the current rules of all the groups
+# with one describe_security_groups, works out which of the wanted ports are missing in each group, and adds them
+# with one authorize call per group. A rerun, where every rule is already in place, makes no authorize calls at all.
+
+ANYWHERE = '0.0.0.0/0'
+
+
+def tcp_permission(port, cidr=ANYWHERE):
+    return {'IpProtocol': 'tcp', 'FromPort': port, 'ToPort': port, 'IpRanges': [{'CidrIp': cidr}]}
+
+
+def port_allowed(group, port, cidr=ANYWHERE):
+    """Is there an ingress rule in group (a describe_security_groups entry) that lets tcp port in from cidr"""
+    for permission in group.get('IpPermissions', []):
+        if cidr not in [ip_range['CidrIp'] for ip_range in permission.get('IpRanges', [])]:
+            continue
+        if permission['IpProtocol'] == '-1':
+            return True
+        if permission['IpProtocol'] == 'tcp' and permission['FromPort'] <= port <= permission['ToPort']:
+            return True
+    return False
+
+
+def missing_permissions(group, ports, cidr=ANYWHERE):
+    return [tcp_permission(port, cidr) for port in sorted(set(ports)) if not port_allowed(group, port, cidr)]
+
+
+def describe_groups(my_ec2, group_ids):
+    paginator = my_ec2.get_paginator('describe_security_groups')
+    groups = []
+    for page in paginator.paginate(GroupIds=list(group_ids)):
+        groups.extend(page['SecurityGroups'])
+    return groups
+
+
+def _ports(permissions):
+    return ', '.join(str(permission['FromPort']) for permission in permissions)
+
+
+def reconcile_ingress(my_ec2, group_ids, ports, cidr=ANYWHERE):
+    """Make sure every group in group_ids allows the tcp ports from cidr. Returns the number of authorize calls made
+    (one rejected as a duplicate included)."""
+    group_ids = sorted(set(group_ids))
+    if not group_ids:
+        return 0
+    calls = 0
+    for group in describe_groups(my_ec2, group_ids):
+        group_id = group['GroupId']
+        missing = missing_permissions(group, ports, cidr)
+        if not missing:
+            print(f"Security group {group_id} already allows ports {', '.join(str(p) for p in sorted(set(ports)))}")
+            continue
+        try:
+            calls += 1
+            my_ec2.authorize_security_group_ingress(GroupId=group_id, IpPermissions=missing)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+                raise
+            # Another step (scripts 6 and 8 can run at the same time) added one of the rules since the describe:
+            # the whole call was rejected, so read the group again and add what is still missing
+            group = describe_groups(my_ec2, [group_id])[0]
+            missing = missing_permissions(group, ports, cidr)
+            if not missing:
+                print(f"Security group {group_id}: ports {', '.join(str(p) for p in sorted(set(ports)))} were allowed "
+                      f"in the meantime")
+                continue
+            calls += 1
+            my_ec2.authorize_security_group_ingress(GroupId=group_id, IpPermissions=missing)
+        print(f"Security group {group_id}: allowed ports {_ports(missing)} from {cidr}")
+    return calls
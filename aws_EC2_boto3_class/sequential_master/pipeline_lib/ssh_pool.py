@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import OrderedDict
+
+import paramiko
+
+from pipeline_lib.tracing import get_tracer
+
+# SSH connection pool shared by the steps (ctx.ssh_pool).
+# Script 6 used to open a new paramiko.SSHClient per host and close it after the install, script 9 opened its own
+# again, and every connect(key_filename=...) read and parsed the PEM key file. The pool parses the private key once,
+# keeps one authenticated connection per host alive (with keepalives) for the whole run, and hands it out to every
+# phase that needs the host: each command or SFTP session is then just a new channel on the existing transport, so
+# the TCP handshake, key exchange and authentication are paid once per host per run instead of once per phase.
+# A connection that has dropped is replaced with a new one the next time the host is asked for.
+#
+# A connection is in use from connect() until release() or discard(). Once a host's last phase is done its connection
+# is discarded (script 6 after the install, script 9 after the stress test), and a connection that is only released
+# (e.g. after the host probe, to be picked up again by the install) stays open as an idle one. At most max_size
+# connections (ssh_pool_size, default ssh_max_workers) are kept: past that the idle ones are closed, least recently
+# used first, so 1,000 hosts do not keep 1,000 transport threads and sockets open. Connections in use are never
+# closed by the pool, and there are at most ssh_max_workers of those at a time.
+#
+# When the steps run in-process (step_execution=in_process) the whole pipeline shares one pool. The connections that
+# are left are closed when the pipeline finishes (PipelineContext.close).
+
+DEFAULT_USERNAME = 'ubuntu'
+DEFAULT_MAX_SIZE = 50
+DEFAULT_KEY_PATH = 'EC2_generic_key.pem'
+CONNECT_ATTEMPTS = 5
+CONNECT_RETRY_DELAY = 10
+KEEPALIVE_INTERVAL = 30
+
+
+class SSHConnectionPool:
+    """One authenticated paramiko connection per host, reused across phases and steps"""
+
+    def __init__(self, key_path=DEFAULT_KEY_PATH, username=DEFAULT_USERNAME, port=22, connect_timeout=30,
+                 attempts=CONNECT_ATTEMPTS, retry_delay=CONNECT_RETRY_DELAY, max_size=DEFAULT_MAX_SIZE):
+        self.key_path = key_path
+        self.username = username
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.max_size = max_size
+        self._pkey = None
+        # Least recently used first
+        self._clients = OrderedDict()
+        self._in_use = set()
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, ctx):
+        return cls(
+            key_path=ctx.setting('ssh_key_path', DEFAULT_KEY_PATH),
+            connect_timeout=float(ctx.setting('ssh_connect_timeout', 30)),
+            max_size=int(ctx.setting('ssh_pool_size', ctx.setting('ssh_max_workers', DEFAULT_MAX_SIZE))),
+        )
+
+    @property
+    def pkey(self):
+        """The private key, read and parsed on first use only"""
+        with self._lock:
+            if self._pkey is None:
+                self._pkey = paramiko.PKey.from_path(self.key_path)
+            return self._pkey
+
+    def _host_lock(self, host):
+        with self._lock:
+            return self._host_locks.setdefault(host, threading.Lock())
+
+    def _cached(self, host):
+        with self._lock:
+            client = self._clients.get(host)
+        if client is None:
+            return None
+        transport = client.get_transport()
+        if transport is not None and transport.is_active():
+            return client
+        print(f"The SSH connection to {host} dropped, reconnecting")
+        self.discard(host)
+        return None
+
+    def connect(self, host, before_connect=None, attempts=None, timeout=None):
+        """The pooled connection to host (an SSHClient), opened with retries if there is none yet. before_connect is
+        called right before each new connection attempt (HostPool.before_connect). attempts and timeout override
+        the pool's for this call (e.g. a single quick try for the host probe). Returns None if the host can not be
+        reached. The connection is in use until release(host) or discard(host)."""
+        # One connection per host: a second thread asking for the same host waits for the first one's connect
+        with self._host_lock(host):
+            client = self._cached(host)
+            if client is not None:
+                with self._lock:
+                    self._in_use.add(host)
+                    self._clients.move_to_end(host)
+                return client
+            pkey = self.pkey
+            with get_tracer().span('ssh_connect', host=host):
+                attempts = attempts or self.attempts
+                for attempt in range(attempts):
+                    client = paramiko.SSHClient()
+                    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                    try:
+                        print(f"Attempting to connect to {host} (Attempt {attempt + 1})")
+                        if before_connect is not None:
+                            before_connect()
+                        client.connect(host, self.port, self.username, pkey=pkey,
+                                       timeout=timeout or self.connect_timeout, allow_agent=False, look_for_keys=False)
+                        break
+                    except (paramiko.ssh_exception.NoValidConnectionsError, paramiko.ssh_exception.SSHException,
+                            OSError) as e:
+                        # SSHException: e.g. an instance reached early that does not have the key in
+                        # authorized_keys yet
+                        print(f"Connection failed: {e}")
+                        client.close()
+                        if attempt + 1 < attempts:
+                            time.sleep(self.retry_delay)
+                else:
+                    print(f"Failed to connect to {host} after multiple attempts")
+                    return None
+            client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+            with self._lock:
+                self._clients[host] = client
+                self._in_use.add(host)
+            self._evict()
+            return client
+
+    def release(self, host):
+        """Done with the connection to host for now: it stays open, idle, for a later phase (unless the pool is full)"""
+        with self._lock:
+            self._in_use.discard(host)
+            if host in self._clients:
+                self._clients.move_to_end(host)
+        self._evict()
+
+    def _evict(self):
+        # Close the least recently used idle connections past max_size
+        evicted = []
+        with self._lock:
+            for host in list(self._clients):
+                if len(self._clients) <= self.max_size:
+                    break
+                if host not in self._in_use:
+                    evicted.append(self._clients.pop(host))
+        for client in evicted:
+            client.close()
+
+    def discard(self, host):
+        """Close and forget the connection to host (after the host's last phase, an SSH level failure, or a host that
+        is terminated)"""
+        with self._lock:
+            client = self._clients.pop(host, None)
+            self._in_use.discard(host)
+        if client is not None:
+            client.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._in_use.clear()
+        for client in clients:
+            client.close()
+        if clients:
+            print(f"Closed {len(clients)} pooled SSH connections")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
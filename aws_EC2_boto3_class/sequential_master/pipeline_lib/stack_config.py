@@ -0,0 +1,16 @@
+# Network layout of the stack.
+# These used to be hard coded in the create_target_group and create_load_balancer calls of script 7. Script 5 now
+# also needs the subnets, to spread a launch over the same subnets/AZs the ALB spans (see launch_planner.py), so
+# they live here. Replace with your VPC ID and subnet IDs. Using the default VPC here.
+
+VPC_ID = 'vpc-009db827e48cf8c7b'
+
+# [Application Load Balancers] You must specify subnets from at least two Availability Zones.
+SUBNET_IDS = [
+    'subnet-0e34b914c08ba8bd5',
+    'subnet-09638c6f9b996a855',
+    'subnet-092198dd41287da22',
+    'subnet-0183921fc71694caa',
+    'subnet-06840adffc6b5353e',
+    'subnet-005a6e9eec2a0087b',
+]
@@ -0,0 +1,153 @@
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+# Streaming executor for the step scripts.
+# The old runner used subprocess.run(capture_output=True), which holds all of a step's output in memory and only
+# prints it after the step exits (and throws stderr away). Here stdout and stderr are read line by line by two reader
+# threads and handed to the writer through a bounded queue. If the console (or spool file) can't keep up, the readers
+# block, the pipe fills up and the child process is slowed down, so memory stays flat no matter how much apt output
+# script 6 produces.
+
+# Lines longer than this are split up, so a child that never prints a newline can't grow a single line without limit
+MAX_LINE_BYTES = 64 * 1024
+
+# How many lines can be waiting between the reader threads and the writer
+DEFAULT_BUFFER_LINES = 1000
+
+
+def _read_stream(pipe, stream_name, lines):
+    """Reader thread: push each line of the pipe into the bounded queue. None marks the end of the stream."""
+    try:
+        for raw_line in iter(lambda: pipe.readline(MAX_LINE_BYTES), b''):
+            text = raw_line.decode('utf-8', errors='ignore').rstrip('\r\n')
+            # Clean up the output by replacing '\\n' with actual new lines (same clean up as the old runner)
+            for line in text.replace('\\n', '\n').split('\n'):
+                lines.put((stream_name, line))
+    finally:
+        pipe.close()
+        lines.put(None)
+
+
+def run_step_streaming(script_path, step_name, output=None, buffer_lines=DEFAULT_BUFFER_LINES):
+    """Run a step script, writing each stdout/stderr line prefixed with the step name as soon as it is produced.
+
+    output is any text file object (sys.stdout by default). Returns the exit code of the script.
+    """
+    if output is None:
+        output = sys.stdout
+
+    # The step scripts mostly use plain print() without flush, so turn off the child's buffering. Otherwise the
+    # output would still only arrive in 4-8 KB blocks.
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    process = subprocess.Popen(['python3', script_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+
+    lines = queue.Queue(maxsize=buffer_lines)
+    readers = [
+        threading.Thread(target=_read_stream, args=(process.stdout, 'stdout', lines), daemon=True),
+        threading.Thread(target=_read_stream, args=(process.stderr, 'stderr', lines), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    open_streams = len(readers)
+    while open_streams:
+        item = lines.get()
+        if item is None:
+            open_streams -= 1
+            continue
+        stream_name, line = item
+        if stream_name == 'stderr':
+            output.write(f"[{step_name}:stderr] {line}\n")
+        else:
+            output.write(f"[{step_name}] {line}\n")
+        # Flush once the queue is drained rather than for every line
+        if lines.empty():
+            output.flush()
+
+    for reader in readers:
+        reader.join()
+    output.flush()
+    return process.wait()
+
+
+def run_step_spooled(script_path, step_name, spool_dir, buffer_lines=DEFAULT_BUFFER_LINES):
+    """Same as run_step_streaming but the output goes to <spool_dir>/<step_name>.log instead of the console.
+
+    Returns (exit code, spool file path). Used by the "all output printed out at end" runner so the output of the
+    whole pipeline is kept on disk instead of in memory until it is printed.
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    spool_path = os.path.join(spool_dir, f"{step_name}.log")
+    with open(spool_path, 'w', encoding='utf-8') as spool_file:
+        returncode = run_step_streaming(script_path, step_name, output=spool_file, buffer_lines=buffer_lines)
+    return returncode, spool_path
+
+
+def print_spool_files(spool_paths, output=None):
+    """Copy the spooled step output to the console, one line at a time"""
+    if output is None:
+        output = sys.stdout
+    for spool_path in spool_paths:
+        with open(spool_path, 'r', encoding='utf-8') as spool_file:
+            for line in spool_file:
+                output.write(line)
+    output.flush()
+
+
+class StepOutputPrefixer:
+    """Stand-in for sys.stdout / sys.stderr while step scripts run in-process in the master runner.
+
+    Gives in-process steps the same "[step] line" output as the streaming executor. Each step registers the thread it
+    runs on with begin_step(). Threads the steps start themselves (e.g. script 6's ThreadPoolExecutor) are not
+    registered; their output is tagged with the running step when only one is running, and with "steps" otherwise.
+    Partial lines are buffered per thread, so concurrent threads can't interleave half lines.
+    """
+
+    def __init__(self, stream, suffix=''):
+        self.stream = stream
+        self.suffix = suffix
+        self._partial = {}
+        # thread ident -> (step name, stream) for the threads running a step
+        self._steps = {threading.get_ident(): ('master', stream)}
+        self._lock = threading.Lock()
+
+    def begin_step(self, step_name, stream=None):
+        """Send the output of the calling thread to stream (the console by default), tagged with step_name"""
+        with self._lock:
+            self._steps[threading.get_ident()] = (step_name, stream or self.stream)
+
+    def end_step(self):
+        with self._lock:
+            self._steps.pop(threading.get_ident(), None)
+
+    def _target(self, thread_id):
+        if thread_id in self._steps:
+            return self._steps[thread_id]
+        running = [target for target in self._steps.values() if target[0] != 'master']
+        if len(running) == 1:
+            return running[0]
+        return 'steps', self.stream
+
+    def write(self, text):
+        thread_id = threading.get_ident()
+        with self._lock:
+            lines = (self._partial.pop(thread_id, '') + text).split('\n')
+            # The last piece has no newline yet, keep it until the rest of the line arrives
+            if lines[-1]:
+                self._partial[thread_id] = lines[-1]
+            step_name, stream = self._target(thread_id)
+            for line in lines[:-1]:
+                stream.write(f"[{step_name}{self.suffix}] {line}\n")
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            for _, stream in set(self._steps.values()):
+                stream.flush()
+
+    def __getattr__(self, name):
+        # encoding, isatty(), fileno() etc. come from the real stream
+        return getattr(self.stream, name)
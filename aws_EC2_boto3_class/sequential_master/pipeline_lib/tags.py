@@ -0,0 +1,33 @@
+# EC2 tags the pipeline puts on the instances it launches.
+#   pipeline:stack   the stack the instance belongs to (stack_name in the .env, default tomcat-alb). Stopped
+#                    instances with this tag are the warm pool (see warm_pool.py).
+#   pipeline:run     the run_id of the run that launched (or restarted) the instance, from the run state. The later
+#                    steps find their instances with this tag instead of scanning every running instance in the
+#                    account (see inventory.py).
+#   pipeline:role    tomcat for the target group fleet, stress for the stress traffic generator.
+#   pipeline:tomcat  the install manifest hash Tomcat was installed with (set by script 6 after a successful install),
+#                    so a warm instance that is started again does not get Tomcat installed a second time.
+
+STACK_TAG_KEY = 'pipeline:stack'
+RUN_TAG_KEY = 'pipeline:run'
+ROLE_TAG_KEY = 'pipeline:role'
+TOMCAT_TAG_KEY = 'pipeline:tomcat'
+
+DEFAULT_STACK_NAME = 'tomcat-alb'
+
+
+def stack_name(ctx):
+    return ctx.setting('stack_name', DEFAULT_STACK_NAME)
+
+
+def instance_tag_specifications(tags):
+    """TagSpecifications for run_instances from a dict of tags"""
+    return [{'ResourceType': 'instance', 'Tags': [{'Key': key, 'Value': value} for key, value in tags.items()]}]
+
+
+def tag_value(instance, key):
+    """The value of tag key on an instance from describe_instances/run_instances, None if it is not set"""
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
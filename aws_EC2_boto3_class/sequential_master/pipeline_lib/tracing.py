@@ -0,0 +1,148 @@
+import atexit
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Timing instrumentation for the pipeline.
+# The master runner and the steps record timed spans (step, phase, host) with get_tracer().span(...). At the end of
+# the run the master writes them all out as one Chrome trace JSON file (open it in https://ui.perfetto.dev or
+# chrome://tracing) and prints a summary table, so we can see where a run spent its time (run_instances, status check
+# polling, SSH connects, apt, ACM issuance...) and compare runs.
+#
+# Steps that run as subprocesses dump their spans into a directory the master passes down in the environment, and
+# the master merges them in. In-process steps record straight into the master's tracer.
+
+# Environment variable the master uses to tell the step subprocesses where to dump their spans
+TRACE_DIR_ENV = 'pipeline_trace_dir'
+
+TRACE_FILE = 'pipeline_trace.json'
+
+
+class Tracer:
+    """Collects spans as Chrome trace "complete" events"""
+
+    def __init__(self, process_name):
+        self.process_name = process_name
+        self.pid = os.getpid()
+        self.events = []
+        self._thread_ids = {}
+        self._lock = threading.Lock()
+
+    def _tid(self):
+        # Small thread numbers read better in the trace viewer than the real thread idents
+        ident = threading.get_ident()
+        with self._lock:
+            if ident not in self._thread_ids:
+                self._thread_ids[ident] = len(self._thread_ids) + 1
+                self.events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': self._thread_ids[ident],
+                    'args': {'name': threading.current_thread().name}
+                })
+            return self._thread_ids[ident]
+
+    def add_span(self, name, category, start, end, **args):
+        """Record a span that has already finished. start and end are time.time() values."""
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1000000),
+            'dur': int((end - start) * 1000000),
+            'pid': self.pid,
+            'tid': self._tid(),
+            'args': args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category='phase', **args):
+        """Time the with block, e.g. with tracer.span('ssh_connect', host=ip): ..."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.time(), **args)
+
+    def snapshot(self):
+        """All the events recorded so far, with the process name metadata event"""
+        with self._lock:
+            events = list(self.events)
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': self.process_name}})
+        return events
+
+    def dump_to_dir(self, trace_dir):
+        """Write this process's events to trace_dir (used by the step subprocesses on exit)"""
+        events = self.snapshot()
+        if len(events) > 1:
+            with open(os.path.join(trace_dir, f"{self.pid}.json"), 'w') as f:
+                json.dump(events, f)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """The tracer of this process"""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer(os.path.basename(sys.argv[0]) or 'python')
+            trace_dir = os.getenv(TRACE_DIR_ENV)
+            if trace_dir:
+                # This is a step subprocess started by the master runner: hand the spans over when the step exits
+                atexit.register(_tracer.dump_to_dir, trace_dir)
+        return _tracer
+
+
+def start_trace_collection(trace_dir):
+    """Called by the master runner: step subprocesses started after this dump their spans into trace_dir"""
+    get_tracer().process_name = 'master runner'
+    os.makedirs(trace_dir, exist_ok=True)
+    os.environ[TRACE_DIR_ENV] = trace_dir
+
+
+def finish_trace(trace_dir, trace_file=TRACE_FILE):
+    """Merge the master's spans with the ones the subprocesses dumped, write the trace file and return the events"""
+    events = get_tracer().snapshot()
+    for path in sorted(glob.glob(os.path.join(trace_dir, '*.json'))):
+        with open(path, 'r') as f:
+            events.extend(json.load(f))
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return events
+
+
+def print_trace_summary(events):
+    """Print a table of the recorded spans: steps in the order they ran, then the phases by total time"""
+    spans = [event for event in events if event['ph'] == 'X']
+    if not spans:
+        return
+
+    print("\n### Pipeline timing summary")
+    print(f"{'Step':<40} {'Start (s)':>10} {'Duration (s)':>14}")
+    run_start = min(span['ts'] for span in spans)
+    for span in sorted((span for span in spans if span['cat'] == 'step'), key=lambda span: span['ts']):
+        print(f"{span['name']:<40} {(span['ts'] - run_start) / 1e6:>10.1f} {span['dur'] / 1e6:>14.1f}")
+
+    # Phases are aggregated over hosts, e.g. 50 "apt install" spans become one row
+    totals = {}
+    for span in spans:
+        if span['cat'] == 'step':
+            continue
+        key = (span['cat'], span['name'])
+        count, total, longest = totals.get(key, (0, 0, 0))
+        totals[key] = (count + 1, total + span['dur'], max(longest, span['dur']))
+
+    print(f"\n{'Phase':<60} {'Count':>6} {'Total (s)':>10} {'Max (s)':>9}")
+    for (category, name), (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        label = f"{category}: {name}"
+        if len(label) > 60:
+            label = label[:57] + '...'
+        print(f"{label:<60} {count:>6} {total / 1e6:>10.1f} {longest / 1e6:>9.1f}")
+    sys.stdout.flush()
@@ -0,0 +1,51 @@
+from pipeline_lib.bootstrap import render_bootstrap_script
+
+# cloud-init user-data provisioning (provision_mode=user_data in the .env).
+# Script 5 passes the Tomcat install commands to run_instances as user-data, so every instance installs Tomcat
+# while it boots, all in parallel and without any SSH round trip from the controller. Script 6 then only confirms
+# that Tomcat answers on each host.
+#
+# The user-data writes the same bootstrap script as install_mode=bootstrap (per command retries and markers) to
+# /var/lib/pipeline/install.sh, runs it with the output going to /var/log/pipeline-install.log and the console, and
+# leaves the exit code in /var/lib/pipeline/install.exit_code plus a "PIPELINE_INSTALL exit_code=N" line on the
+# console, which script 6 looks for in the console output of a host that never came up.
+
+STATUS_DIRECTORY = '/var/lib/pipeline'
+INSTALL_LOG = '/var/log/pipeline-install.log'
+CONSOLE_MARKER = 'PIPELINE_INSTALL exit_code='
+
+# EC2 limit on the user-data size (before base64)
+MAX_USER_DATA_BYTES = 16384
+
+
+def render_user_data(commands, retries=3, backoff=10, after_install=''):
+    """The user-data shell script that runs commands at first boot. after_install is shell run once the exit code
+    is saved (the readiness callback, see readiness_receiver.py)."""
+    install_script = render_bootstrap_script(commands, retries, backoff, remove_when_done=False)
+    user_data = f"""#!/bin/bash
+# Tomcat install at first boot, generated by the pipeline (pipeline_lib/user_data.py)
+mkdir -p {STATUS_DIRECTORY}
+cat > {STATUS_DIRECTORY}/install.sh <<'PIPELINE_INSTALL_SCRIPT'
+{install_script}PIPELINE_INSTALL_SCRIPT
+bash {STATUS_DIRECTORY}/install.sh > {INSTALL_LOG} 2>&1
+rc=$?
+echo $rc > {STATUS_DIRECTORY}/install.exit_code
+echo "{CONSOLE_MARKER}$rc" > /dev/console
+{after_install}exit $rc
+"""
+    if len(user_data.encode('utf-8')) > MAX_USER_DATA_BYTES:
+        raise ValueError(f"user-data is larger than {MAX_USER_DATA_BYTES} bytes")
+    return user_data
+
+
+def console_install_status(my_ec2, instance_id):
+    """The install exit code from the console output of instance_id, or None if it is not there (yet)"""
+    try:
+        output = my_ec2.get_console_output(InstanceId=instance_id, Latest=True).get('Output', '')
+    except my_ec2.exceptions.ClientError as e:
+        print(f"Could not get the console output of {instance_id}: {e}")
+        return None
+    for line in reversed(output.splitlines()):
+        if CONSOLE_MARKER in line:
+            return int(line.split(CONSOLE_MARKER)[1].split()[0])
+    return None
@@ -0,0 +1,39 @@
+from pipeline_lib.tags import STACK_TAG_KEY
+
+# Warm pool of stopped instances (warm_pool=1 in the .env).
+# The holdoff scripts stop the fleet after a run. Those stopped instances already have Tomcat installed, and starting
+# one takes seconds where launching and installing a new one takes minutes. With the warm pool on, script 5 first
+# starts up to max_count stopped instances tagged with this stack (pipeline:stack, see tags.py) and only launches the
+# shortfall. Script 6 then skips the install on hosts whose pipeline:tomcat tag matches the current install manifest.
+
+
+def find_stopped_stack_instances(my_ec2, stack):
+    """The stopped instances tagged with this stack, oldest launch first"""
+    paginator = my_ec2.get_paginator('describe_instances')
+    instances = []
+    for page in paginator.paginate(Filters=[
+        {'Name': f'tag:{STACK_TAG_KEY}', 'Values': [stack]},
+        {'Name': 'instance-state-name', 'Values': ['stopped']},
+    ]):
+        for reservation in page['Reservations']:
+            instances.extend(reservation['Instances'])
+    return sorted(instances, key=lambda instance: instance['LaunchTime'])
+
+
+def start_warm_instances(my_ec2, stack, count):
+    """Start up to count stopped instances of the stack. Returns their describe_instances entries."""
+    if count <= 0:
+        return []
+    instances = find_stopped_stack_instances(my_ec2, stack)[:count]
+    if not instances:
+        print(f"No stopped instances in the warm pool of stack {stack}")
+        return []
+    instance_ids = [instance['InstanceId'] for instance in instances]
+    try:
+        my_ec2.start_instances(InstanceIds=instance_ids)
+    except my_ec2.exceptions.ClientError as e:
+        # e.g. InsufficientInstanceCapacity: fall back to launching the whole fleet
+        print(f"Error starting warm pool instances {instance_ids}: {e}")
+        return []
+    print(f"Started {len(instance_ids)} warm pool instances of stack {stack}: {', '.join(instance_ids)}")
+    return instances
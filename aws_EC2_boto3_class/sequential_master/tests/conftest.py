@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts import the library as pipeline_lib from the sequential_master directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
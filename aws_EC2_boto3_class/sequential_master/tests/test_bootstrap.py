@@ -0,0 +1,60 @@
+import subprocess
+
+from pipeline_lib.bootstrap import MARKER, _StreamSplitter, parse_marker, render_bootstrap_script
+
+
+def run_script(tmp_path, commands, retries=3):
+    path = tmp_path / 'bootstrap.sh'
+    path.write_text(render_bootstrap_script(commands, retries=retries, backoff=0, remove_when_done=False))
+    return subprocess.run(['bash', str(path)], capture_output=True, cwd=tmp_path)
+
+
+def split(data):
+    splitter = _StreamSplitter()
+    markers = splitter.feed(data)
+    return splitter, markers
+
+
+def test_parse_marker():
+    assert parse_marker(f"{MARKER} 2 start") == (2, 'start', None, None)
+    assert parse_marker(f"{MARKER} 2 end 100 3") == (2, 'end', 100, 3)
+    assert parse_marker('Reading package lists...') is None
+    assert parse_marker(f"{MARKER}X 1 start") is None
+
+
+def test_script_reports_each_command(tmp_path):
+    process = run_script(tmp_path, ['echo one', 'echo two; echo warning >&2'])
+    assert process.returncode == 0
+    out, markers = split(process.stdout)
+    assert markers == [(0, 'start', None, None), (0, 'end', 0, 1), (1, 'start', None, None), (1, 'end', 0, 1)]
+    assert out.text(0) == 'one'
+    assert out.text(1) == 'two'
+    err, _ = split(process.stderr)
+    assert err.text(1) == 'warning'
+
+
+def test_script_retries_then_stops_at_the_failing_command(tmp_path):
+    # Fails on the first attempt only (the counter file survives between attempts)
+    flaky = 'if [ ! -e tried ]; then touch tried; false; fi'
+    process = run_script(tmp_path, [flaky, '(exit 7)', 'echo never'], retries=2)
+    assert process.returncode == 7
+    out, markers = split(process.stdout)
+    assert (0, 'end', 0, 2) in markers
+    assert (1, 'end', 7, 2) in markers
+    assert all(marker[0] != 2 for marker in markers)
+
+
+def test_splitter_handles_lines_split_across_chunks():
+    splitter = _StreamSplitter()
+    data = f"{MARKER} 0 start\nhello\n{MARKER} 0 end 0 1\n".encode()
+    markers = []
+    for i in range(0, len(data), 5):
+        markers += splitter.feed(data[i:i + 5])
+    assert markers == [(0, 'start', None, None), (0, 'end', 0, 1)]
+    assert splitter.text(0) == 'hello'
+
+
+def test_output_before_the_first_marker_is_kept_apart():
+    splitter, markers = split(f"bash: oops\n{MARKER} 0 start\nok\n".encode())
+    assert splitter.text(None) == 'bash: oops'
+    assert splitter.text(0) == 'ok'
@@ -0,0 +1,41 @@
+import gzip
+
+from pipeline_lib.host_log import MAX_LINE_BYTES, HostLog
+
+
+def test_log_is_gzip_and_appends_runs(tmp_path):
+    for run in range(2):
+        log = HostLog(str(tmp_path), '10.0.0.1')
+        log.note(f"run {run}")
+        log.write(b'output\n')
+        log.close()
+    text = gzip.open(tmp_path / '10.0.0.1.log.gz').read().decode()
+    assert text.count('output\n') == 2
+    assert 'run 0' in text and 'run 1' in text
+
+
+def test_tail_keeps_the_last_lines(tmp_path):
+    log = HostLog(str(tmp_path), 'host', tail_lines=3)
+    for i in range(10):
+        log.write(f"line {i}\n")
+    # A line split across chunks, without its newline yet
+    log.write('par')
+    log.write('tial')
+    assert log.tail().splitlines() == ['line 8', 'line 9', 'partial']
+    assert log.bytes_written == len(''.join(f"line {i}\n" for i in range(10))) + len('partial')
+    log.close()
+
+
+def test_long_lines_are_cut_in_the_tail_only(tmp_path):
+    log = HostLog(str(tmp_path), 'host')
+    log.write('x' * (MAX_LINE_BYTES * 2) + '\n')
+    assert len(log.tail()) == MAX_LINE_BYTES
+    log.close()
+    assert len(gzip.open(log.path).read()) == MAX_LINE_BYTES * 2 + 1
+
+
+def test_write_after_close_is_ignored(tmp_path):
+    log = HostLog(str(tmp_path), 'host')
+    log.close()
+    log.write('late\n')
+    log.close()
@@ -0,0 +1,106 @@
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+
+from pipeline_lib.launch_planner import (
+    CLIENT_TOKEN_LENGTH,
+    LaunchPlanError,
+    check_vcpu_quota,
+    client_token,
+    fallback_subnets,
+    launch_chunk,
+    plan_chunks,
+)
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'RunInstances')
+
+
+def test_plan_chunks_splits_evenly_then_by_chunk_size():
+    chunks = plan_chunks(11, ['a', 'b', 'c'], chunk_size=2)
+    assert chunks == [('a', 2), ('a', 2), ('b', 2), ('b', 2), ('c', 2), ('c', 1)]
+    assert sum(count for subnet, count in chunks) == 11
+
+
+def test_plan_chunks_more_subnets_than_instances():
+    assert plan_chunks(2, ['a', 'b', 'c']) == [('a', 1), ('b', 1)]
+
+
+def test_plan_chunks_needs_a_subnet():
+    with pytest.raises(ValueError):
+        plan_chunks(5, [])
+
+
+def test_fallback_subnets_other_az_first():
+    zones = {'a': 'az1', 'b': 'az1', 'c': 'az2', 'd': 'az3'}
+    assert fallback_subnets('a', zones) == ['c', 'd', 'b']
+
+
+def test_client_token_is_per_chunk_and_attempt_and_bounded():
+    assert client_token('run', 3, 1) == 'run-chunk3-try1'
+    assert client_token('run', 3, 1) != client_token('run', 3, 2)
+    assert len(client_token('x' * 100, 1, 1)) == CLIENT_TOKEN_LENGTH
+
+
+def quota_clients(quota, running_types, vcpus_per_instance):
+    my_ec2 = mock.Mock()
+    my_ec2.get_paginator.return_value.paginate.return_value = [{'Reservations': [{'Instances': [
+        {'InstanceType': instance_type, 'CpuOptions': {'CoreCount': 1, 'ThreadsPerCore': 2}}
+        for instance_type in running_types
+    ]}]}]
+    my_ec2.describe_instance_types.return_value = {
+        'InstanceTypes': [{'VCpuInfo': {'DefaultVCpus': vcpus_per_instance}}]
+    }
+    quotas_client = mock.Mock()
+    quotas_client.get_service_quota.return_value = {'Quota': {'Value': quota}}
+    return my_ec2, quotas_client
+
+
+def test_check_vcpu_quota_trims_to_what_fits():
+    # 2 running standard instances use 4 of 20 vCPUs: 8 more 2 vCPU instances fit
+    my_ec2, quotas_client = quota_clients(20, ['t2.micro', 'm5.large'], 2)
+    assert check_vcpu_quota(my_ec2, quotas_client, 't2.micro', 5, 50) == 8
+
+
+def test_check_vcpu_quota_fails_below_min_count():
+    my_ec2, quotas_client = quota_clients(8, [], 2)
+    with pytest.raises(LaunchPlanError):
+        check_vcpu_quota(my_ec2, quotas_client, 't2.micro', 5, 10)
+
+
+def test_check_vcpu_quota_skips_other_families():
+    quotas_client = mock.Mock()
+    assert check_vcpu_quota(mock.Mock(), quotas_client, 'p3.2xlarge', 5, 10) == 10
+    quotas_client.get_service_quota.assert_not_called()
+
+
+def test_check_vcpu_quota_skipped_when_unreadable():
+    my_ec2, quotas_client = quota_clients(8, [], 2)
+    quotas_client.get_service_quota.side_effect = client_error('AccessDeniedException')
+    assert check_vcpu_quota(my_ec2, quotas_client, 't2.micro', 5, 10) == 10
+
+
+def test_launch_chunk_retries_capacity_errors_in_another_az():
+    my_ec2 = mock.Mock()
+    my_ec2.run_instances.side_effect = [
+        client_error('InsufficientInstanceCapacity'),
+        {'Instances': [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}]},
+        {'Instances': [{'InstanceId': 'i-3'}]},
+    ]
+    zones = {'a': 'az1', 'b': 'az2', 'c': 'az3'}
+    instances = launch_chunk(my_ec2, 0, 'a', 3, zones, {'ImageId': 'ami-1'}, 'run')
+    assert [instance['InstanceId'] for instance in instances] == ['i-1', 'i-2', 'i-3']
+    calls = my_ec2.run_instances.call_args_list
+    assert [call.kwargs['SubnetId'] for call in calls] == ['a', 'b', 'c']
+    # Only what is still missing is asked for, with a new token per attempt
+    assert [call.kwargs['MaxCount'] for call in calls] == [3, 3, 1]
+    assert len({call.kwargs['ClientToken'] for call in calls}) == 3
+
+
+def test_launch_chunk_raises_other_errors():
+    my_ec2 = mock.Mock()
+    my_ec2.run_instances.side_effect = client_error('InvalidAMIID.NotFound')
+    with pytest.raises(ClientError):
+        launch_chunk(my_ec2, 0, 'a', 3, {'a': 'az1', 'b': 'az2'}, {}, 'run')
@@ -0,0 +1,76 @@
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from pipeline_lib.readiness import CONDITIONS, wait_for_step_readiness, wait_until
+
+
+class Context:
+    """The parts of PipelineContext the conditions use: client() and state.get()"""
+
+    def __init__(self, outputs=None, **clients):
+        self.clients = clients
+        self.state = mock.Mock()
+        self.state.get.side_effect = lambda key, default=None: (outputs or {}).get(key, default)
+
+    def client(self, name):
+        return self.clients[name]
+
+
+def test_instances_running():
+    ec2 = mock.Mock()
+    ec2.describe_instances.return_value = {'Reservations': [{'Instances': [
+        {'State': {'Name': 'running'}}, {'State': {'Name': 'pending'}},
+    ]}]}
+    check = CONDITIONS['instances_running'](Context({'instance_ids': ['i-1', 'i-2']}, ec2=ec2))
+    assert not check()
+    ec2.describe_instances.return_value['Reservations'][0]['Instances'][1]['State']['Name'] = 'running'
+    assert check()
+
+
+def test_targets_healthy():
+    elbv2 = mock.Mock()
+    elbv2.exceptions.TargetGroupNotFoundException = ClientError
+    elbv2.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'arn:tg'}]}
+    elbv2.describe_target_health.return_value = {'TargetHealthDescriptions': []}
+    check = CONDITIONS['targets_healthy'](Context(elbv2=elbv2))
+    # Nothing registered yet
+    assert not check()
+    elbv2.describe_target_health.return_value = {'TargetHealthDescriptions': [
+        {'TargetHealth': {'State': 'healthy'}}, {'TargetHealth': {'State': 'initial'}},
+    ]}
+    assert not check()
+    elbv2.describe_target_health.return_value['TargetHealthDescriptions'][1]['TargetHealth']['State'] = 'healthy'
+    assert check()
+
+
+def test_certificate_issued_uses_the_run_certificate():
+    acm = mock.Mock()
+    acm.describe_certificate.return_value = {'Certificate': {'Status': 'PENDING_VALIDATION'}}
+    check = CONDITIONS['certificate_issued'](Context({'certificate_arn': 'arn:cert'}, acm=acm))
+    assert not check()
+    acm.describe_certificate.return_value = {'Certificate': {'Status': 'ISSUED'}}
+    assert check()
+    acm.get_paginator.assert_not_called()
+
+
+def test_wait_until_polls_and_times_out():
+    results = iter([False, Exception('throttled'), True])
+
+    def check():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    with mock.patch('pipeline_lib.readiness.time.sleep'):
+        assert wait_until(check, 60, interval=1)
+        assert not wait_until(lambda: False, 0)
+
+
+def test_wait_for_step_readiness_checks_every_condition():
+    ready = {'a': True, 'b': False}
+    with mock.patch.dict(CONDITIONS, {name: (lambda ctx, name=name: lambda: ready[name]) for name in ready}):
+        assert wait_for_step_readiness(None, {'script': 's', 'ready': ['a'], 'timeout': 0})
+        assert not wait_for_step_readiness(None, {'script': 's', 'ready': ['a', 'b'], 'timeout': 0})
+        assert wait_for_step_readiness(None, {'script': 's', 'ready': []})
@@ -0,0 +1,55 @@
+import json
+from multiprocessing import Process
+
+from pipeline_lib.run_state import RunState
+
+
+def test_run_id_is_stable_until_reset(tmp_path):
+    state = RunState(str(tmp_path / 'state.json'))
+    run_id = state.run_id
+    assert RunState(state.path).run_id == run_id
+    state.reset()
+    assert state.run_id != run_id
+
+
+def test_record_and_complete(tmp_path):
+    state = RunState(str(tmp_path / 'state.json'))
+    state.record('5_launch', instance_ids=['i-1'])
+    state.record('7_alb', target_group_arn='arn:tg')
+    assert state.get('instance_ids') == ['i-1']
+    assert state.get('target_group_arn') == 'arn:tg'
+    assert state.get('missing', 'default') == 'default'
+    assert not state.is_complete('5_launch')
+    state.mark_complete('5_launch')
+    assert state.is_complete('5_launch')
+    data = json.load(open(state.path))
+    assert data['steps']['5_launch']['outputs'] == {'instance_ids': ['i-1']}
+    assert data['steps']['7_alb']['status'] == 'incomplete'
+
+
+def test_reset_drops_steps_and_outputs(tmp_path):
+    state = RunState(str(tmp_path / 'state.json'))
+    state.record('5_launch', instance_ids=['i-1'])
+    state.mark_complete('5_launch')
+    state.reset()
+    assert not state.is_complete('5_launch')
+    assert state.get('instance_ids') is None
+
+
+def _record_many(path, step_name, count):
+    state = RunState(path)
+    for i in range(count):
+        state.record(step_name, **{f"{step_name}_{i}": i})
+
+
+def test_concurrent_writers_do_not_lose_updates(tmp_path):
+    # The steps record from their own processes at the same time: every read-modify-write runs under the file lock
+    path = str(tmp_path / 'state.json')
+    RunState(path).run_id
+    processes = [Process(target=_record_many, args=(path, f"step{n}", 20)) for n in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    outputs = RunState(path).load()['outputs']
+    assert len(outputs) == 80
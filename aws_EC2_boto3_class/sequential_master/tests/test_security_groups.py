@@ -0,0 +1,77 @@
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from pipeline_lib.security_groups import missing_permissions, port_allowed, reconcile_ingress, tcp_permission
+
+
+def group(group_id, *permissions):
+    return {'GroupId': group_id, 'IpPermissions': list(permissions)}
+
+
+def ec2_with(groups):
+    """A mocked ec2 client whose describe_security_groups paginator returns groups (a dict by ID, can be changed)"""
+    my_ec2 = mock.Mock()
+    my_ec2.get_paginator.return_value.paginate.side_effect = lambda GroupIds: [
+        {'SecurityGroups': [groups[group_id] for group_id in GroupIds]}
+    ]
+    return my_ec2
+
+
+def test_port_allowed():
+    assert port_allowed(group('sg', tcp_permission(22)), 22)
+    assert not port_allowed(group('sg', tcp_permission(22)), 80)
+    assert port_allowed(group('sg', {'IpProtocol': 'tcp', 'FromPort': 8000, 'ToPort': 9000,
+                                     'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}), 8080)
+    assert port_allowed(group('sg', {'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}), 443)
+    # From somewhere else only
+    assert not port_allowed(group('sg', tcp_permission(22, '10.0.0.0/8')), 22)
+
+
+def test_missing_permissions():
+    missing = missing_permissions(group('sg', tcp_permission(80)), [8080, 22, 80, 22])
+    assert [permission['FromPort'] for permission in missing] == [22, 8080]
+
+
+def test_reconcile_makes_one_call_per_group_with_missing_ports():
+    groups = {'sg-1': group('sg-1', tcp_permission(22)), 'sg-2': group('sg-2')}
+    my_ec2 = ec2_with(groups)
+    assert reconcile_ingress(my_ec2, ['sg-2', 'sg-1', 'sg-1'], [22, 80]) == 2
+    calls = {call.kwargs['GroupId']: [p['FromPort'] for p in call.kwargs['IpPermissions']]
+             for call in my_ec2.authorize_security_group_ingress.call_args_list}
+    assert calls == {'sg-1': [80], 'sg-2': [22, 80]}
+
+
+def test_reconcile_rerun_makes_no_calls():
+    my_ec2 = ec2_with({'sg-1': group('sg-1', tcp_permission(22), tcp_permission(80))})
+    assert reconcile_ingress(my_ec2, ['sg-1'], [22, 80]) == 0
+    my_ec2.authorize_security_group_ingress.assert_not_called()
+    assert reconcile_ingress(my_ec2, [], [22]) == 0
+
+
+def test_reconcile_duplicate_retries_what_is_still_missing():
+    groups = {'sg-1': group('sg-1')}
+    my_ec2 = ec2_with(groups)
+
+    def authorize(GroupId, IpPermissions):
+        if my_ec2.authorize_security_group_ingress.call_count == 1:
+            # Another step added port 22 after the describe
+            groups['sg-1'] = group('sg-1', tcp_permission(22))
+            raise ClientError({'Error': {'Code': 'InvalidPermission.Duplicate', 'Message': ''}}, 'Authorize')
+
+    my_ec2.authorize_security_group_ingress.side_effect = authorize
+    assert reconcile_ingress(my_ec2, ['sg-1'], [22, 80]) == 2
+    retry = my_ec2.authorize_security_group_ingress.call_args_list[1]
+    assert [p['FromPort'] for p in retry.kwargs['IpPermissions']] == [80]
+
+
+def test_reconcile_duplicate_with_nothing_left_to_add():
+    groups = {'sg-1': group('sg-1')}
+    my_ec2 = ec2_with(groups)
+
+    def authorize(GroupId, IpPermissions):
+        groups['sg-1'] = group('sg-1', tcp_permission(443))
+        raise ClientError({'Error': {'Code': 'InvalidPermission.Duplicate', 'Message': ''}}, 'Authorize')
+
+    my_ec2.authorize_security_group_ingress.side_effect = authorize
+    assert reconcile_ingress(my_ec2, ['sg-1'], [443]) == 1
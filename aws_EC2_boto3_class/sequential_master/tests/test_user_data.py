@@ -0,0 +1,41 @@
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+
+from pipeline_lib.bootstrap import render_bootstrap_script
+from pipeline_lib.user_data import CONSOLE_MARKER, MAX_USER_DATA_BYTES, console_install_status, render_user_data
+
+
+def test_user_data_embeds_the_bootstrap_script():
+    commands = ['sudo apt-get update', 'sudo apt-get install -y tomcat9']
+    user_data = render_user_data(commands, after_install='curl -s http://controller/ready\n')
+    assert user_data.startswith('#!/bin/bash\n')
+    assert render_bootstrap_script(commands, remove_when_done=False) in user_data
+    assert f'echo "{CONSOLE_MARKER}$rc" > /dev/console' in user_data
+    # The callback runs after the exit code is saved, before the script exits with it
+    assert user_data.index('install.exit_code') < user_data.index('curl -s') < user_data.rindex('exit $rc')
+
+
+def test_user_data_size_guard():
+    render_user_data(['echo ' + 'x' * 1000])
+    with pytest.raises(ValueError):
+        render_user_data(['echo ' + 'x' * MAX_USER_DATA_BYTES])
+
+
+def ec2_with_console(output=None, error=None):
+    my_ec2 = mock.Mock()
+    my_ec2.exceptions.ClientError = ClientError
+    if error:
+        my_ec2.get_console_output.side_effect = ClientError({'Error': {'Code': error, 'Message': ''}}, 'Console')
+    else:
+        my_ec2.get_console_output.return_value = {'Output': output}
+    return my_ec2
+
+
+def test_console_install_status():
+    output = f"boot...\n{CONSOLE_MARKER}100\nmore\n{CONSOLE_MARKER}0 \n"
+    assert console_install_status(ec2_with_console(output), 'i-1') == 0
+    assert console_install_status(ec2_with_console(f"{CONSOLE_MARKER}100\n"), 'i-1') == 100
+    assert console_install_status(ec2_with_console('still booting\n'), 'i-1') is None
+    assert console_install_status(ec2_with_console(error='InvalidInstanceID.NotFound'), 'i-1') is None